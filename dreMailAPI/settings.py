@@ -39,8 +39,8 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated', 
      ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        'dre_mail_api.authentication.CachedUserJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -84,6 +84,7 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
     'ROTATE_REFRESH_TOKENS': True,
     'BLACKLIST_AFTER_ROTATION': True,
+    'TOKEN_REFRESH_SERIALIZER': 'dre_mail_api.blacklist.FilteredTokenRefreshSerializer',
 }
 
 MIDDLEWARE = [
@@ -145,6 +146,93 @@ if DEBUG == True:
     }
 
 
+# Caches
+# The mailbox alias holds the cached mailbox listings, and the users alias the users the
+# JWT authentication reads. Without REDIS_URL each process keeps an in memory cache of at
+# most MAX_ENTRIES entries. With REDIS_URL set they are shared by every worker, under a key
+# prefix of their own, and nothing caps their size: every entry (but the blacklist version,
+# see blacklist.py) expires after the TIMEOUT of its alias, so the listings of older mailbox
+# versions are kept until then.
+
+MAILBOX_CACHE_TIMEOUT = 300
+
+# Seconds a change to a user takes to reach the other processes without REDIS_URL
+USER_CACHE_TIMEOUT = config("USER_CACHE_TIMEOUT", default=60, cast=int)
+
+# Seconds between the syncs of the blacklist filter of every process with the database, the
+# longest a logout or refresh takes to reach the other processes without REDIS_URL
+TOKEN_BLACKLIST_SYNC_INTERVAL = config("TOKEN_BLACKLIST_SYNC_INTERVAL", default=5, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'mailbox': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'mailbox',
+        'TIMEOUT': MAILBOX_CACHE_TIMEOUT,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 10,
+        }
+    },
+    'users': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'users',
+        'TIMEOUT': USER_CACHE_TIMEOUT,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 10,
+        }
+    }
+}
+
+REDIS_URL = config("REDIS_URL", default="")
+
+if REDIS_URL:
+
+    CACHES['mailbox'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'TIMEOUT': MAILBOX_CACHE_TIMEOUT,
+        'KEY_PREFIX': 'mailbox',
+    }
+    CACHES['users'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'TIMEOUT': USER_CACHE_TIMEOUT,
+        'KEY_PREFIX': 'users',
+    }
+
+
+# Push notifications (Server-Sent Events at PUSH_PATH under ASGI). The broker fans the events
+# out to the connected clients: the in process broker only reaches the clients connected to
+# the process that made the change, with REDIS_URL set the events go through Redis pub/sub
+# and reach every worker. Without it, the events of the background jobs are relayed through
+# the database and the processes holding streams poll for them.
+
+PUSH_PATH = "/v1/api/events"
+PUSH_BROKER = config(
+    "PUSH_BROKER",
+    default="dre_mail_api.notifications.RedisBroker" if REDIS_URL
+    else "dre_mail_api.notifications.InProcessBroker"
+)
+
+# Seconds between the keep alive comments sent on idle streams
+PUSH_HEARTBEAT = config("PUSH_HEARTBEAT", default=15, cast=int)
+
+# Seconds between the polls for the events relayed by the background jobs, without REDIS_URL
+PUSH_RELAY_INTERVAL = config("PUSH_RELAY_INTERVAL", default=1, cast=float)
+
+
+# Background jobs, run by `python manage.py run_jobs`. The most jobs of each queue running at
+# once across every worker, the queues not listed are only limited by the worker threads.
+
+JOB_CONCURRENCY = {
+    "media": config("JOB_MEDIA_CONCURRENCY", default=2, cast=int),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -181,6 +269,21 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+
+# Media files (attachments and avatars)
+# They are only served by the authorized download endpoints. Set DOWNLOAD_OFFLOAD to
+# "x-accel-redirect" (nginx, with an internal location at DOWNLOAD_ACCEL_PREFIX aliased to
+# MEDIA_ROOT) or "x-sendfile" (Apache, lighttpd) to let the front proxy send the files.
+
+MEDIA_ROOT = config("MEDIA_ROOT", default=str(BASE_DIR))
+MEDIA_URL = 'media/'
+
+# The largest attachment a resumable upload accepts, in bytes
+MAX_UPLOAD_SIZE = config("MAX_UPLOAD_SIZE", default=100 * 1024 * 1024, cast=int)
+
+DOWNLOAD_OFFLOAD = config("DOWNLOAD_OFFLOAD", default="")
+DOWNLOAD_ACCEL_PREFIX = config("DOWNLOAD_ACCEL_PREFIX", default="/protected-media/")
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -18,18 +18,14 @@ from django.urls import path, include, re_path
 from dre_mail_api import urls as api_urls
 from django.views.static import serve
 from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls')),
     path('v1/api/', include((api_urls, 'dre_mail_api'), namespace="v1.0")), 
-    re_path(r'^media/(?P<path>.*)$', serve,
-            {'document_root': settings.MEDIA_ROOT}),
     re_path(r'^static/(?P<path>.*)$', serve,
             {'document_root': settings.STATIC_ROOT}),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL,
-                          document_root=settings.MEDIA_ROOT)
+# Media files are not served publicly: attachments and avatars are downloaded through
+# the authorized endpoints of the API
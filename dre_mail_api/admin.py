@@ -7,10 +7,12 @@ admin.site.register(CustomUser)
 admin.site.register(EmailGroup)
 admin.site.register(Email)
 admin.site.register(EmailTransfer)
-admin.site.register(Favorites)
-admin.site.register(Junk)
-admin.site.register(Trash)
-admin.site.register(Spam)
+admin.site.register(MailboxEntry)
+admin.site.register(MailboxCounter)
+admin.site.register(MailboxChange)
+admin.site.register(Upload)
+admin.site.register(Blob)
+admin.site.register(Job)
 admin.site.register(Drafts)
 
 
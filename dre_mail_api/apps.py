@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DreMailApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dre_mail_api'
+
+    def ready(self):
+        from . import signals, tasks
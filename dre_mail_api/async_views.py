@@ -0,0 +1,350 @@
+from collections import OrderedDict
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib import auth
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http.response import HttpResponseBase
+from rest_framework import status
+from rest_framework.exceptions import (
+    APIException, AuthenticationFailed, MethodNotAllowed, NotAuthenticated, NotFound, Throttled
+)
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework.views import exception_handler
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .authentication import aload_user
+from .caching import get_cache, is_not_modified, listing_key, make_etag, record
+from .models import *
+from .pagination import MailboxCursorPagination
+from .principal import get_principal
+from .serializers import EmailActionSerializer, InboxSerializer, SentEmailSerializer, UserSerializer
+from . import counters
+
+
+# Async versions of the read heavy endpoints: the mailbox listings, user lookup and
+# group members. They are plain Django async views rather than DRF views (DRF has no async
+# views), so under ASGI a request waits on the database without holding a worker thread,
+# and one process can keep thousands of slow clients connected. They authenticate,
+# throttle, version and report errors like the DRF views, and render the same JSON.
+
+MEDIA_TYPE = "application/json"
+
+
+"""--------------- REQUEST HANDLING ---------------"""
+
+async def authenticate(request):
+    """
+    The user of the request, from its JWT access token or else its session
+
+    :param request: The Django request
+    :return: The active user, or None for an anonymous request.
+    """
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+
+    if header is not None:
+        rawToken = authentication.get_raw_token(header)
+
+        if rawToken is None:
+            return None
+
+        user, _ = await authenticate_token(rawToken)
+        return user
+
+    user = await sync_to_async(auth.get_user)(request)
+
+    return user if user.is_authenticated else None
+
+
+async def authenticate_token(rawToken):
+    """
+    The user of a JWT access token
+
+    :param rawToken: The encoded token
+    :return: The active user and the validated token.
+    """
+    # Validating the token is pure computation, and the user is read through the user cache
+    token = JWTAuthentication().get_validated_token(rawToken)
+
+    try:
+        userID = token[jwt_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken("Token contained no recognizable user identification")
+
+    user = await aload_user(userID)
+
+    if user is None or not user.is_active:
+        raise NotAuthenticated("User not found or inactive")
+
+    return user, token
+
+
+async def check_throttles(request):
+    """
+    It raises Throttled when one of the default throttles refuses the request
+    """
+    for throttleClass in api_settings.DEFAULT_THROTTLE_CLASSES:
+        throttle = throttleClass()
+
+        if not await sync_to_async(throttle.allow_request)(request, None):
+            raise Throttled(throttle.wait())
+
+
+def render(data, status=status.HTTP_200_OK, headers=None):
+    """
+    A response holding the data rendered as the DRF views render it
+    """
+    response = HttpResponse(JSONRenderer().render(data), status=status, content_type=MEDIA_TYPE)
+
+    for header, value in (headers or {}).items():
+        response[header] = value
+
+    return response
+
+
+def async_api_view(view):
+    """
+    Handle a GET request to an async read view the way the DRF views handle theirs. The
+    view gets a DRF request and returns a response or the data to render.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        apiRequest = Request(request, parsers=[])
+
+        # The urls in the responses point at the DRF endpoints of the default version
+        apiRequest.versioning_scheme = api_settings.DEFAULT_VERSIONING_CLASS()
+        apiRequest.version = api_settings.DEFAULT_VERSION
+        apiRequest.accepted_media_type = MEDIA_TYPE
+
+        try:
+            if request.method != "GET":
+                raise MethodNotAllowed(request.method)
+
+            user = await authenticate(request)
+
+            if user is None:
+                raise NotAuthenticated()
+
+            apiRequest.user = user
+            await check_throttles(apiRequest)
+
+            response = await view(apiRequest, *args, **kwargs)
+
+        except (APIException, TokenError) as e:
+            if isinstance(e, TokenError):
+                e = InvalidToken(e.args[0])
+
+            handled = exception_handler(e, {"request": apiRequest, "view": None})
+            response = render(handled.data, handled.status_code, {
+                header: value for header, value in handled.items() if header.lower() != "content-type"
+            })
+
+            if isinstance(e, (NotAuthenticated, AuthenticationFailed)):
+                response["WWW-Authenticate"] = JWTAuthentication().authenticate_header(apiRequest)
+
+            return response
+
+        if not isinstance(response, HttpResponseBase):
+            response = render(response)
+
+        return response
+
+    return wrapper
+
+
+def async_cached_listing(view):
+    """
+    The `cached_listing` of the async views: the listing data is served from the cache for
+    as long as the mailbox of the user does not change, and an unchanged mailbox gets a 304
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = get_principal(request).user
+        version = await counters.amailbox_version(user.id)
+        etag = make_etag(request, user.id, user.date_joined.timestamp(), version)
+
+        if is_not_modified(request, etag):
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        key = listing_key(request, version)
+        data = await get_cache().aget(key)
+
+        if data is not None:
+            await sync_to_async(record)("hit")
+            return render(data, headers={"ETag": etag})
+
+        await sync_to_async(record)("miss")
+        data = await view(request, *args, **kwargs)
+
+        await get_cache().aset(key, data)
+
+        return render(data, headers={"ETag": etag})
+
+    return wrapper
+
+
+def filter_read_status(queryset, request, lookup):
+    """
+    Keep the read or unread emails when the `hasRead` query parameter asks for them
+    """
+    read = request.query_params.get("hasRead")
+
+    if read == "true":
+        return queryset.filter(**{lookup: request.user.id})
+    elif read is not None:
+        return queryset.exclude(**{lookup: request.user.id})
+
+    return queryset
+
+
+"""--------------- MAILBOX LISTINGS ---------------"""
+
+async def list_entries(request, entries, serializerClass, transfers=False):
+    """
+    A page of mailbox entries, serialized from objects loaded by the async ORM
+
+    :param request: The DRF request
+    :param entries: The mailbox entries of the listing
+    :param serializerClass: The serializer rendering the page
+    :param transfers: Whether the email transfers of the entries are rendered rather than the entries
+    :return: The data of the page.
+    """
+    entries = EmailActionSerializer.setup_eager_loading(entries, request.user)
+
+    paginator = MailboxCursorPagination()
+    page = await paginator.apaginate_queryset(entries, request)
+
+    if transfers:
+        page = [entry.emailTransfer for entry in page]
+
+    serializer = serializerClass(page, many=True, context={"request": request})
+
+    return paginator.get_paginated_data(serializer.data)
+
+
+@async_api_view
+@async_cached_listing
+async def inbox(request):
+    entries = filter_read_status(
+        MailboxEntry.objects.in_folder(request.user, MailboxEntry.INBOX), request, "emailTransfer__hasRead__id"
+    )
+
+    return await list_entries(request, entries, InboxSerializer, transfers=True)
+
+
+@async_api_view
+@async_cached_listing
+async def sent_emails(request):
+    sentEmails = filter_read_status(
+        EmailTransfer.objects.visible_to(request.user), request, "hasRead__id"
+    ).filter(sender=request.user)
+
+    sentEmails = SentEmailSerializer.setup_eager_loading(sentEmails, request.user)
+
+    paginator = MailboxCursorPagination()
+    page = await paginator.apaginate_queryset(sentEmails, request)
+
+    return paginator.get_paginated_data(SentEmailSerializer(page, many=True, context={"request": request}).data)
+
+
+def folder_listing(folder):
+    """
+    The async listing of a folder of the mailbox
+    """
+    @async_api_view
+    @async_cached_listing
+    async def listing(request):
+        return await list_entries(
+            request, MailboxEntry.objects.in_folder(request.user, folder), EmailActionSerializer
+        )
+
+    return listing
+
+
+trash = folder_listing(MailboxEntry.TRASH)
+spam = folder_listing(MailboxEntry.SPAM)
+junk = folder_listing(MailboxEntry.JUNK)
+
+
+@async_api_view
+@async_cached_listing
+async def favorites(request):
+    return await list_entries(
+        request, MailboxEntry.objects.flagged(request.user, MailboxEntry.FAVORITE), EmailActionSerializer
+    )
+
+
+"""--------------- USERS AND GROUPS ---------------"""
+
+@async_api_view
+async def user_detail(request, pk):
+
+    # The ETag comes from the last modification of the user, read without loading them
+    updatedAt = await CustomUser.objects.filter(pk=pk).values_list("updated_at", flat=True).afirst()
+
+    if updatedAt is None:
+        raise NotFound()
+
+    etag = make_etag(request, pk, updatedAt.isoformat())
+
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    user = await CustomUser.objects.aget(pk=pk)
+
+    return render(UserSerializer(user, context={"request": request}).data, headers={"ETag": etag})
+
+
+@async_api_view
+async def group_members(request, pk):
+
+    # The groups the user created or is a member of
+    isVisible = await EmailGroup.objects.filter(
+        Q(creator_id=request.user.id) | Q(members__id=request.user.id), pk=pk
+    ).aexists()
+
+    if not isVisible:
+        raise NotFound()
+
+    members = CustomUser.objects.filter(members__id=pk).order_by("id")
+
+    # Paged by number like the DRF members endpoint
+    pageSize = PageNumberPagination().get_page_size(request)
+    count = await members.acount()
+
+    try:
+        number = int(request.query_params.get("page", 1))
+    except ValueError:
+        raise NotFound("Invalid page.")
+
+    if number < 1 or (number > 1 and (number - 1) * pageSize >= count):
+        raise NotFound("Invalid page.")
+
+    page = [user async for user in members[(number - 1) * pageSize:number * pageSize]]
+    url = request.build_absolute_uri()
+
+    if number == 1:
+        previous = None
+    elif number == 2:
+        previous = remove_query_param(url, "page")
+    else:
+        previous = replace_query_param(url, "page", number - 1)
+
+    return OrderedDict([
+        ("count", count),
+        ("next", replace_query_param(url, "page", number + 1) if number * pageSize < count else None),
+        ("previous", previous),
+        ("results", UserSerializer(page, many=True, context={"request": request}).data),
+    ])
@@ -0,0 +1,103 @@
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .models import CustomUser
+
+
+# JWT authentication without a database query per request. The signed access token already
+# names the user, so the user is built from a short lived cache of their row instead of
+# being loaded from the database every time. Saving or deleting a user drops their entry,
+# and the other processes see the change once it expires (USER_CACHE_TIMEOUT).
+
+CACHE_ALIAS = "users"
+
+# The fields of the user that are cached, the password hash is left out and loaded from
+# the database on the rare occasion it is used
+FIELDS = [field.attname for field in CustomUser._meta.concrete_fields if field.attname != "password"]
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def user_key(userID):
+    return f"user:{userID}"
+
+
+def build_user(values):
+    """
+    A user instance made from the cached fields, as if it had been loaded from the database
+    """
+    return CustomUser.from_db(DEFAULT_DB_ALIAS, FIELDS, [values[field] for field in FIELDS])
+
+
+def load_user(userID):
+    """
+    The user with this id, from the cache or else the database
+
+    :param userID: The id of the user
+    :return: The user, or None when there is no such user.
+    """
+    values = get_cache().get(user_key(userID))
+
+    if values is None:
+        values = CustomUser.objects.filter(pk=userID).values(*FIELDS).first()
+
+        if values is None:
+            return None
+
+        get_cache().set(user_key(userID), values)
+
+    return build_user(values)
+
+
+async def aload_user(userID):
+    """
+    The `load_user` of the async views
+    """
+    values = await get_cache().aget(user_key(userID))
+
+    if values is None:
+        values = await CustomUser.objects.filter(pk=userID).values(*FIELDS).afirst()
+
+        if values is None:
+            return None
+
+        await get_cache().aset(user_key(userID), values)
+
+    return build_user(values)
+
+
+def forget_user(userID):
+    """
+    It drops the cached user, now and once the current transaction commits, so that a
+    request reading the user before the commit does not cache the old row again
+    """
+    get_cache().delete(user_key(userID))
+    transaction.on_commit(lambda: get_cache().delete(user_key(userID)))
+
+
+class CachedUserJWTAuthentication(JWTAuthentication):
+    """
+    The JWT authentication of SimpleJWT, with the user read through the user cache
+    """
+
+    def get_user(self, validated_token):
+        try:
+            userID = validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = load_user(userID)
+
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return user
@@ -0,0 +1,132 @@
+import uuid
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .models import CustomUser
+from . import jobs
+
+
+# Resized variants of the avatars. Listings nest every sender and recipient, so clients
+# draw small avatars from these instead of downloading the full image. A variant is named
+# after a token renewed with every upload: a new avatar gets new urls, even when it is
+# stored under the name of the one it replaces, so a variant never changes and clients can
+# cache it for good.
+
+SIZES = (32, 64, 256)
+
+# The extension of the variants and the format Pillow saves them in
+FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+VARIANT_DIRECTORY = "userImages/variants"
+
+
+def new_token():
+    return uuid.uuid4().hex[:16]
+
+
+def avatar_token(user):
+    """
+    The token of the current avatar of the user, it changes whenever the avatar does
+    """
+    return user.avi_token
+
+
+def variant_name(user, size, extension):
+    return f"{VARIANT_DIRECTORY}/{user.pk}/{avatar_token(user)}/{size}.{extension}"
+
+
+def variant_file(user, size, extension):
+    """
+    The variant as a FieldFile, so that it is served like the avatar itself
+    """
+    field = CustomUser._meta.get_field("avi")
+
+    return field.attr_class(user, field, variant_name(user, size, extension))
+
+
+def has_variants(user):
+    return all(
+        default_storage.exists(variant_name(user, size, extension)) for size in SIZES for extension in FORMATS
+    )
+
+
+def create_variants(user):
+    """
+    It resizes the avatar of the user into every size and format
+
+    :param user: The user, with an avatar
+    """
+    with user.avi.open("rb") as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image.load()
+
+    hasAlpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if hasAlpha else "RGB")
+
+    for size in SIZES:
+        resized = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+
+        for extension, (imageFormat, options) in FORMATS.items():
+
+            # JPEG has no transparency, so the avatar is laid on white
+            if imageFormat == "JPEG" and hasAlpha:
+                flattened = Image.new("RGB", resized.size, "white")
+                flattened.paste(resized, mask=resized.getchannel("A"))
+                variant = flattened
+            else:
+                variant = resized
+
+            buffer = BytesIO()
+            variant.save(buffer, imageFormat, **options)
+
+            name = variant_name(user, size, extension)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def enqueue_variants(user):
+    """
+    It queues the resizing of the avatar of the user for the workers, until it runs the
+    variants are made on their first download
+    """
+    token = avatar_token(user)
+    jobs.enqueue("create_avatar_variants", key=f"avatar-variants:{user.pk}:{token}", userID=user.pk, token=token)
+
+
+def delete_variants(user):
+    """
+    It deletes the variants of the current avatar of the user, before it is replaced
+    """
+    if not user.avi:
+        return
+
+    for size in SIZES:
+        for extension in FORMATS:
+            default_storage.delete(variant_name(user, size, extension))
+
+
+def variant_urls(user, aviURL):
+    """
+    The urls of the variants of the avatar of a user
+
+    :param user: The user
+    :param aviURL: The url of the download endpoint of the avatar, the variants are below it
+    :return: The url of every format by size, or None when the user has no avatar.
+    """
+    if not user.avi:
+        return None
+
+    token = avatar_token(user)
+
+    return {
+        str(size): {extension: f"{aviURL}/{token}/{size}.{extension}" for extension in FORMATS}
+        for size in SIZES
+    }
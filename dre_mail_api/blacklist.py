@@ -0,0 +1,217 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.timezone import now
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+# The refresh token blacklist. Every refresh (the tokens are rotated) and every logout adds
+# a token to it, so checking a token against it is a query on a table that keeps growing.
+# Each process keeps a Bloom filter of the blacklisted token ids instead: a token that is
+# not in the filter is not blacklisted, and only the few that are (or are false positives)
+# are looked up. The expired tokens are pruned in batches (see `prune`).
+#
+# A shared version number, kept in the users cache, goes up whenever a token is blacklisted,
+# and a process that sees it change adds the tokens blacklisted since its last sync to its
+# filter. Every process also adds them every TOKEN_BLACKLIST_SYNC_INTERVAL seconds whatever
+# the version: without REDIS_URL each process has a version of its own, so a token
+# blacklisted by another process is seen within that interval, and so is one whose version
+# was evicted from the cache.
+
+CACHE_ALIAS = "users"
+VERSION_KEY = "token-blacklist:version"
+
+# The filter is made for this many tokens at first, and remade twice as big when it fills up
+INITIAL_CAPACITY = 10000
+ERROR_RATE = 0.01
+
+# How far back a sync looks before the previous one, for the tokens blacklisted in
+# transactions that committed after it
+SYNC_OVERLAP = timedelta(minutes=1)
+
+PRUNE_BATCH_SIZE = 1000
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+class BloomFilter:
+    """
+    A set of strings that can answer "maybe" for a string it does not hold, with the given
+    probability once it holds `capacity` strings, but never "no" for one it holds
+    """
+
+    def __init__(self, capacity, errorRate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+
+        # The positions come from two halves of a single hash (double hashing)
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        if value in self:
+            return
+
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+class BlacklistFilter:
+    """
+    The Bloom filter of the blacklisted tokens of this process, kept up to date with the
+    shared version
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.version = None
+        self.syncedAt = None
+        self.checkedAt = None
+
+    def sync(self):
+        """
+        It adds the tokens blacklisted since the last sync when the version has changed or
+        the sync interval has passed, or remakes the filter from the tokens that have not
+        expired when it is full
+        """
+        cache = get_cache()
+        version = cache.get(VERSION_KEY)
+
+        # The version is read before the tokens, so that tokens blacklisted meanwhile are
+        # added at the next sync
+        if version is None:
+            cache.add(VERSION_KEY, 0, timeout=None)
+            version = cache.get(VERSION_KEY)
+
+        if (
+            self.bloom is not None and version == self.version and self.bloom.count <= self.bloom.capacity
+            and time.monotonic() - self.checkedAt < settings.TOKEN_BLACKLIST_SYNC_INTERVAL
+        ):
+            return
+
+        with self.lock:
+            checkedAt, syncedAt = time.monotonic(), now()
+
+            if self.bloom is None or self.bloom.count > self.bloom.capacity:
+                jtis = list(
+                    BlacklistedToken.objects.filter(token__expires_at__gt=syncedAt).values_list("token__jti", flat=True)
+                )
+                bloom = BloomFilter(max(INITIAL_CAPACITY, 2 * len(jtis)))
+            else:
+                bloom = self.bloom
+                jtis = BlacklistedToken.objects.filter(
+                    blacklisted_at__gte=self.syncedAt - SYNC_OVERLAP
+                ).values_list("token__jti", flat=True)
+
+            for jti in jtis:
+                bloom.add(jti)
+
+            self.bloom, self.version, self.syncedAt, self.checkedAt = bloom, version, syncedAt, checkedAt
+
+    def __contains__(self, jti):
+        return jti in self.bloom
+
+
+@lru_cache(maxsize=None)
+def get_filter():
+    """
+    The blacklist filter of this process
+    """
+    return BlacklistFilter()
+
+
+def is_blacklisted(jti):
+    """
+    Whether the token with this id is blacklisted, looked up in the database only when the
+    filter can't rule it out
+    """
+    blacklistFilter = get_filter()
+    blacklistFilter.sync()
+
+    if jti not in blacklistFilter:
+        return False
+
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+def blacklist_changed():
+    """
+    It moves the version on once the current transaction commits, so that the processes
+    add the newly blacklisted tokens to their filters
+    """
+    def increment():
+        try:
+            get_cache().incr(VERSION_KEY)
+        except ValueError:
+
+            # The version was evicted, the processes add the token at their next periodic sync
+            pass
+
+    transaction.on_commit(increment)
+
+
+def prune(batchSize=PRUNE_BATCH_SIZE):
+    """
+    It deletes the outstanding and blacklisted tokens that have expired, a batch at a time
+    so that no transaction holds many rows
+
+    :param batchSize: The number of tokens deleted by each transaction
+    :return: The number of outstanding and blacklisted tokens deleted.
+    """
+    expired = OutstandingToken.objects.filter(expires_at__lt=now()).order_by("id")
+    outstanding = blacklisted = 0
+    lastID = 0
+
+    while True:
+        batch = list(expired.filter(id__gt=lastID).values_list("id", flat=True)[:batchSize])
+
+        if not batch:
+            return outstanding, blacklisted
+
+        with transaction.atomic():
+            blacklisted += BlacklistedToken.objects.filter(token_id__in=batch).delete()[0]
+            outstanding += OutstandingToken.objects.filter(id__in=batch).delete()[0]
+
+        lastID = batch[-1]
+
+
+class FilteredRefreshToken(RefreshToken):
+    """
+    A refresh token checked against the blacklist filter
+    """
+
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[jwt_settings.JTI_CLAIM]):
+            raise TokenError(_("Token is blacklisted"))
+
+
+class FilteredTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = FilteredRefreshToken
@@ -0,0 +1,258 @@
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+from .models import Blob, Email, Upload
+
+
+# Content addressed attachment storage. A file is hashed while it is streamed to a
+# temporary file and then moved to the path of its SHA-256 hash, or dropped when a blob
+# with that hash is already stored. Emails and uploads point at their blob and keep its
+# reference count; blobs nobody refers to any more are removed by `collect`.
+
+BLOB_DIRECTORY = "blobs"
+BLOCK_SIZE = 64 * 1024
+
+# How long an unreferenced blob is kept, so that a file stored for an email that is
+# still being saved is not collected from under it
+GRACE_PERIOD = timedelta(hours=24)
+
+COLLECT_BATCH_SIZE = 1000
+
+
+def blob_name(sha256):
+    """
+    The storage name of the blob with this hash, spread over 256 directories
+    """
+    return f"{BLOB_DIRECTORY}/{sha256[:2]}/{sha256}"
+
+
+def hash_file(path):
+    """
+    It hashes a file on disk
+
+    :return: The SHA-256 hash of the file and its size.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            digest.update(block)
+            size += len(block)
+
+    return digest.hexdigest(), size
+
+
+def store(file):
+    """
+    It stores an uploaded file in the blob of its content, hashing it as it is written
+
+    :param file: The uploaded file
+    :return: The blob.
+    """
+    directory = default_storage.path(BLOB_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".", delete=False) as temporary:
+        for chunk in file.chunks(BLOCK_SIZE):
+            digest.update(chunk)
+            temporary.write(chunk)
+            size += len(chunk)
+
+    return store_path(temporary.name, digest.hexdigest(), size)
+
+
+def store_path(path, sha256, size, model=Blob, keep=False):
+    """
+    It moves a file that is already on disk to the blob of its content, or deletes it
+    when the blob is already stored
+
+    :param path: The path of the file, it is moved or deleted
+    :param sha256: The hash of the file
+    :param size: The size of the file
+    :param model: The blob model (the historical one when called from a migration)
+    :param keep: Whether to link the file to the blob and leave it in place, for a caller
+    whose transaction may still roll back
+    :return: The blob.
+    """
+    target = default_storage.path(blob_name(sha256))
+
+    # The row lock keeps the collector from removing the blob while it is reused
+    with transaction.atomic():
+        blob, created = model.objects.select_for_update().get_or_create(sha256=sha256, defaults={"size": size})
+
+        if created or not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            if not keep:
+                os.replace(path, target)
+            elif not os.path.exists(target):
+                os.link(path, target)
+        else:
+            if not keep:
+                os.remove(path)
+
+            # Restart the grace period of a blob that may be unreferenced
+            model.objects.filter(sha256=sha256).update(updated_at=now())
+
+    return blob
+
+
+"""--------------- REFERENCES ---------------"""
+
+def move_reference(old, new):
+    """
+    It moves a reference from one blob to another, either may be None
+
+    :param old: The hash of the blob that was referred to
+    :param new: The hash of the blob that is referred to now
+    """
+    if old == new:
+        return
+
+    if new is not None:
+        Blob.objects.filter(sha256=new).update(refcount=F("refcount") + 1, updated_at=now())
+
+    if old is not None:
+        Blob.objects.filter(sha256=old).update(refcount=F("refcount") - 1, updated_at=now())
+
+
+def _references(model):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(blob=OuterRef("pk")).order_by().values("blob")
+            .annotate(count=Count("pk")).values("count")
+        ),
+        Value(0)
+    )
+
+
+def recount(emailModel=Email, uploadModel=Upload, blobModel=Blob):
+    """
+    It recomputes the reference count of every blob from the emails and uploads
+
+    :return: The number of blobs whose count was wrong.
+    """
+    blobs = blobModel.objects.annotate(
+        actual=_references(emailModel) + _references(uploadModel)
+    ).exclude(refcount=F("actual"))
+
+    fixed = 0
+    for sha256, actual in blobs.values_list("sha256", "actual").iterator():
+        blobModel.objects.filter(sha256=sha256).update(refcount=actual)
+        fixed += 1
+
+    return fixed
+
+
+"""--------------- COLLECTION ---------------"""
+
+def collect(gracePeriod=GRACE_PERIOD, dryRun=False):
+    """
+    It removes the blobs nobody has referred to for the grace period, and their files
+
+    :param gracePeriod: How long a blob must have been unreferenced
+    :param dryRun: Only list the blobs that would be removed
+    :return: The hashes of the removed blobs.
+    """
+    cutoff = now() - gracePeriod
+    garbage = Blob.objects.filter(refcount__lte=0, updated_at__lt=cutoff).exclude(
+        Exists(Email.objects.filter(blob=OuterRef("pk")))
+    ).exclude(
+        Exists(Upload.objects.filter(blob=OuterRef("pk")))
+    )
+
+    candidates = list(garbage.values_list("sha256", flat=True))
+    if dryRun:
+        return candidates
+
+    removed = []
+
+    for start in range(0, len(candidates), COLLECT_BATCH_SIZE):
+        with transaction.atomic():
+
+            # Check again under the row locks, a blob may have been reused meanwhile
+            batch = list(
+                garbage.filter(sha256__in=candidates[start:start + COLLECT_BATCH_SIZE])
+                .select_for_update().values_list("sha256", flat=True)
+            )
+
+            for sha256 in batch:
+                try:
+                    os.remove(default_storage.path(blob_name(sha256)))
+                except FileNotFoundError:
+                    pass
+
+            Blob.objects.filter(sha256__in=batch).delete()
+
+        removed.extend(batch)
+
+    return removed
+
+
+"""--------------- DEDUPLICATION ---------------"""
+
+def deduplicate(emailModel=Email, uploadModel=Upload, blobModel=Blob):
+    """
+    It moves the attachment files written before content addressed storage into blobs,
+    removing the copies of the same content, and points the emails and uploads at them
+
+    :return: The number of files moved into blobs, of the files that were duplicates
+    and of the files that are missing.
+    """
+    hashes = {}
+    stored = duplicates = missing = 0
+
+    def blob_of(name):
+        nonlocal stored, duplicates, missing
+
+        if name not in hashes:
+            path = default_storage.path(name)
+
+            if not os.path.exists(path):
+                missing += 1
+                hashes[name] = None
+                return None
+
+            sha256, size = hash_file(path)
+            created = not blobModel.objects.filter(sha256=sha256).exists()
+            store_path(path, sha256, size, model=blobModel)
+
+            stored += created
+            duplicates += not created
+            hashes[name] = sha256
+
+        return hashes[name]
+
+    emails = emailModel.objects.filter(blob__isnull=True).exclude(attachment="").exclude(attachment__isnull=True)
+
+    for emailID, name in emails.values_list("id", "attachment").iterator():
+        sha256 = blob_of(name)
+
+        if sha256 is not None:
+            emailModel.objects.filter(id=emailID).update(
+                blob_id=sha256, attachment=blob_name(sha256), attachmentName=os.path.basename(name)
+            )
+
+    uploads = uploadModel.objects.filter(blob__isnull=True).exclude(file="").exclude(file__isnull=True)
+
+    for uploadID, name in uploads.values_list("id", "file").iterator():
+        sha256 = blob_of(name)
+
+        if sha256 is not None:
+            uploadModel.objects.filter(id=uploadID).update(blob_id=sha256, file=blob_name(sha256))
+
+    recount(emailModel, uploadModel, blobModel)
+
+    return stored, duplicates, missing
@@ -0,0 +1,142 @@
+import hashlib
+from functools import wraps
+
+from django.core.cache import caches
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import counters
+from .principal import get_principal
+
+
+# Response cache for the mailbox listings. Every key carries the mailbox version of the
+# user, which the mailbox operations move on in the same transaction as any change to
+# the mailbox (delivery, read status, folder move, delete). The listings also show the
+# profiles of the senders and recipients, so a change to a profile moves on the versions of
+# the users whose listings show it (counters.touch_participants, from a background job). A
+# changed mailbox is therefore never served from the cache and no key ever has to be
+# deleted: the listings of older versions are evicted by the bounded LRU cache or expire.
+#
+# The same versions give the responses strong ETags, so a client polling an unchanged
+# listing gets a 304 Not Modified after a single version lookup.
+
+CACHE_ALIAS = "mailbox"
+STATS_KEY = "mailbox-cache:{}"
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def listing_key(request, version):
+    """
+    The cache key of a listing request for the given mailbox version
+
+    :param request: The request for the listing, its url includes the page and filters
+    :param version: The mailbox version of the user
+    :return: The cache key.
+    """
+    user = get_principal(request).user
+    url = hashlib.sha256(request.build_absolute_uri().encode()).hexdigest()
+
+    # The join date tells apart accounts that reused the id of a deleted user
+    return f"mailbox:{user.id}:{user.date_joined.timestamp()}:{version}:{url}"
+
+
+def make_etag(request, *versions):
+    """
+    A strong ETag for the representation of the requested resource at the given versions,
+    computed without rendering the response
+
+    :param request: The request, its url and negotiated media type identify the representation
+    :param versions: The values that change whenever the resource changes
+    :return: The quoted ETag.
+    """
+    parts = [request.build_absolute_uri(), request.accepted_media_type, *versions]
+    return quote_etag(hashlib.sha256(":".join(str(part) for part in parts).encode()).hexdigest()[:32])
+
+
+def is_not_modified(request, etag):
+    """
+    Whether the If-None-Match header of the request matches the ETag
+    """
+    ifNoneMatch = request.META.get("HTTP_IF_NONE_MATCH")
+
+    if not ifNoneMatch:
+        return False
+
+    etags = parse_etags(ifNoneMatch)
+    return "*" in etags or etag in etags
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
+def record(event):
+    """
+    Count a cache hit or miss, in the cache itself so that every worker shares the counts
+    """
+    cache = get_cache()
+    key = STATS_KEY.format(event)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cache_stats():
+    """
+    The hits and misses of the listing cache
+
+    :return: A dict of the hits, misses and hit ratio.
+    """
+    counts = get_cache().get_many([STATS_KEY.format("hit"), STATS_KEY.format("miss")])
+    hits = counts.get(STATS_KEY.format("hit"), 0)
+    misses = counts.get(STATS_KEY.format("miss"), 0)
+
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+    }
+
+
+def cached_listing(view):
+    """
+    Serve the GET requests of a mailbox listing action from the cache for as long as the
+    mailbox of the user does not change, and answer conditional requests for an unchanged
+    mailbox with 304 Not Modified
+    """
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+
+        if request.method != "GET":
+            return view(self, request, *args, **kwargs)
+
+        user = get_principal(request).user
+        version = counters.mailbox_version(user.id)
+        etag = make_etag(request, user.id, user.date_joined.timestamp(), version)
+
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+
+        key = listing_key(request, version)
+        data = get_cache().get(key)
+
+        if data is not None:
+            record("hit")
+            return Response(data, headers={"ETag": etag})
+
+        record("miss")
+        response = view(self, request, *args, **kwargs)
+
+        if response.status_code == 200:
+            get_cache().set(key, response.data)
+            response["ETag"] = etag
+
+        return response
+
+    return wrapper
@@ -0,0 +1,197 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Count, Exists, F, OuterRef, Q
+
+from .models import CustomUser, EmailTransfer, MailboxCounter, MailboxEntry
+
+
+# The badge counts of every user are kept in MailboxCounter. The mailbox operations
+# work out how the counts of each user change and apply the differences in the same
+# transaction, so reading them is a single primary key lookup.
+
+FIELDS = ["unread_inbox", "trash", "spam", "junk", "favorites"]
+
+# The number of users whose counters are changed by a single UPDATE
+UPDATE_BATCH_SIZE = 5000
+
+# The folders that are counted as a whole
+FOLDER_FIELDS = {
+    MailboxEntry.TRASH: "trash",
+    MailboxEntry.SPAM: "spam",
+    MailboxEntry.JUNK: "junk",
+}
+
+
+def entry_counts(folder, flags, read):
+    """
+    The counts a single mailbox entry contributes to
+
+    :param folder: The folder of the entry, None when the entry does not exist
+    :param flags: The flags of the entry
+    :param read: Whether the user has read the email
+    :return: A Counter of the counter fields.
+    """
+    counts = Counter()
+
+    if folder is None or folder == MailboxEntry.DELETED:
+        return counts
+
+    if folder == MailboxEntry.INBOX and not read:
+        counts["unread_inbox"] += 1
+
+    if folder in FOLDER_FIELDS:
+        counts[FOLDER_FIELDS[folder]] += 1
+
+    if flags & MailboxEntry.FAVORITE:
+        counts["favorites"] += 1
+
+    return counts
+
+
+def apply_deltas(deltas):
+    """
+    It adds the differences to the counters of the users and moves their mailbox version
+    on, with one UPDATE for every distinct difference (a group delivery changes every
+    member the same way)
+
+    :param deltas: A dict of user id to a Counter of the counter fields. Users whose
+        mailbox changed without changing the counts are given an empty Counter.
+    """
+    usersByDelta = defaultdict(list)
+
+    for userID, delta in deltas.items():
+        delta = tuple(sorted((field, n) for field, n in delta.items() if n))
+        usersByDelta[delta].append(userID)
+
+    for delta, userIDs in usersByDelta.items():
+        for start in range(0, len(userIDs), UPDATE_BATCH_SIZE):
+            MailboxCounter.objects.filter(user_id__in=userIDs[start:start + UPDATE_BATCH_SIZE]).update(
+                version=F("version") + 1,
+                **{field: F(field) + n for field, n in delta}
+            )
+
+
+def touch_participants(userID):
+    """
+    It moves on the mailbox versions of the users whose listings show this user: their
+    own, those of everyone with one of their emails in a mailbox, and those of the senders
+    of the emails they received. Their cached listings and ETags then change with the
+    profile they embed.
+
+    :param userID: The id of the user whose profile changed
+    """
+    transfers = EmailTransfer.objects.filter(Q(sender_id=userID) | Q(recipient_id=userID))
+    viewers = MailboxEntry.objects.filter(emailTransfer__in=transfers).values("user_id")
+    senders = EmailTransfer.objects.filter(recipient_id=userID).values("sender_id")
+
+    MailboxCounter.objects.filter(
+        Q(user_id=userID) | Q(user_id__in=viewers) | Q(user_id__in=senders)
+    ).update(version=F("version") + 1)
+
+
+def mailbox_version(userID):
+    """
+    The current version of the mailbox of the user, read with a single primary key lookup
+    """
+    return MailboxCounter.objects.filter(user_id=userID).values_list("version", flat=True).first() or 0
+
+
+async def amailbox_version(userID):
+    """
+    The `mailbox_version` of the async views
+    """
+    return await MailboxCounter.objects.filter(user_id=userID).values_list("version", flat=True).afirst() or 0
+
+
+def count_mailboxes(entryModel, readModel, userIDs=None):
+    """
+    It counts the mailboxes of the users from scratch
+
+    :param entryModel: The MailboxEntry model (the historical one in migrations)
+    :param readModel: The through model of EmailTransfer.hasRead
+    :param userIDs: The users to count, None for every user
+    :return: A dict of user id to a Counter of the counter fields.
+    """
+    entries = entryModel.objects.all()
+    if userIDs is not None:
+        entries = entries.filter(user_id__in=userIDs)
+
+    counts = defaultdict(Counter)
+
+    folders = entries.filter(folder__in=FOLDER_FIELDS).values("user_id", "folder").annotate(n=Count("id"))
+    for row in folders:
+        counts[row["user_id"]][FOLDER_FIELDS[row["folder"]]] = row["n"]
+
+    unread = entries.filter(folder=MailboxEntry.INBOX).exclude(
+        Exists(readModel.objects.filter(emailtransfer_id=OuterRef("emailTransfer_id"), customuser_id=OuterRef("user_id")))
+    ).values("user_id").annotate(n=Count("id"))
+    for row in unread:
+        counts[row["user_id"]]["unread_inbox"] = row["n"]
+
+    favorites = entries.exclude(folder=MailboxEntry.DELETED).alias(
+        favorite=F("flags").bitand(MailboxEntry.FAVORITE)
+    ).filter(favorite=MailboxEntry.FAVORITE).values("user_id").annotate(n=Count("id"))
+    for row in favorites:
+        counts[row["user_id"]]["favorites"] = row["n"]
+
+    return counts
+
+
+def drift(userIDs=None):
+    """
+    Compare the stored counters with the actual counts
+
+    :return: A dict of user id to a dict of field: (stored, actual) for every wrong counter.
+    """
+    actual = count_mailboxes(MailboxEntry, EmailTransfer.hasRead.through, userIDs)
+
+    users = CustomUser.objects.all() if userIDs is None else CustomUser.objects.filter(id__in=userIDs)
+    stored = {row["user"]: row for row in MailboxCounter.objects.filter(user__in=users).values("user", *FIELDS)}
+
+    drifted = {}
+
+    for userID in users.values_list("id", flat=True):
+        row = stored.get(userID)
+        wrong = {
+            field: (row[field] if row else None, actual[userID][field])
+            for field in FIELDS
+            if row is None or row[field] != actual[userID][field]
+        }
+
+        if wrong:
+            drifted[userID] = wrong
+
+    return drifted
+
+
+def rebuild(userIDs=None):
+    """
+    Overwrite the counters of the users with their actual counts
+    """
+    counts = count_mailboxes(MailboxEntry, EmailTransfer.hasRead.through, userIDs)
+    users = CustomUser.objects.all() if userIDs is None else CustomUser.objects.filter(id__in=userIDs)
+
+    MailboxCounter.objects.bulk_create(
+        [
+            MailboxCounter(user_id=userID, **{field: counts[userID][field] for field in FIELDS})
+            for userID in users.values_list("id", flat=True)
+        ],
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=FIELDS
+    )
+
+
+def read_deltas(userTransferPairs, read):
+    """
+    The counter differences of users reading (or unreading) emails
+
+    :param userTransferPairs: A Q object selecting the (user, emailTransfer) entries
+    :param read: True when the emails became read, False when they became unread
+    :return: A dict of user id to a Counter of the counter fields.
+    """
+    rows = MailboxEntry.objects.filter(
+        userTransferPairs, folder=MailboxEntry.INBOX
+    ).values("user_id").annotate(n=Count("id"))
+
+    return {row["user_id"]: Counter(unread_inbox=-row["n"] if read else row["n"]) for row in rows}
@@ -0,0 +1,193 @@
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.negotiation import BaseContentNegotiation
+
+
+# Downloads of attachments and avatars. The views authorize the request and hand the file
+# over to `serve_file`, which answers conditional and Range requests and streams the bytes
+# (or lets the front proxy send them when DOWNLOAD_OFFLOAD is set).
+
+BLOCK_SIZE = 64 * 1024
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Downloads answer with the file itself whatever the client accepts
+class DownloadContentNegotiation(BaseContentNegotiation):
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range of a Range header
+
+    :param header: The value of the Range header
+    :param size: The size of the file
+    :return: The (first, last) byte positions, None to serve the whole file, or
+        False when the range cannot be satisfied.
+    """
+    match = RANGE_PATTERN.match(header or "")
+
+    # Malformed and multiple ranges are ignored and the whole file is served
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+
+    # A suffix range asks for the last bytes of the file
+    if first == "":
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+
+    if last != "" and int(last) < first:
+        return None
+
+    if first >= size:
+        return False
+
+    return first, size - 1 if last == "" else min(int(last), size - 1)
+
+
+def read_range(file, first, length):
+    """
+    Yield `length` bytes of the file from the position `first`, one block at a time
+    """
+    try:
+        file.seek(first)
+
+        while length > 0:
+            block = file.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+
+            length -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
+def content_disposition(filename, asAttachment):
+    disposition = "attachment" if asAttachment else "inline"
+
+    try:
+        filename.encode("ascii")
+        return '{}; filename="{}"'.format(disposition, filename.replace("\\", "\\\\").replace('"', r"\""))
+    except UnicodeEncodeError:
+        return "{}; filename*=utf-8''{}".format(disposition, quote(filename))
+
+
+def serve_file(request, fieldFile, asAttachment=False, filename=None):
+    """
+    It answers a download of a stored file, honouring If-None-Match, If-Modified-Since,
+    Range and If-Range
+
+    :param request: The request for the file, already authorized
+    :param fieldFile: The FieldFile to send
+    :param asAttachment: Whether the client should save the file rather than display it
+    :param filename: The name to download the file as, the name of the stored file by default
+    :return: The response streaming the file, or the proxy handing it off.
+    """
+    if not fieldFile:
+        raise Http404("There is no file to download.")
+
+    storage, name = fieldFile.storage, fieldFile.name
+
+    try:
+        size = storage.size(name)
+        modified = storage.get_modified_time(name)
+    except (FileNotFoundError, NotImplementedError, OSError):
+        raise Http404("The file does not exist.")
+
+    etag = quote_etag(hashlib.sha256(f"{name}:{size}:{modified.timestamp()}".encode()).hexdigest()[:32])
+    lastModified = http_date(modified.timestamp())
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": lastModified,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+
+    # Conditional requests
+    ifNoneMatch = request.META.get("HTTP_IF_NONE_MATCH")
+    ifModifiedSince = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+
+    if ifNoneMatch:
+        notModified = "*" in parse_etags(ifNoneMatch) or etag in parse_etags(ifNoneMatch)
+    else:
+        notModified = ifModifiedSince is not None and int(modified.timestamp()) <= ifModifiedSince
+
+    if notModified:
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    filename = filename or os.path.basename(name)
+    contentType = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers["Content-Disposition"] = content_disposition(filename, asAttachment)
+
+    # Let the front proxy send the file (and answer the Range requests)
+    if settings.DOWNLOAD_OFFLOAD == "x-accel-redirect":
+        response = HttpResponse(content_type=contentType)
+        response["X-Accel-Redirect"] = settings.DOWNLOAD_ACCEL_PREFIX + quote(name)
+    elif settings.DOWNLOAD_OFFLOAD == "x-sendfile":
+        response = HttpResponse(content_type=contentType)
+        response["X-Sendfile"] = storage.path(name)
+    else:
+        response = stream_file(request, storage, name, size, etag, lastModified, contentType)
+
+    for header, value in headers.items():
+        response[header] = value
+
+    return response
+
+
+def stream_file(request, storage, name, size, etag, lastModified, contentType):
+    """
+    Stream the whole file, or the byte range asked for
+    """
+    byteRange = parse_range(request.META.get("HTTP_RANGE"), size)
+
+    # A Range is only honoured while the file is still the version the client has part of
+    ifRange = request.META.get("HTTP_IF_RANGE")
+    if byteRange and ifRange and ifRange not in (etag, lastModified):
+        byteRange = None
+
+    if byteRange is False:
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    # FileResponse lets the server use wsgi.file_wrapper (sendfile) for whole files
+    if byteRange is None:
+        return FileResponse(storage.open(name, "rb"), content_type=contentType)
+
+    first, last = byteRange
+    length = last - first + 1
+
+    response = StreamingHttpResponse(
+        read_range(storage.open(name, "rb"), first, length),
+        status=status.HTTP_206_PARTIAL_CONTENT,
+        content_type=contentType
+    )
+    response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    response["Content-Length"] = str(length)
+
+    return response
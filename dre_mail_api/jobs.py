@@ -0,0 +1,335 @@
+import os
+import random
+import socket
+import statistics
+import traceback
+import uuid
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min
+from django.utils.timezone import now
+
+from .models import Job, JobQueue
+from . import notifications
+
+
+# A background job queue kept in the database, so the slow follow-up work of a request runs
+# off the request path without a separate broker. Jobs are queued in the transaction of the
+# request, so they exist exactly when its changes commit, and a job runs in a transaction
+# that also marks it done: its database changes are applied once, however often it is
+# retried. The `run_jobs` workers claim the jobs that are due with SELECT ... FOR UPDATE
+# SKIP LOCKED where the database supports it.
+
+DEFAULT_QUEUE = "default"
+
+# The delay before the first retry of a failed job, doubled for every further attempt
+BACKOFF = timedelta(seconds=10)
+MAX_BACKOFF = timedelta(hours=1)
+
+# A running job whose worker has not finished it in this time is assumed lost and retried
+STALE_AFTER = timedelta(minutes=10)
+
+# How long finished jobs (and so their keys) are kept
+RETENTION = timedelta(days=7)
+
+# The registered tasks, by name
+TASKS = {}
+
+
+class LostJob(Exception):
+    """
+    The job was taken from its worker (it ran for longer than STALE_AFTER) while it ran
+    """
+
+
+class Task:
+
+    def __init__(self, name, function, queue, maxAttempts, every):
+        self.name = name
+        self.function = function
+        self.queue = queue
+        self.maxAttempts = maxAttempts
+        self.every = every
+
+
+def task(name, queue=DEFAULT_QUEUE, maxAttempts=5, every=None):
+    """
+    Register a function as the task of the jobs with this name. It is called with the
+    payload of the job as keyword arguments.
+
+    :param name: The name jobs are queued with
+    :param queue: The queue of the jobs, see the JOB_CONCURRENCY setting
+    :param maxAttempts: How many times a job is run before it is given up on
+    :param every: A timedelta to run the task periodically, without arguments (see `schedule`)
+    """
+    def register(function):
+        TASKS[name] = Task(name, function, queue, maxAttempts, every)
+        return function
+
+    return register
+
+
+def enqueue(name, key=None, delay=None, **payload):
+    """
+    Queue a job, in the current transaction
+
+    :param name: The name of the task
+    :param key: A key that makes the job idempotent: a job with the same key is only queued once
+    :param delay: How long to wait before running the job
+    :param payload: The arguments of the task, they must be JSON serializable
+    :return: The job, and whether it was queued by this call.
+    """
+    definition = TASKS[name]
+    fields = {
+        "name": name,
+        "queue": definition.queue,
+        "payload": payload,
+        "max_attempts": definition.maxAttempts,
+        "run_at": now() + (delay or timedelta()),
+    }
+
+    if key is None:
+        return Job.objects.create(**fields), True
+
+    return Job.objects.get_or_create(key=key, defaults=fields)
+
+
+def worker_name():
+    """
+    A name for a worker that is unique across hosts and processes
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def backoff(attempts):
+    """
+    The delay before retrying a job that failed its attempts-th attempt, with jitter so
+    that jobs that failed together are not all retried at once
+    """
+    delay = min(MAX_BACKOFF, BACKOFF * 2 ** (attempts - 1))
+
+    return delay * random.uniform(0.5, 1)
+
+
+"""--------------- WORKERS ---------------"""
+
+def lock_queues(names):
+    """
+    It locks the rows of the queues, in the current transaction, creating the missing ones
+    """
+    if not names:
+        return
+
+    locked = JobQueue.objects.select_for_update().filter(name__in=names).order_by("name")
+
+    if len(locked) < len(names):
+        JobQueue.objects.bulk_create([JobQueue(name=name) for name in names], ignore_conflicts=True)
+        list(locked.all())
+
+
+def claim(worker, limit, queues=None):
+    """
+    It claims up to `limit` jobs that are due, oldest first, within the concurrency limit
+    of each queue (the JOB_CONCURRENCY setting)
+
+    :param worker: The name of the worker claiming the jobs
+    :param limit: The most jobs to claim
+    :param queues: The queues to take jobs from, None for every queue
+    :return: The claimed jobs.
+    """
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now())
+    if queues:
+        due = due.filter(queue__in=queues)
+
+    limited = sorted(queue for queue in settings.JOB_CONCURRENCY if not queues or queue in queues)
+
+    with transaction.atomic():
+
+        # The running jobs of the limited queues are counted under the locks of the queues,
+        # so that another worker can't claim their last free places at the same time
+        lock_queues(limited)
+
+        running = Counter(dict(
+            Job.objects.filter(status=Job.RUNNING).values_list("queue").annotate(n=Count("id"))
+        ))
+        free = {queue: limit - running[queue] for queue, limit in settings.JOB_CONCURRENCY.items()}
+
+        candidates = due.exclude(
+            queue__in=[queue for queue, n in free.items() if n <= 0]
+        ).select_for_update(skip_locked=True).order_by("run_at", "id").values_list("id", "queue")[:limit]
+
+        claimed = []
+        for jobID, queue in candidates:
+            if queue in free:
+                if free[queue] <= 0:
+                    continue
+                free[queue] -= 1
+
+            claimed.append(jobID)
+
+        # Another worker may have claimed some of them first where rows can't be locked
+        startedAt = now()
+        Job.objects.filter(id__in=claimed, status=Job.QUEUED).update(
+            status=Job.RUNNING, locked_by=worker, locked_at=startedAt, started_at=startedAt,
+            attempts=F("attempts") + 1
+        )
+
+    return list(Job.objects.filter(id__in=claimed, status=Job.RUNNING, locked_by=worker).order_by("run_at", "id"))
+
+
+def run(job):
+    """
+    It runs a claimed job, and marks it done, queues its retry or gives up on it
+
+    :param job: A job claimed by the worker
+    :return: Whether the job succeeded.
+    """
+    try:
+        with transaction.atomic():
+
+            # The worker holds no event streams, the push events of the job are relayed
+            with notifications.relayed():
+                TASKS[job.name].function(**job.payload)
+
+            # The changes of the job are only kept if it still belongs to this worker
+            done = Job.objects.filter(id=job.id, status=Job.RUNNING, locked_by=job.locked_by).update(
+                status=Job.DONE, finished_at=now(), locked_by="", last_error=""
+            )
+            if not done:
+                raise LostJob(f"Job {job.id} was taken from {job.locked_by}")
+
+        return True
+
+    except LostJob:
+        return False
+
+    except Exception:
+        error = traceback.format_exc()
+        failed = job.attempts >= job.max_attempts or job.name not in TASKS
+
+        Job.objects.filter(id=job.id, status=Job.RUNNING, locked_by=job.locked_by).update(
+            status=Job.FAILED if failed else Job.QUEUED,
+            run_at=now() if failed else now() + backoff(job.attempts),
+            finished_at=now() if failed else None,
+            locked_by="",
+            last_error=error
+        )
+
+        return False
+
+
+def requeue_stale():
+    """
+    It retries the jobs whose worker went away while running them
+
+    :return: The number of jobs retried and given up on.
+    """
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=now() - STALE_AFTER)
+    error = f"The worker did not finish the job within {STALE_AFTER}"
+
+    failed = stale.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.FAILED, finished_at=now(), locked_by="", last_error=error
+    )
+    retried = stale.update(status=Job.QUEUED, run_at=now(), locked_by="", last_error=error)
+
+    return retried, failed
+
+
+def run_pending(queues=None, worker=None):
+    """
+    It runs the jobs that are due, one at a time in this thread, until there are none left
+
+    :return: The number of jobs run.
+    """
+    worker = worker or worker_name()
+    count = 0
+
+    while True:
+        jobs = claim(worker, 1, queues)
+        if not jobs:
+            return count
+
+        run(jobs[0])
+        count += 1
+
+
+def schedule():
+    """
+    It queues the periodic tasks once for each of their periods. Every worker calls it, the
+    key of the job of a period makes sure only one of them queues it.
+
+    :return: The number of jobs queued.
+    """
+    current = now().timestamp()
+    queued = 0
+
+    for definition in TASKS.values():
+        if definition.every:
+            period = int(current // definition.every.total_seconds())
+            queued += enqueue(definition.name, key=f"{definition.name}:{period}")[1]
+
+    return queued
+
+
+def prune(retention=RETENTION):
+    """
+    It removes the jobs that finished more than `retention` ago, failed ones included
+
+    :return: The number of jobs removed.
+    """
+    return Job.objects.filter(
+        status__in=[Job.DONE, Job.FAILED], finished_at__lt=now() - retention
+    ).delete()[0]
+
+
+"""--------------- METRICS ---------------"""
+
+def metrics(window=timedelta(hours=1)):
+    """
+    The depth, latency and throughput of every queue
+
+    :param window: The period the throughput and latencies are measured over
+    :return: A dict of queue to its metrics: the jobs due, scheduled for later, running and
+        failed, the age in seconds of the oldest job due, and for the jobs finished in the
+        window their number, failures, and median wait and run time in seconds.
+    """
+    current = now()
+    queues = defaultdict(lambda: {
+        "due": 0, "scheduled": 0, "running": 0, "failed": 0, "oldest_due": 0.0,
+        "finished": 0, "failures": 0, "wait_p50": None, "run_p50": None,
+    })
+
+    counts = Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING, Job.FAILED]).values_list("queue", "status").annotate(
+        n=Count("id"), oldest=Min("run_at")
+    )
+    for queue, status, n, oldest in counts:
+        if status == Job.QUEUED:
+            due = Job.objects.filter(queue=queue, status=Job.QUEUED, run_at__lte=current)
+            queues[queue]["due"] = due.count()
+            queues[queue]["scheduled"] = n - queues[queue]["due"]
+            queues[queue]["oldest_due"] = max(0.0, (current - oldest).total_seconds()) if queues[queue]["due"] else 0.0
+        else:
+            queues[queue][status] = n
+
+    finished = Job.objects.filter(finished_at__gte=current - window).values_list(
+        "queue", "status", "run_at", "started_at", "finished_at"
+    )
+    waits, runs = defaultdict(list), defaultdict(list)
+
+    for queue, status, runAt, startedAt, finishedAt in finished:
+        queues[queue]["finished"] += 1
+
+        if status == Job.FAILED:
+            queues[queue]["failures"] += 1
+        elif startedAt is not None:
+            waits[queue].append((startedAt - runAt).total_seconds())
+            runs[queue].append((finishedAt - startedAt).total_seconds())
+
+    for queue in waits:
+        queues[queue]["wait_p50"] = statistics.median(waits[queue])
+        queues[queue]["run_p50"] = statistics.median(runs[queue])
+
+    return dict(queues)
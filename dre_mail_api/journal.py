@@ -0,0 +1,177 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Subquery
+from django.utils.timezone import now
+
+from .models import MailboxChange, MailboxCounter, MailboxEntry
+
+
+# The change journal of the mailboxes. The mailbox operations append a row for every email
+# transfer they change in the mailbox of a user, after updating the counter of the user:
+# its row lock orders the changes of each user, so the rows of a user are appended in the
+# order they commit. A client keeps the id of the last change it saw as a token and asks for
+# the changes after it, which costs as much as the changes rather than the mailbox.
+
+INSERT_BATCH_SIZE = 1000
+
+# The most changes returned by a single request, the client asks again for the rest
+CHANGES_LIMIT = 500
+
+# How long the changes are kept, older tokens have to resync
+RETENTION = timedelta(days=30)
+
+# The kinds of change that each carry the whole read state, or the whole folder state, of
+# an entry: only the newest of each is needed to sync
+READ_KINDS = [MailboxChange.READ, MailboxChange.UNREAD]
+FOLDER_KINDS = [MailboxChange.MOVED, MailboxChange.DELETED]
+
+
+class TokenTooOld(Exception):
+    """
+    Changes after the token have been compacted away, the client has to refetch its mailbox
+    """
+
+
+def record(changes):
+    """
+    It appends changes to the journals of the users, in the transaction of the change and
+    once the counters of the users have been updated
+
+    :param changes: The MailboxChange rows to append
+    """
+    MailboxChange.objects.bulk_create(changes, batch_size=INSERT_BATCH_SIZE)
+
+
+def move_change(userID, transferID, folder, flags):
+    """
+    The change of an entry filed in a folder with the given flags
+    """
+    if folder == MailboxEntry.DELETED:
+        return MailboxChange(user_id=userID, emailTransfer_id=transferID, kind=MailboxChange.DELETED)
+
+    return MailboxChange(
+        user_id=userID, emailTransfer_id=transferID, kind=MailboxChange.MOVED, folder=folder, flags=flags
+    )
+
+
+def read_changes(userID, transferIDs, read):
+    """
+    The changes of email transfers read or unread by the user
+    """
+    kind = MailboxChange.READ if read else MailboxChange.UNREAD
+
+    return [MailboxChange(user_id=userID, emailTransfer_id=transferID, kind=kind) for transferID in transferIDs]
+
+
+"""--------------- SYNC ---------------"""
+
+def parse_token(token):
+    """
+    The id of the last change a token stands for
+
+    :raise ValueError: The token is not one this journal gave out
+    """
+    since = int(token)
+
+    if since < 0:
+        raise ValueError(token)
+
+    return since
+
+
+def current_token(userID):
+    """
+    The token of the newest change of the user, to sync from after fetching the mailbox
+    """
+    newest = MailboxChange.objects.filter(user_id=userID).aggregate(newest=Max("id"))["newest"]
+
+    if newest is None:
+        newest = MailboxCounter.objects.filter(user_id=userID).values_list("compacted", flat=True).first() or 0
+
+    return str(newest)
+
+
+def changes_since(userID, since, limit=CHANGES_LIMIT):
+    """
+    The changes to the mailbox of the user after a token, one record per email transfer
+    holding its new state
+
+    :param userID: The id of the user
+    :param since: The id of the last change the client saw
+    :param limit: The most changes to read
+    :return: The records, the token of the last change read and whether there are more.
+    """
+    compacted = MailboxCounter.objects.filter(user_id=userID).values_list("compacted", flat=True).first() or 0
+
+    if since < compacted:
+        raise TokenTooOld(f"Changes up to {compacted} are no longer kept")
+
+    rows = list(
+        MailboxChange.objects.filter(user_id=userID, id__gt=since).order_by("id").values_list(
+            "id", "emailTransfer_id", "kind", "folder", "flags"
+        )[:limit + 1]
+    )
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    # The changes of each email transfer are merged into a single record, listed in the
+    # order of their last change
+    records = {}
+
+    for _, transferID, kind, folder, flags in rows:
+        change = records.pop(transferID, {"id": transferID})
+
+        if kind == MailboxChange.DELIVERED:
+            change["delivered"] = True
+        elif kind in READ_KINDS:
+            change["has_read"] = kind == MailboxChange.READ
+        elif kind == MailboxChange.MOVED:
+            change.pop("deleted", None)
+            change.update(folder=folder, favorite=bool(flags & MailboxEntry.FAVORITE))
+        else:
+            change = {"id": transferID, "deleted": True}
+
+        records[transferID] = change
+
+    return list(records.values()), str(rows[-1][0] if rows else since), more
+
+
+"""--------------- COMPACTION ---------------"""
+
+def compact(retention=RETENTION):
+    """
+    It compacts the journals. Changes superseded by a newer change of the same entry are
+    removed whatever their age, since syncing past them gives the same state, and changes
+    older than the retention are removed with the tokens before them.
+
+    :param retention: How long the changes are kept
+    :return: The number of superseded and of expired changes removed.
+    """
+    superseded = 0
+
+    for kinds in (READ_KINDS, FOLDER_KINDS):
+        newer = MailboxChange.objects.filter(
+            user_id=OuterRef("user_id"),
+            emailTransfer_id=OuterRef("emailTransfer_id"),
+            kind__in=kinds,
+            id__gt=OuterRef("id")
+        )
+        superseded += MailboxChange.objects.filter(kind__in=kinds).filter(Exists(newer)).delete()[0]
+
+    expired = MailboxChange.objects.filter(created_at__lt=now() - retention)
+
+    with transaction.atomic():
+
+        # Tokens up to the newest expired change of each user can no longer sync
+        newestExpired = expired.filter(user_id=OuterRef("user_id")).values("user_id").annotate(
+            newest=Max("id")
+        ).values("newest")
+
+        MailboxCounter.objects.filter(
+            Exists(expired.filter(user_id=OuterRef("user_id")))
+        ).update(compacted=Subquery(newestExpired))
+
+        removed = expired.delete()[0]
+
+    return superseded, removed
@@ -0,0 +1,458 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Exists, F, OuterRef, Q, Value, When
+from django.db.models.lookups import Exact
+from django.utils.timezone import now
+
+from . import counters, jobs, journal, notifications
+from .models import EmailGroup, EmailTransfer, MailboxChange, MailboxEntry
+
+
+# The operations that change the state of emails in the mailboxes of the users.
+# Every change is a set based insert, upsert or update on MailboxEntry, whatever the
+# number of email transfers involved, and updates the counters of the users in the
+# same transaction, then appends the changes to their journals. The users are notified of
+# the changes once the transaction commits.
+
+# Group emails are fanned out into one entry per member, inserted in batches of this size
+FANOUT_BATCH_SIZE = 1000
+
+# Read statuses are inserted in batches of this size
+READ_BATCH_SIZE = 1000
+
+# The favorites listing is the FAVORITE flag rather than a folder
+FAVORITES = "favorites"
+
+# The destinations emails can be moved to from each folder. Emails are only permanently
+# deleted from the trash, and taking them off the favorites puts them back in the inbox.
+MOVES = {
+    MailboxEntry.INBOX: [MailboxEntry.TRASH, MailboxEntry.SPAM, MailboxEntry.JUNK, FAVORITES],
+    MailboxEntry.SENT: [MailboxEntry.TRASH, FAVORITES],
+    MailboxEntry.TRASH: [MailboxEntry.INBOX, MailboxEntry.SPAM, MailboxEntry.JUNK, MailboxEntry.DELETED],
+    MailboxEntry.SPAM: [MailboxEntry.INBOX, MailboxEntry.TRASH, MailboxEntry.JUNK],
+    MailboxEntry.JUNK: [MailboxEntry.INBOX, MailboxEntry.TRASH, MailboxEntry.SPAM],
+    FAVORITES: [MailboxEntry.INBOX],
+}
+
+
+def _entry_states(user, transferIDs):
+    """
+    Lock and return the current entries of the user for the email transfers
+
+    :return: A dict of email transfer id to its (folder, flags, read) state.
+    """
+    entries = MailboxEntry.objects.select_for_update().filter(
+        user=user, emailTransfer_id__in=transferIDs
+    ).annotate(
+        read=Exists(
+            EmailTransfer.hasRead.through.objects.filter(
+                emailtransfer_id=OuterRef("emailTransfer_id"),
+                customuser_id=OuterRef("user_id")
+            )
+        )
+    ).values_list("emailTransfer_id", "folder", "flags", "read")
+
+    return {transferID: (folder, flags, read) for transferID, folder, flags, read in entries}
+
+
+def _state_delta(before, after):
+    """
+    The counter difference between the entry states before and after a change
+    """
+    delta = Counter()
+
+    for transferID, state in after.items():
+        delta.update(counters.entry_counts(*state))
+        delta.subtract(counters.entry_counts(*before.get(transferID, (None, 0, False))))
+
+    return delta
+
+
+def _publish_moves(user, before, after):
+    """
+    Journal the email transfers whose folder or flags changed, and notify the user of them
+    """
+    moved = {
+        transferID: (folder, flags)
+        for transferID, (folder, flags, _) in after.items()
+        if before.get(transferID, (MailboxEntry.SENT, 0, False))[:2] != (folder, flags)
+    }
+
+    if not moved:
+        return
+
+    journal.record([
+        journal.move_change(user.id, transferID, folder, flags) for transferID, (folder, flags) in moved.items()
+    ])
+
+    notifications.notify(user.id, notifications.FOLDER, changes=[
+        {"id": transferID, "folder": folder, "favorite": bool(flags & MailboxEntry.FAVORITE)}
+        for transferID, (folder, flags) in moved.items()
+    ])
+
+
+def _deliveries(transfers):
+    """
+    The (transfer, user id) pairs an email is delivered to: its recipient, or every
+    member of its group except the sender
+
+    :param transfers: The email transfers that have been sent
+    """
+    groupIDs = {transfer.group_id for transfer in transfers if transfer.recipient_id is None and transfer.group_id}
+
+    # Look the members of every group up with a single query
+    members = defaultdict(list)
+    if groupIDs:
+        memberships = EmailGroup.members.through.objects.filter(
+            emailgroup_id__in=groupIDs
+        ).values_list("emailgroup_id", "customuser_id")
+
+        for groupID, userID in memberships:
+            members[groupID].append(userID)
+
+    for transfer in transfers:
+        if transfer.recipient_id is not None:
+            yield transfer, transfer.recipient_id
+        elif transfer.group_id is not None:
+            for userID in members[transfer.group_id]:
+                if userID != transfer.sender_id:
+                    yield transfer, userID
+
+
+def deliver(transfers, groups=True):
+    """
+    It files newly sent email transfers in the inbox of their recipients. Group emails
+    are fanned out so that every member gets their own inbox entry.
+
+    :param transfers: The email transfers that have been sent
+    :param groups: Whether to fan the group emails out, or leave them to a background job
+    """
+    entries = [
+        MailboxEntry(
+            user_id=userID,
+            emailTransfer=transfer,
+            folder=MailboxEntry.INBOX,
+            flags=MailboxEntry.RECEIVED,
+            dateSent=transfer.dateSent
+        )
+        for transfer, userID in _deliveries(transfers)
+        if groups or transfer.recipient_id is not None
+    ]
+
+    with transaction.atomic():
+
+        # The recipients who already have the email (a retried delivery) are left out, so that
+        # they are not counted or journaled again
+        existing = set(MailboxEntry.objects.filter(
+            emailTransfer_id__in={entry.emailTransfer_id for entry in entries}
+        ).values_list("user_id", "emailTransfer_id"))
+        entries = [entry for entry in entries if (entry.user_id, entry.emailTransfer_id) not in existing]
+
+        MailboxEntry.objects.bulk_create(entries, batch_size=FANOUT_BATCH_SIZE, ignore_conflicts=True)
+
+        # Every new email is unread, and it is new in the sent emails of the sender
+        deltas = defaultdict(Counter)
+        for entry in entries:
+            deltas[entry.user_id]["unread_inbox"] += 1
+
+        for transfer in transfers:
+            deltas.setdefault(transfer.sender_id, Counter())
+
+        counters.apply_deltas(deltas)
+
+        journal.record([
+            MailboxChange(user_id=entry.user_id, emailTransfer_id=entry.emailTransfer_id, kind=MailboxChange.DELIVERED)
+            for entry in entries
+        ])
+
+        delivered = defaultdict(list)
+        for entry in entries:
+            delivered[entry.user_id].append(entry.emailTransfer_id)
+
+        for userID, transferIDs in delivered.items():
+            notifications.notify(userID, notifications.DELIVERY, ids=transferIDs)
+
+
+def send(transfers, key):
+    """
+    It files newly sent email transfers in the inbox of their recipients at once, and queues
+    the fan out of the group emails to the members as a background job
+
+    :param transfers: The email transfers that have been sent
+    :param key: The key of the fan out job, so that it is queued once
+    """
+    deliver(transfers, groups=False)
+
+    groupTransferIDs = [transfer.id for transfer in transfers if transfer.group_id is not None]
+    if groupTransferIDs:
+        jobs.enqueue("deliver_group_emails", key=key, transferIDs=groupTransferIDs)
+
+
+def current_folder(user, transfer):
+    """
+    The folder the user filed the email transfer in, None if they never acted on it
+    """
+    return MailboxEntry.objects.filter(
+        user=user, emailTransfer=transfer
+    ).values_list("folder", flat=True).first()
+
+
+def move(user, transfers, folder):
+    """
+    It files the email transfers in the given folder of the user with a single upsert
+
+    :param user: The user whose mailbox is changed
+    :param transfers: The email transfers to move
+    :param folder: The destination folder
+    """
+    with transaction.atomic():
+        before = _entry_states(user, [transfer.id for transfer in transfers])
+
+        MailboxEntry.objects.bulk_create(
+            [
+                MailboxEntry(user=user, emailTransfer=transfer, folder=folder, dateSent=transfer.dateSent)
+                for transfer in transfers
+            ],
+            update_conflicts=True,
+            unique_fields=["user", "emailTransfer"],
+            update_fields=["folder", "updated_at"]
+        )
+
+        after = {
+            transfer.id: (folder,) + before.get(transfer.id, (None, 0, False))[1:]
+            for transfer in transfers
+        }
+
+        counters.apply_deltas({user.id: _state_delta(before, after)})
+        _publish_moves(user, before, after)
+
+
+def restore(user, transferIDs, folder):
+    """
+    It moves email transfers out of a folder and back to the inbox, or to the sent folder
+    for the emails the user did not receive
+
+    :param user: The user whose mailbox is changed
+    :param transferIDs: The ids of the email transfers to restore
+    :param folder: The folder the email transfers are restored from
+    :return: The number of email transfers that were in the folder.
+    """
+    with transaction.atomic():
+        before = {
+            transferID: state for transferID, state in _entry_states(user, transferIDs).items()
+            if state[0] == folder
+        }
+
+        restored = MailboxEntry.objects.filter(
+            user=user, emailTransfer_id__in=before, folder=folder
+        ).update(
+            folder=Case(
+                When(Exact(F("flags").bitand(MailboxEntry.RECEIVED), MailboxEntry.RECEIVED), then=Value(MailboxEntry.INBOX)),
+                default=Value(MailboxEntry.SENT)
+            ),
+            updated_at=now()
+        )
+
+        after = {
+            transferID: (MailboxEntry.INBOX if flags & MailboxEntry.RECEIVED else MailboxEntry.SENT, flags, read)
+            for transferID, (_, flags, read) in before.items()
+        }
+
+        counters.apply_deltas({user.id: _state_delta(before, after)})
+        _publish_moves(user, before, after)
+
+    return restored
+
+
+def set_flag(user, transfers, flag):
+    """
+    It sets a flag (e.g. favorite) on email transfers of the user
+
+    :param user: The user whose mailbox is changed
+    :param transfers: The email transfers to flag
+    :param flag: The flag to set
+    """
+    with transaction.atomic():
+        before = _entry_states(user, [transfer.id for transfer in transfers])
+
+        # Emails the user never acted on stay in their sent folder
+        MailboxEntry.objects.bulk_create(
+            [
+                MailboxEntry(user=user, emailTransfer=transfer, folder=MailboxEntry.SENT, dateSent=transfer.dateSent)
+                for transfer in transfers if transfer.id not in before
+            ],
+            ignore_conflicts=True
+        )
+
+        MailboxEntry.objects.filter(
+            user=user, emailTransfer__in=transfers
+        ).update(flags=F("flags").bitor(flag), updated_at=now())
+
+        after = {}
+        for transfer in transfers:
+            folder, flags, read = before.get(transfer.id, (MailboxEntry.SENT, 0, False))
+            after[transfer.id] = (folder, flags | flag, read)
+
+        counters.apply_deltas({user.id: _state_delta(before, after)})
+        _publish_moves(user, before, after)
+
+
+def clear_flag(user, transferIDs, flag):
+    """
+    It removes a flag from email transfers of the user
+
+    :return: The number of email transfers that carried the flag.
+    """
+    with transaction.atomic():
+        before = {
+            transferID: state for transferID, state in _entry_states(user, transferIDs).items()
+            if state[1] & flag
+        }
+
+        cleared = MailboxEntry.objects.filter(
+            user=user, emailTransfer_id__in=before
+        ).update(flags=F("flags").bitand(~flag), updated_at=now())
+
+        after = {
+            transferID: (folder, flags & ~flag, read)
+            for transferID, (folder, flags, read) in before.items()
+        }
+
+        counters.apply_deltas({user.id: _state_delta(before, after)})
+        _publish_moves(user, before, after)
+
+    return cleared
+
+
+def set_read(user, transferIDs, read):
+    """
+    It marks email transfers as read or unread by the user, whatever their current status
+
+    :param user: The user reading the emails
+    :param transferIDs: The ids of the email transfers
+    :param read: True to mark them as read, False to mark them as unread
+    :return: The ids of the email transfers whose read status changed.
+    """
+    ReadStatus = EmailTransfer.hasRead.through
+
+    with transaction.atomic():
+        before = _entry_states(user, transferIDs)
+
+        readIDs = set(
+            ReadStatus.objects.filter(
+                customuser_id=user.id, emailtransfer_id__in=transferIDs
+            ).values_list("emailtransfer_id", flat=True)
+        )
+        changed = [transferID for transferID in dict.fromkeys(transferIDs) if (transferID in readIDs) != read]
+
+        # The through table is written directly, so the counters are updated here
+        # rather than by the m2m_changed signal
+        if read:
+            ReadStatus.objects.bulk_create(
+                [ReadStatus(customuser_id=user.id, emailtransfer_id=transferID) for transferID in changed],
+                batch_size=READ_BATCH_SIZE,
+                ignore_conflicts=True
+            )
+        else:
+            ReadStatus.objects.filter(customuser_id=user.id, emailtransfer_id__in=changed).delete()
+
+        before = {transferID: before[transferID] for transferID in changed if transferID in before}
+        after = {transferID: (folder, flags, read) for transferID, (folder, flags, _) in before.items()}
+
+        counters.apply_deltas({user.id: _state_delta(before, after)})
+
+        if changed:
+            journal.record(journal.read_changes(user.id, changed, read))
+            notifications.notify(user.id, notifications.READ, ids=changed, has_read=read)
+
+    return changed
+
+
+def mark_folder_read(user, folder, upTo=None):
+    """
+    It marks every unread email in a folder of the user as read, with a bulk insert of
+    their read statuses
+
+    :param user: The user reading the emails
+    :param folder: The folder to mark as read
+    :param upTo: The (dateSent, emailTransfer id) position of the newest email to mark,
+        so that emails that arrived after the client listed the folder stay unread
+    :return: The number of emails marked as read.
+    """
+    ReadStatus = EmailTransfer.hasRead.through
+
+    with transaction.atomic():
+        unread = MailboxEntry.objects.in_folder(user, folder).exclude(
+            Exists(ReadStatus.objects.filter(emailtransfer_id=OuterRef("emailTransfer_id"), customuser_id=user.id))
+        )
+
+        if upTo is not None:
+            dateSent, transferID = upTo
+            unread = unread.filter(Q(dateSent__lt=dateSent) | Q(dateSent=dateSent, emailTransfer_id__lte=transferID))
+
+        transferIDs = list(unread.select_for_update().values_list("emailTransfer_id", flat=True))
+
+        ReadStatus.objects.bulk_create(
+            [ReadStatus(customuser_id=user.id, emailtransfer_id=transferID) for transferID in transferIDs],
+            batch_size=READ_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+        counters.apply_deltas({
+            user.id: Counter(unread_inbox=-len(transferIDs) if folder == MailboxEntry.INBOX else 0)
+        })
+
+        if transferIDs:
+            journal.record(journal.read_changes(user.id, transferIDs, True))
+            notifications.notify(user.id, notifications.READ, ids=transferIDs, has_read=True)
+
+    return len(transferIDs)
+
+
+def _is_in(state, folder):
+    """
+    Whether a mailbox entry state is listed in the folder (or in the favorites)
+
+    :param state: The (folder, flags, read) state of the entry, None when the user never acted on the email
+    :param folder: A folder or FAVORITES
+    """
+    # Without an entry the user only has the email in their sent folder
+    entryFolder, flags, _ = state or (MailboxEntry.SENT, 0, False)
+
+    if folder == FAVORITES:
+        return bool(flags & MailboxEntry.FAVORITE) and entryFolder != MailboxEntry.DELETED
+
+    return entryFolder == folder
+
+
+def bulk_move(user, transfers, source, destination):
+    """
+    It moves the email transfers that are in the source folder to the destination, in a
+    single transaction. Moving to the inbox restores them, moving to FAVORITES flags them
+    and moving from FAVORITES to the inbox takes the flag off.
+
+    :param user: The user whose mailbox is changed
+    :param transfers: The email transfers to move
+    :param source: The folder (or FAVORITES) the email transfers are moved from
+    :param destination: The folder (or FAVORITES) the email transfers are moved to
+    :return: The ids of the email transfers that were in the source folder and were moved.
+    """
+    with transaction.atomic():
+        states = _entry_states(user, [transfer.id for transfer in transfers])
+        moving = [transfer for transfer in transfers if _is_in(states.get(transfer.id), source)]
+        movingIDs = [transfer.id for transfer in moving]
+
+        if not moving:
+            return []
+
+        if destination == FAVORITES:
+            set_flag(user, moving, MailboxEntry.FAVORITE)
+        elif source == FAVORITES:
+            clear_flag(user, movingIDs, MailboxEntry.FAVORITE)
+        elif destination == MailboxEntry.INBOX:
+            restore(user, movingIDs, source)
+        else:
+            move(user, moving, destination)
+
+    return movingIDs
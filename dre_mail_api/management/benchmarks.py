@@ -0,0 +1,28 @@
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+# Helpers of the benchmark commands. They seed their data in a transaction and raise
+# Rollback at the end of it, so that the database is left as it was.
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(operation, repeat):
+    """
+    Return the best wall clock time in milliseconds and the number of
+    queries issued by a single run.
+    """
+    timings = []
+
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            operation()
+            timings.append((time.perf_counter() - start) * 1000)
+
+    return min(timings), len(context.captured_queries)
@@ -0,0 +1,109 @@
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from dre_mail_api import mailbox
+from dre_mail_api.models import *
+
+
+class Command(BaseCommand):
+    help = "Compare the sync and async inbox endpoints under concurrent requests through the ASGI handler"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", nargs="+", type=int, default=[1, 10, 100],
+            help="Number of requests in flight at once"
+        )
+        parser.add_argument(
+            "--requests", type=int, default=200,
+            help="Number of requests sent at each concurrency"
+        )
+        parser.add_argument(
+            "--emails", type=int, default=100,
+            help="Number of emails in the inbox being listed"
+        )
+        parser.add_argument(
+            "--cache", action="store_true",
+            help="Keep the listing cache, by default every request reads the database"
+        )
+
+    def handle(self, *args, **options):
+
+        # The data has to be committed for the requests to see it, so it is deleted afterwards
+        user = self.seed(options["emails"])
+
+        try:
+            overrides = {
+                "ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"],
+                "REST_FRAMEWORK": {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_CLASSES": []},
+            }
+            if not options["cache"]:
+                overrides["CACHES"] = {
+                    **settings.CACHES,
+                    "mailbox": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+                }
+
+            with override_settings(**overrides):
+                asyncio.run(self.run(str(AccessToken.for_user(user)), options))
+        finally:
+            CustomUser.objects.filter(email__startswith="bench_async_").delete()
+            Email.objects.filter(subject="Async benchmark").delete()
+
+    async def run(self, token, options):
+        client = AsyncClient()
+
+        self.stdout.write(
+            f"{'view':>6} {'concurrency':>12} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}"
+        )
+
+        for concurrency in options["concurrency"]:
+            for view, url in [("sync", "/v1/api/emailTransfers/inbox"), ("async", "/v1/api/async/emailTransfers/inbox")]:
+                timings, elapsed = await self.measure(client, url, token, concurrency, options["requests"])
+
+                timings.sort()
+                self.stdout.write(
+                    f"{view:>6} {concurrency:>12} {len(timings) / elapsed:>10.1f} "
+                    f"{statistics.median(timings):>10.2f} {timings[int(len(timings) * 0.95) - 1]:>10.2f} {timings[-1]:>10.2f}"
+                )
+
+    async def measure(self, client, url, token, concurrency, requests):
+        """
+        Send the requests with at most `concurrency` in flight, and return the latency of
+        each request in milliseconds and the total wall clock time in seconds
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        timings = []
+
+        async def request():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(url, authorization=f"Bearer {token}")
+                timings.append((time.perf_counter() - start) * 1000)
+
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} answered {response.status_code}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(requests)))
+
+        return timings, time.perf_counter() - start
+
+    def seed(self, emails):
+        """
+        Create a user with `emails` emails in their inbox
+        """
+        user = CustomUser.objects.create_user(email="bench_async_user@dremail.com", password="password", username="bench_async_user")
+        sender = CustomUser.objects.create_user(email="bench_async_sender@dremail.com", password="password", username="bench_async_sender")
+
+        email = Email.objects.create(subject="Async benchmark", message="Benchmark message")
+        transfers = EmailTransfer.objects.bulk_create(
+            EmailTransfer(email=email, sender=sender, recipient=user) for _ in range(emails)
+        )
+        mailbox.deliver(transfers)
+
+        return user
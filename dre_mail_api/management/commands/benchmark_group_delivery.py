@@ -0,0 +1,105 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from dre_mail_api import mailbox
+from dre_mail_api.management.benchmarks import Rollback, measure
+from dre_mail_api.models import *
+
+
+class Command(BaseCommand):
+    help = "Measure the cost of sending to a group and of reading a member's inbox as the group grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[10, 1000, 10000],
+            help="Number of members in the group"
+        )
+        parser.add_argument(
+            "--emails", type=int, default=50,
+            help="Number of emails sent to the group before reading the inbox"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="Number of times each operation is timed"
+        )
+
+    def handle(self, *args, **options):
+
+        # The paths of an email sent through the API: the request inserts the transfer and
+        # queues the fan out, which the deliver_group_emails job runs later
+        self.stdout.write(
+            "send: inserting a group transfer and queuing its fan out, as EmailTransferSerializer.create does\n"
+            "fan out: delivering it to every member, as the deliver_group_emails job does"
+        )
+        self.stdout.write(
+            f"{'members':>8} {'send ms':>10} {'queries':>8} {'fan out ms':>10} {'queries':>8} "
+            f"{'inbox ms':>10} {'queries':>8} {'join ms':>10} {'queries':>8}"
+        )
+
+        for size in options["sizes"]:
+
+            # Seed inside a transaction that is always rolled back so the
+            # benchmark never leaves data behind.
+            try:
+                with transaction.atomic():
+                    sender, group, member = self.seed(size)
+                    email = Email.objects.create(subject="Benchmark", message="Benchmark message")
+
+                    send = measure(lambda: mailbox.send(self.transfers(email, sender, group, 1), key=None), options["repeat"])
+
+                    # A transfer is only fanned out once, each run delivers a new one
+                    pending = self.transfers(email, sender, group, options["repeat"])
+                    fanOut = measure(lambda: mailbox.deliver([pending.pop()]), options["repeat"])
+
+                    mailbox.deliver(self.transfers(email, sender, group, options["emails"]))
+
+                    with connection.cursor() as cursor:
+                        cursor.execute("ANALYZE")
+
+                    # A member's inbox is a scan of their own entries
+                    inbox = measure(
+                        lambda: list(
+                            MailboxEntry.objects.in_folder(member, MailboxEntry.INBOX).order_by("-dateSent", "-id")[:10]
+                        ),
+                        options["repeat"]
+                    )
+
+                    # Reading through the group memberships, as the inbox did before the fan out
+                    join = measure(
+                        lambda: list(
+                            EmailTransfer.objects.filter(group__members=member).order_by("-dateSent", "-id")[:10]
+                        ),
+                        options["repeat"]
+                    )
+                    raise Rollback()
+            except Rollback:
+                pass
+
+            self.stdout.write(
+                f"{size:>8} {send[0]:>10.2f} {send[1]:>8} {fanOut[0]:>10.2f} {fanOut[1]:>8} {inbox[0]:>10.2f} {inbox[1]:>8} {join[0]:>10.2f} {join[1]:>8}"
+            )
+
+    def transfers(self, email, sender, group, count):
+        """
+        Insert `count` transfers of the email to the group, without delivering them
+        """
+        return EmailTransfer.objects.bulk_create(
+            EmailTransfer(email=email, sender=sender, group=group) for _ in range(count)
+        )
+
+    def seed(self, size):
+        """
+        Create a sender and a group with `size` members (the sender included)
+        """
+        sender = CustomUser.objects.create_user(email="bench_sender@dremail.com", password="password", username="bench_sender")
+
+        members = CustomUser.objects.bulk_create(
+            CustomUser(email=f"bench_member_{i}@dremail.com", username=f"bench_member_{i}", password="!")
+            for i in range(size - 1)
+        )
+        MailboxCounter.objects.bulk_create(MailboxCounter(user=member) for member in members)
+
+        group = EmailGroup.objects.create(name="bench_group", description="Benchmark group", creator=sender)
+        group.members.add(sender, *members)
+
+        return sender, group, members[0]
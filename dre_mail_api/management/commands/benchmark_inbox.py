@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from dre_mail_api.management.benchmarks import Rollback, measure
+from dre_mail_api.models import *
+from dre_mail_api import mailbox
+
+
+class Command(BaseCommand):
+    help = "Measure inbox query latency as the trash, spam and junk folders grow"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[100, 1000, 10000],
+            help="Number of emails filed in each of trash, spam and junk"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="Number of times each query is timed"
+        )
+
+    def handle(self, *args, **options):
+
+        self.stdout.write(f"{'filed':>8} {'inbox ms':>10} {'queries':>8} {'visible ms':>10} {'queries':>8}")
+
+        for size in options["sizes"]:
+
+            # Seed inside a transaction that is always rolled back so the
+            # benchmark never leaves data behind.
+            try:
+                with transaction.atomic():
+                    user = self.seed(size)
+                    inbox = measure(
+                        lambda: list(
+                            MailboxEntry.objects.in_folder(user, MailboxEntry.INBOX).order_by("-dateSent", "-id")[:10]
+                        ),
+                        options["repeat"]
+                    )
+                    visible = measure(
+                        lambda: list(
+                            EmailTransfer.objects.visible_to(user).filter(recipient=user).order_by("-dateSent", "-id")[:10]
+                        ),
+                        options["repeat"]
+                    )
+                    raise Rollback()
+            except Rollback:
+                pass
+
+            self.stdout.write(
+                f"{size * 3:>8} {inbox[0]:>10.2f} {inbox[1]:>8} {visible[0]:>10.2f} {visible[1]:>8}"
+            )
+
+    def seed(self, size):
+        """
+        Create a user with `size` emails in each of trash, spam and junk plus a
+        page worth of emails still in the inbox.
+        """
+        sender = CustomUser.objects.create_user(email="bench_sender@dremail.com", password="password", username="bench_sender")
+        user = CustomUser.objects.create_user(email="bench_user@dremail.com", password="password", username="bench_user")
+        email = Email.objects.create(subject="Benchmark", message="Benchmark message")
+
+        transfers = EmailTransfer.objects.bulk_create(
+            EmailTransfer(email=email, sender=sender, recipient=user)
+            for _ in range(size * 3 + 10)
+        )
+
+        mailbox.deliver(transfers)
+        mailbox.move(user, transfers[:size], MailboxEntry.TRASH)
+        mailbox.move(user, transfers[size:size * 2], MailboxEntry.SPAM)
+        mailbox.move(user, transfers[size * 2:size * 3], MailboxEntry.JUNK)
+
+        # Refresh the planner statistics so the folder lookups are planned
+        # the way they would be on a long lived database.
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        return user
@@ -0,0 +1,115 @@
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from dre_mail_api import notifications, push
+from dre_mail_api.models import *
+
+
+class Command(BaseCommand):
+    help = "Hold many idle event streams open in this process and measure the fan out of events to them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--connections", type=int, default=1000,
+            help="Number of event streams held open"
+        )
+        parser.add_argument(
+            "--users", type=int, default=100,
+            help="Number of users the streams are spread over"
+        )
+        parser.add_argument(
+            "--events", type=int, default=100,
+            help="Number of events published, each to one user"
+        )
+
+    def handle(self, *args, **options):
+
+        # The streams read the users from the database, so they are deleted afterwards
+        users = [
+            CustomUser.objects.create_user(email=f"bench_push_{i}@dremail.com", password="password", username=f"bench_push_{i}")
+            for i in range(options["users"])
+        ]
+
+        try:
+            asyncio.run(self.run([(user.id, str(AccessToken.for_user(user))) for user in users], options))
+        finally:
+            CustomUser.objects.filter(email__startswith="bench_push_").delete()
+
+    async def run(self, users, options):
+        broker = notifications.get_broker()
+        disconnect = asyncio.Event()
+        opened = asyncio.Semaphore(0)
+        received = {}
+
+        async def receive():
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        def stream(userID, token):
+            """
+            An open event stream of the user, recording when each event reaches it
+            """
+            async def send(message):
+                body = message.get("body", b"")
+
+                if body.startswith(b"retry:"):
+                    opened.release()
+                elif body.startswith(b"event:"):
+                    received.setdefault(body, []).append(time.perf_counter())
+
+            scope = {
+                "type": "http", "method": "GET", "path": settings.PUSH_PATH,
+                "headers": [(b"authorization", f"Bearer {token}".encode())], "query_string": b"",
+            }
+            return push.events(scope, receive, send)
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        tasks = [
+            asyncio.ensure_future(stream(*users[i % len(users)]))
+            for i in range(options["connections"])
+        ]
+        for _ in tasks:
+            await opened.acquire()
+        elapsed = time.perf_counter() - start
+
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        self.stdout.write(
+            f"Opened {broker.connections()} streams in {elapsed:.2f}s, "
+            f"{memory / options['connections'] / 1024:.1f} KiB each"
+        )
+
+        # Each event goes to every stream of one user
+        timings = []
+        for i in range(options["events"]):
+            userID = users[i % len(users)][0]
+            streams = len(broker.subscriptions.get(userID, ()))
+            event = {"type": notifications.DELIVERY, "ids": [i]}
+            body = push.format_event(event)
+
+            sent = time.perf_counter()
+            broker.publish(userID, event)
+
+            while len(received.get(body, [])) < streams:
+                await asyncio.sleep(0)
+
+            timings.extend((arrival - sent) * 1000 for arrival in received[body])
+
+        timings.sort()
+        self.stdout.write(
+            f"Fan out of {options['events']} events: p50 {statistics.median(timings):.3f} ms, "
+            f"p95 {timings[int(len(timings) * 0.95) - 1]:.3f} ms, max {timings[-1]:.3f} ms"
+        )
+
+        disconnect.set()
+        await asyncio.gather(*tasks)
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import blobs
+
+
+class Command(BaseCommand):
+    help = "Remove the attachment blobs that no email or upload refers to any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-hours", type=float, default=blobs.GRACE_PERIOD.total_seconds() / 3600,
+            help="Only remove blobs unreferenced for this long"
+        )
+        parser.add_argument("--recount", action="store_true", help="Recompute the reference counts first")
+        parser.add_argument("--dry-run", action="store_true", help="Only list the blobs that would be removed")
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            self.stdout.write(f"{blobs.recount()} reference count(s) fixed")
+
+        removed = blobs.collect(timedelta(hours=options["grace_hours"]), dryRun=options["dry_run"])
+
+        for sha256 in removed:
+            self.stdout.write(sha256)
+
+        verb = "would be removed" if options["dry_run"] else "removed"
+        self.stdout.write(self.style.SUCCESS(f"{len(removed)} blob(s) {verb}"))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import journal
+
+
+class Command(BaseCommand):
+    help = "Remove the superseded and expired changes from the mailbox change journals"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days", type=float, default=journal.RETENTION.days,
+            help="Keep the changes of this many days, older sync tokens have to resync"
+        )
+
+    def handle(self, *args, **options):
+        superseded, expired = journal.compact(timedelta(days=options["retention_days"]))
+
+        self.stdout.write(self.style.SUCCESS(f"{superseded} superseded and {expired} expired change(s) removed"))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import avatars
+from dre_mail_api.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Create the resized variants of the avatars stored before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Recreate the variants that already exist")
+
+    def handle(self, *args, **options):
+        created = skipped = failed = 0
+
+        for user in CustomUser.objects.exclude(avi="").exclude(avi__isnull=True).only("id", "avi").iterator():
+            if not options["force"] and avatars.has_variants(user):
+                skipped += 1
+                continue
+
+            try:
+                avatars.create_variants(user)
+                created += 1
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"user {user.id}: {e}"))
+                failed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Variants created for {created} avatar(s), {skipped} already had them, {failed} failed"
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import blobs
+
+
+class Command(BaseCommand):
+    help = "Move the attachment files that are not stored by content yet into blobs, removing duplicates"
+
+    def handle(self, *args, **options):
+        stored, duplicates, missing = blobs.deduplicate()
+
+        if missing:
+            self.stdout.write(self.style.WARNING(f"{missing} attachment file(s) are missing"))
+
+        self.stdout.write(self.style.SUCCESS(f"{stored} blob(s) stored, {duplicates} duplicate file(s) removed"))
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import jobs
+
+
+class Command(BaseCommand):
+    help = "Show the depth, latency and throughput of the background job queues"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--window-minutes", type=float, default=60,
+            help="Period the throughput and latencies are measured over"
+        )
+
+    def handle(self, *args, **options):
+        window = timedelta(minutes=options["window_minutes"])
+
+        self.stdout.write(
+            f"{'queue':>10} {'due':>8} {'later':>8} {'running':>8} {'failed':>8} {'oldest s':>10} "
+            f"{'finished':>9} {'failures':>9} {'wait p50':>9} {'run p50':>9}"
+        )
+
+        for queue, stats in sorted(jobs.metrics(window).items()):
+            waited = "-" if stats["wait_p50"] is None else f"{stats['wait_p50']:.3f}"
+            ran = "-" if stats["run_p50"] is None else f"{stats['run_p50']:.3f}"
+
+            self.stdout.write(
+                f"{queue:>10} {stats['due']:>8} {stats['scheduled']:>8} {stats['running']:>8} {stats['failed']:>8} "
+                f"{stats['oldest_due']:>10.1f} {stats['finished']:>9} {stats['failures']:>9} {waited:>9} {ran:>9}"
+            )
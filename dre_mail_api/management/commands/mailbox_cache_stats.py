@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api.caching import cache_stats
+
+
+class Command(BaseCommand):
+    help = "Show the hits and misses of the mailbox listing cache"
+
+    def handle(self, *args, **options):
+        stats = cache_stats()
+        self.stdout.write(
+            f"hits: {stats['hits']}  misses: {stats['misses']}  hit ratio: {stats['hit_ratio']:.1%}"
+        )
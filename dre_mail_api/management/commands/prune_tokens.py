@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import blacklist
+
+
+class Command(BaseCommand):
+    help = "Delete the expired refresh tokens and their blacklist entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=blacklist.PRUNE_BATCH_SIZE,
+            help="Number of tokens deleted by each transaction"
+        )
+
+    def handle(self, *args, **options):
+        outstanding, blacklisted = blacklist.prune(options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(f"{outstanding} expired token(s) deleted, {blacklisted} of them blacklisted"))
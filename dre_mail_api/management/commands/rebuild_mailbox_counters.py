@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the mailbox counters of every user from their mailbox entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report the counters that drifted")
+        parser.add_argument("--user", type=int, action="append", dest="users", help="Only the user with this id")
+
+    def handle(self, *args, **options):
+        drifted = counters.drift(options["users"])
+
+        for userID, fields in drifted.items():
+            for field, (stored, actual) in fields.items():
+                self.stdout.write(f"user {userID}: {field} is {stored}, expected {actual}")
+
+        if options["check"]:
+            message = f"{len(drifted)} mailbox counter(s) drifted"
+            self.stdout.write(self.style.WARNING(message) if drifted else self.style.SUCCESS(message))
+            return
+
+        counters.rebuild(options["users"])
+        self.stdout.write(self.style.SUCCESS(f"Mailbox counters rebuilt, {len(drifted)} fixed"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from dre_mail_api.search import index_transfers
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full text search documents of every email transfer"
+
+    def handle(self, *args, **options):
+        index_transfers()
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
@@ -0,0 +1,113 @@
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from dre_mail_api import jobs, notifications
+
+
+class Command(BaseCommand):
+    help = "Run the background jobs as they come due, until stopped"
+
+    # Seconds between the retries of lost jobs, the pruning of finished ones and the queueing
+    # of the periodic ones
+    MAINTENANCE_INTERVAL = 60
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=4,
+            help="Number of jobs this worker runs at once"
+        )
+        parser.add_argument(
+            "--queues", nargs="+",
+            help="Only run the jobs of these queues"
+        )
+        parser.add_argument(
+            "--poll-interval", type=float, default=1.0,
+            help="Seconds to wait before looking for jobs again when there are none"
+        )
+        parser.add_argument(
+            "--burst", action="store_true",
+            help="Exit once there are no jobs due rather than waiting for more"
+        )
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        stopping = threading.Event()
+
+        # Finish the running jobs, and claim no more, on Ctrl+C or a SIGTERM
+        handlers = {
+            signalNumber: signal.signal(signalNumber, lambda *_: stopping.set())
+            for signalNumber in (signal.SIGINT, signal.SIGTERM)
+        }
+
+        self.stdout.write(f"Worker {worker} running {options['concurrency']} job(s) at once")
+
+        try:
+            self.work(worker, stopping, options)
+        finally:
+            for signalNumber, handler in handlers.items():
+                signal.signal(signalNumber, handler)
+
+    def work(self, worker, stopping, options):
+        running = set()
+        lastMaintenance = 0
+
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            while not stopping.is_set():
+                if time.monotonic() - lastMaintenance > self.MAINTENANCE_INTERVAL:
+                    self.maintain()
+                    lastMaintenance = time.monotonic()
+
+                running = {future for future in running if not future.done()}
+                free = options["concurrency"] - len(running)
+                claimed = jobs.claim(worker, free, options["queues"]) if free else []
+
+                for job in claimed:
+                    running.add(executor.submit(self.run, job))
+
+                if claimed:
+                    continue
+
+                if options["burst"] and not running:
+                    break
+
+                # Wait for a free thread, or for new jobs to come due
+                if running:
+                    wait(running, timeout=options["poll_interval"], return_when=FIRST_COMPLETED)
+                else:
+                    stopping.wait(options["poll_interval"])
+
+            wait(running)
+
+    def run(self, job):
+        start = time.perf_counter()
+
+        try:
+            succeeded = jobs.run(job)
+        finally:
+
+            # Every thread holds its own database connection
+            connection.close()
+
+        elapsed = time.perf_counter() - start
+
+        if succeeded:
+            self.stdout.write(f"{job.name} #{job.id} done in {elapsed:.3f}s")
+        else:
+            self.stderr.write(f"{job.name} #{job.id} failed attempt {job.attempts} of {job.max_attempts}")
+
+    def maintain(self):
+        retried, failed = jobs.requeue_stale()
+        pruned = jobs.prune()
+        notifications.prune_relayed()
+        scheduled = jobs.schedule()
+
+        if retried or failed or pruned:
+            self.stdout.write(f"{retried} lost job(s) retried, {failed} given up on, {pruned} finished job(s) pruned")
+
+        if scheduled:
+            self.stdout.write(f"{scheduled} periodic job(s) queued")
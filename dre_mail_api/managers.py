@@ -1,4 +1,6 @@
 from django.contrib.auth.base_user import BaseUserManager
+from django.db import models
+from django.db.models import Exists, F, OuterRef, Q
 from django.utils.translation import gettext_lazy as _
 
 
@@ -31,4 +33,80 @@ class CustomUserManager(BaseUserManager):
             raise ValueError(_("Superuser must have is_staff=True."))
         if extra_fields.get("is_superuser") is not True:
             raise ValueError(_("Superuser must have is_superuser=True."))
-        return self.create_user(email, password, **extra_fields)
\ No newline at end of file
+        return self.create_user(email, password, **extra_fields)
+
+class EmailTransferQuerySet(models.QuerySet):
+    """
+    Queryset for email transfers that expresses the mailbox state of a user as
+    correlated subqueries so that each listing is a single SQL statement.
+    """
+
+    def visible_to(self, user):
+        """
+        Return the email transfers the user has not permanently deleted.
+        """
+        from .models import MailboxEntry
+
+        return self.exclude(
+            Exists(
+                MailboxEntry.objects.filter(
+                    user=user,
+                    emailTransfer=OuterRef("pk"),
+                    folder=MailboxEntry.DELETED
+                )
+            )
+        )
+
+    def involving(self, user):
+        """
+        Return the email transfers the user sent, received directly or received
+        through one of their groups.
+        """
+        from .models import EmailGroup
+
+        isGroupMember = Exists(
+            EmailGroup.members.through.objects.filter(
+                emailgroup_id=OuterRef("group_id"),
+                customuser=user
+            )
+        )
+
+        return self.filter(Q(sender=user) | Q(recipient=user) | isGroupMember)
+
+    def with_read_status(self, user):
+        """
+        Annotate every email transfer with whether the user has read it so the
+        serializers do not need a query per row.
+        """
+        from .models import EmailTransfer
+
+        return self.annotate(
+            has_read=Exists(
+                EmailTransfer.hasRead.through.objects.filter(
+                    emailtransfer_id=OuterRef("pk"),
+                    customuser=user
+                )
+            )
+        )
+
+
+class MailboxEntryQuerySet(models.QuerySet):
+    """
+    Queryset for the per user mailbox entries. Listing a folder is a range scan
+    of the (user, folder, dateSent) index.
+    """
+
+    def in_folder(self, user, folder):
+        """
+        Return the entries the user filed in the given folder.
+        """
+        return self.filter(user=user, folder=folder)
+
+    def flagged(self, user, flag):
+        """
+        Return the entries of the user that carry the given flag, leaving out
+        the permanently deleted ones.
+        """
+        return self.filter(user=user).alias(
+            flagBits=F("flags").bitand(flag)
+        ).filter(flagBits=flag).exclude(folder=self.model.DELETED)
@@ -0,0 +1,70 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:09
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+# The folder models and the field referencing the user who filed the email
+FOLDERS = {
+    "Favorites": "favoriter",
+    "Junk": "junker",
+    "Trash": "deleter",
+    "Spam": "spammer",
+    "Deleted": "deleter",
+}
+
+
+def remove_duplicate_entries(apps, schema_editor):
+    """
+    Keep the oldest row of every (user, emailTransfer) pair so the unique
+    constraints can be created.
+    """
+    for modelName, userField in FOLDERS.items():
+        model = apps.get_model("dre_mail_api", modelName)
+
+        keep = model.objects.values(userField, "emailTransfer").annotate(keep=Min("id")).values("keep")
+
+        model.objects.exclude(id__in=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0006_alter_emailtransfer_group_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailtransfer',
+            index=models.Index(fields=['recipient', 'dateSent', 'id'], name='transfer_recipient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailtransfer',
+            index=models.Index(fields=['sender', 'dateSent', 'id'], name='transfer_sender_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailtransfer',
+            index=models.Index(fields=['group', 'dateSent', 'id'], name='transfer_group_date_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='deleted',
+            constraint=models.UniqueConstraint(fields=('deleter', 'emailTransfer'), name='unique_deleted_entry'),
+        ),
+        migrations.AddConstraint(
+            model_name='favorites',
+            constraint=models.UniqueConstraint(fields=('favoriter', 'emailTransfer'), name='unique_favorites_entry'),
+        ),
+        migrations.AddConstraint(
+            model_name='junk',
+            constraint=models.UniqueConstraint(fields=('junker', 'emailTransfer'), name='unique_junk_entry'),
+        ),
+        migrations.AddConstraint(
+            model_name='spam',
+            constraint=models.UniqueConstraint(fields=('spammer', 'emailTransfer'), name='unique_spam_entry'),
+        ),
+        migrations.AddConstraint(
+            model_name='trash',
+            constraint=models.UniqueConstraint(fields=('deleter', 'emailTransfer'), name='unique_trash_entry'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+from django.db import migrations
+
+
+# The full text index as this migration made it. The search backends of search.py are not
+# imported, so that changing them later doesn't change what this migration does.
+
+TRANSFER_TABLE = "dre_mail_api_emailtransfer"
+FTS_TABLE = "dre_mail_api_emailtransfer_fts"
+
+POSTGRES_DOCUMENT = """
+    SELECT
+        setweight(to_tsvector('simple', coalesce(e.subject, '')), 'A') ||
+        setweight(to_tsvector('simple', concat_ws(' ',
+            s.first_name, s.last_name, s.username, s.email,
+            r.first_name, r.last_name, r.username, r.email
+        )), 'B') ||
+        setweight(to_tsvector('simple', coalesce(e.message, '')), 'C')
+    FROM dre_mail_api_email e
+    JOIN dre_mail_api_customuser s ON s.id = t.sender_id
+    LEFT JOIN dre_mail_api_customuser r ON r.id = t.recipient_id
+    WHERE e.id = t.email_id
+"""
+
+SQLITE_DOCUMENT = f"""
+    SELECT t.id, e.subject, e.message,
+        s.first_name || ' ' || s.last_name || ' ' || s.username || ' ' || s.email || ' ' ||
+        coalesce(r.first_name || ' ' || r.last_name || ' ' || r.username || ' ' || r.email, '')
+    FROM {TRANSFER_TABLE} t
+    JOIN dre_mail_api_email e ON e.id = t.email_id
+    JOIN dre_mail_api_customuser s ON s.id = t.sender_id
+    LEFT JOIN dre_mail_api_customuser r ON r.id = t.recipient_id
+"""
+
+INSTALL = {
+    "postgresql": [
+        f"ALTER TABLE {TRANSFER_TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        f"CREATE INDEX IF NOT EXISTS transfer_search_vector_idx ON {TRANSFER_TABLE} USING GIN (search_vector)",
+        f"UPDATE {TRANSFER_TABLE} AS t SET search_vector = ({POSTGRES_DOCUMENT})",
+    ],
+    "sqlite": [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+        "USING fts5(subject, message, participants, tokenize='unicode61')",
+        f"DELETE FROM {FTS_TABLE}",
+        f"INSERT INTO {FTS_TABLE} (rowid, subject, message, participants) {SQLITE_DOCUMENT}",
+    ],
+}
+
+UNINSTALL = {
+    "postgresql": [f"ALTER TABLE {TRANSFER_TABLE} DROP COLUMN IF EXISTS search_vector"],
+    "sqlite": [f"DROP TABLE IF EXISTS {FTS_TABLE}"],
+}
+
+
+def install_search_index(apps, schema_editor):
+    """
+    Create the full text index of the database backend and index the existing emails
+    """
+    with schema_editor.connection.cursor() as cursor:
+        for statement in INSTALL[schema_editor.connection.vendor]:
+            cursor.execute(statement)
+
+
+def uninstall_search_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in UNINSTALL[schema_editor.connection.vendor]:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0007_mailbox_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
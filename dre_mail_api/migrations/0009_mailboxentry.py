@@ -0,0 +1,163 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models import Exists, F, OuterRef
+
+
+BATCH_SIZE = 1000
+
+INBOX = "inbox"
+SENT = "sent"
+FAVORITE = 1
+RECEIVED = 2
+
+# The folder models, the field referencing the user who filed the email and the folder
+# it becomes. When an email is in several of them the last one wins.
+FOLDERS = [
+    ("Junk", "junker", "junk"),
+    ("Spam", "spammer", "spam"),
+    ("Trash", "deleter", "trash"),
+    ("Deleted", "deleter", "deleted"),
+]
+
+
+def batches(rows):
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def copy_folders(apps, schema_editor):
+    """
+    Build the mailbox entries from the received emails and the five folder models
+    """
+    EmailTransfer = apps.get_model("dre_mail_api", "EmailTransfer")
+    MailboxEntry = apps.get_model("dre_mail_api", "MailboxEntry")
+    Favorites = apps.get_model("dre_mail_api", "Favorites")
+
+    # Every received email starts in the inbox of its recipient
+    received = EmailTransfer.objects.filter(recipient__isnull=False).values_list("id", "recipient_id", "dateSent")
+
+    for batch in batches(received.iterator()):
+        MailboxEntry.objects.bulk_create(
+            [
+                MailboxEntry(user_id=userID, emailTransfer_id=transferID, folder=INBOX, flags=RECEIVED, dateSent=dateSent)
+                for transferID, userID, dateSent in batch
+            ],
+            ignore_conflicts=True
+        )
+
+    for modelName, userField, folder in FOLDERS:
+        rows = apps.get_model("dre_mail_api", modelName).objects.values_list(
+            userField, "emailTransfer_id", "emailTransfer__dateSent"
+        )
+
+        for batch in batches(rows.iterator()):
+            MailboxEntry.objects.bulk_create(
+                [
+                    MailboxEntry(user_id=userID, emailTransfer_id=transferID, folder=folder, dateSent=dateSent)
+                    for userID, transferID, dateSent in batch
+                ],
+                update_conflicts=True,
+                unique_fields=["user", "emailTransfer"],
+                update_fields=["folder"]
+            )
+
+    # Favorites become a flag, the emails that were not received stay in the sent folder
+    favorites = Favorites.objects.values_list("favoriter", "emailTransfer_id", "emailTransfer__dateSent")
+
+    for batch in batches(favorites.iterator()):
+        MailboxEntry.objects.bulk_create(
+            [
+                MailboxEntry(user_id=userID, emailTransfer_id=transferID, folder=SENT, dateSent=dateSent)
+                for userID, transferID, dateSent in batch
+            ],
+            ignore_conflicts=True
+        )
+
+    MailboxEntry.objects.filter(
+        Exists(Favorites.objects.filter(favoriter=OuterRef("user"), emailTransfer=OuterRef("emailTransfer")))
+    ).update(flags=F("flags").bitor(FAVORITE))
+
+
+def copy_folders_back(apps, schema_editor):
+    """
+    Rebuild the five folder models from the mailbox entries
+    """
+    MailboxEntry = apps.get_model("dre_mail_api", "MailboxEntry")
+
+    for modelName, userField, folder in FOLDERS:
+        model = apps.get_model("dre_mail_api", modelName)
+        rows = MailboxEntry.objects.filter(folder=folder).values_list("user_id", "emailTransfer_id")
+
+        for batch in batches(rows.iterator()):
+            model.objects.bulk_create(
+                model(emailTransfer_id=transferID, **{f"{userField}_id": userID}) for userID, transferID in batch
+            )
+
+    Favorites = apps.get_model("dre_mail_api", "Favorites")
+    rows = MailboxEntry.objects.alias(
+        favorite=F("flags").bitand(FAVORITE)
+    ).filter(favorite=FAVORITE).values_list("user_id", "emailTransfer_id")
+
+    for batch in batches(rows.iterator()):
+        Favorites.objects.bulk_create(
+            Favorites(favoriter_id=userID, emailTransfer_id=transferID) for userID, transferID in batch
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0008_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('trash', 'Trash'), ('spam', 'Spam'), ('junk', 'Junk'), ('deleted', 'Deleted')], default='inbox', max_length=10)),
+                ('flags', models.PositiveSmallIntegerField(default=0)),
+                ('dateSent', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('emailTransfer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxEntries', to='dre_mail_api.emailtransfer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxEntries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['user', 'folder', 'dateSent', 'id'], name='mailbox_user_folder_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailboxentry',
+            constraint=models.UniqueConstraint(fields=('user', 'emailTransfer'), name='unique_mailbox_entry'),
+        ),
+        migrations.RunPython(copy_folders, copy_folders_back),
+        migrations.DeleteModel(
+            name='Deleted',
+        ),
+        migrations.DeleteModel(
+            name='Favorites',
+        ),
+        migrations.DeleteModel(
+            name='Junk',
+        ),
+        migrations.DeleteModel(
+            name='Spam',
+        ),
+        migrations.DeleteModel(
+            name='Trash',
+        ),
+    ]
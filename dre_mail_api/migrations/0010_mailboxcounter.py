@@ -0,0 +1,85 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:18
+
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Exists, F, OuterRef
+
+
+# The counts as this migration computed them, rather than imported from counters.py
+FIELDS = ["unread_inbox", "trash", "spam", "junk", "favorites"]
+FOLDER_FIELDS = {"trash": "trash", "spam": "spam", "junk": "junk"}
+INBOX = "inbox"
+DELETED = "deleted"
+FAVORITE = 1
+
+
+def count_mailboxes(MailboxEntry, ReadStatus):
+    """
+    The counts of every user, counted from their mailbox entries
+
+    :return: A dict of user id to a Counter of the counter fields.
+    """
+    entries = MailboxEntry.objects.all()
+    counts = defaultdict(Counter)
+
+    folders = entries.filter(folder__in=FOLDER_FIELDS).values("user_id", "folder").annotate(n=Count("id"))
+    for row in folders:
+        counts[row["user_id"]][FOLDER_FIELDS[row["folder"]]] = row["n"]
+
+    unread = entries.filter(folder=INBOX).exclude(
+        Exists(ReadStatus.objects.filter(emailtransfer_id=OuterRef("emailTransfer_id"), customuser_id=OuterRef("user_id")))
+    ).values("user_id").annotate(n=Count("id"))
+    for row in unread:
+        counts[row["user_id"]]["unread_inbox"] = row["n"]
+
+    favorites = entries.exclude(folder=DELETED).alias(
+        favorite=F("flags").bitand(FAVORITE)
+    ).filter(favorite=FAVORITE).values("user_id").annotate(n=Count("id"))
+    for row in favorites:
+        counts[row["user_id"]]["favorites"] = row["n"]
+
+    return counts
+
+
+def create_counters(apps, schema_editor):
+
+    # Give every existing user a counter row holding their current counts
+    CustomUser = apps.get_model("dre_mail_api", "CustomUser")
+    MailboxEntry = apps.get_model("dre_mail_api", "MailboxEntry")
+    MailboxCounter = apps.get_model("dre_mail_api", "MailboxCounter")
+    EmailTransfer = apps.get_model("dre_mail_api", "EmailTransfer")
+
+    counts = count_mailboxes(MailboxEntry, EmailTransfer.hasRead.through)
+
+    MailboxCounter.objects.bulk_create(
+        [
+            MailboxCounter(user_id=userID, **{field: counts[userID][field] for field in FIELDS})
+            for userID in CustomUser.objects.values_list("id", flat=True)
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0009_mailboxentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mailboxCounter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread_inbox', models.IntegerField(default=0)),
+                ('trash', models.IntegerField(default=0)),
+                ('spam', models.IntegerField(default=0)),
+                ('junk', models.IntegerField(default=0)),
+                ('favorites', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+from importlib import import_module
+
+from django.db import migrations
+from django.db.models import Exists, F, OuterRef
+
+
+BATCH_SIZE = 1000
+
+RECEIVED = 2
+
+
+# The counts as the migration that made the counters computed them, so that the two agree
+mailboxcounter = import_module("dre_mail_api.migrations.0010_mailboxcounter")
+
+
+def fan_out_group_emails(apps, schema_editor):
+    """
+    Deliver the existing group emails to the inbox of every member, as group sends now do
+    """
+    EmailTransfer = apps.get_model("dre_mail_api", "EmailTransfer")
+    EmailGroup = apps.get_model("dre_mail_api", "EmailGroup")
+    MailboxEntry = apps.get_model("dre_mail_api", "MailboxEntry")
+    MailboxCounter = apps.get_model("dre_mail_api", "MailboxCounter")
+    Membership = EmailGroup.members.through
+
+    deliveries = Membership.objects.filter(
+        emailgroup__emailtransfer__recipient__isnull=True
+    ).exclude(
+        customuser=F("emailgroup__emailtransfer__sender")
+    ).values_list("customuser_id", "emailgroup__emailtransfer__id", "emailgroup__emailtransfer__dateSent")
+
+    batch = []
+    for delivery in deliveries.iterator():
+        batch.append(delivery)
+
+        if len(batch) == BATCH_SIZE:
+            deliver(MailboxEntry, batch)
+            batch = []
+
+    deliver(MailboxEntry, batch)
+
+    # Members who already filed a group email received it as well
+    MailboxEntry.objects.filter(
+        Exists(
+            Membership.objects.filter(
+                customuser=OuterRef("user"),
+                emailgroup__emailtransfer=OuterRef("emailTransfer"),
+                emailgroup__emailtransfer__recipient__isnull=True
+            )
+        )
+    ).exclude(
+        emailTransfer__sender=F("user")
+    ).update(flags=F("flags").bitor(RECEIVED))
+
+    # Recount the mailboxes of the members
+    counts = mailboxcounter.count_mailboxes(MailboxEntry, EmailTransfer.hasRead.through)
+
+    MailboxCounter.objects.bulk_create(
+        [
+            MailboxCounter(user_id=userID, **{field: counts[userID][field] for field in mailboxcounter.FIELDS})
+            for userID in Membership.objects.values_list("customuser_id", flat=True).distinct()
+        ],
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=mailboxcounter.FIELDS
+    )
+
+
+def deliver(MailboxEntry, batch):
+    MailboxEntry.objects.bulk_create(
+        [
+            MailboxEntry(
+                user_id=userID, emailTransfer_id=transferID, folder=mailboxcounter.INBOX, flags=RECEIVED, dateSent=dateSent
+            )
+            for userID, transferID, dateSent in batch
+        ],
+        ignore_conflicts=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0010_mailboxcounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(fan_out_group_emails, migrations.RunPython.noop),
+    ]
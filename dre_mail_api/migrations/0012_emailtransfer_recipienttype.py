@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0011_group_fanout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailtransfer',
+            name='recipientType',
+            field=models.CharField(choices=[('to', 'To'), ('cc', 'Cc'), ('bcc', 'Bcc')], default='to', max_length=3),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0012_emailtransfer_recipienttype'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,135 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:45
+
+import hashlib
+import os
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+# The content addressed storage as this migration filled it, rather than imported from
+# blobs.py
+
+BLOB_DIRECTORY = "blobs"
+BLOCK_SIZE = 64 * 1024
+
+
+def blob_name(sha256):
+    return f"{BLOB_DIRECTORY}/{sha256[:2]}/{sha256}"
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            digest.update(block)
+            size += len(block)
+
+    return digest.hexdigest(), size
+
+
+def references(model):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(blob=OuterRef("pk")).order_by().values("blob")
+            .annotate(count=Count("pk")).values("count")
+        ),
+        Value(0)
+    )
+
+
+def deduplicate_attachments(apps, schema_editor):
+    """
+    Move the attachment files written so far into blobs, one per distinct content, and
+    point the emails and uploads at them
+    """
+    Email = apps.get_model("dre_mail_api", "Email")
+    Upload = apps.get_model("dre_mail_api", "Upload")
+    Blob = apps.get_model("dre_mail_api", "Blob")
+
+    hashes = {}
+
+    def blob_of(name):
+        if name not in hashes:
+            path = default_storage.path(name)
+
+            if not os.path.exists(path):
+                hashes[name] = None
+                return None
+
+            sha256, size = hash_file(path)
+            target = default_storage.path(blob_name(sha256))
+            Blob.objects.get_or_create(sha256=sha256, defaults={"size": size})
+
+            # The first copy of a content becomes its blob, the others are removed
+            if os.path.exists(target):
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+
+            hashes[name] = sha256
+
+        return hashes[name]
+
+    emails = Email.objects.filter(blob__isnull=True).exclude(attachment="").exclude(attachment__isnull=True)
+
+    for emailID, name in emails.values_list("id", "attachment").iterator():
+        sha256 = blob_of(name)
+
+        if sha256 is not None:
+            Email.objects.filter(id=emailID).update(
+                blob_id=sha256, attachment=blob_name(sha256), attachmentName=os.path.basename(name)
+            )
+
+    uploads = Upload.objects.filter(blob__isnull=True).exclude(file="").exclude(file__isnull=True)
+
+    for uploadID, name in uploads.values_list("id", "file").iterator():
+        sha256 = blob_of(name)
+
+        if sha256 is not None:
+            Upload.objects.filter(id=uploadID).update(blob_id=sha256, file=blob_name(sha256))
+
+    # Every blob is referred to by the emails and uploads pointing at it
+    Blob.objects.update(refcount=references(Email) + references(Upload))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0015_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.PositiveBigIntegerField()),
+                ('refcount', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='attachmentName',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='emails', to='dre_mail_api.blob'),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='uploads', to='dre_mail_api.blob'),
+        ),
+        migrations.RunPython(deduplicate_attachments, migrations.RunPython.noop),
+    ]
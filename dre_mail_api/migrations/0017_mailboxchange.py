@@ -0,0 +1,36 @@
+# Generated by Django 4.1.6 on 2026-10-18 13:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0016_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='compacted',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MailboxChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('delivered', 'Delivered'), ('read', 'Read'), ('unread', 'Unread'), ('moved', 'Moved'), ('deleted', 'Deleted')], max_length=10)),
+                ('folder', models.CharField(blank=True, choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('trash', 'Trash'), ('spam', 'Spam'), ('junk', 'Junk'), ('deleted', 'Deleted')], default='', max_length=10)),
+                ('flags', models.PositiveSmallIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('emailTransfer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxChanges', to='dre_mail_api.emailtransfer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxChanges', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailboxchange',
+            index=models.Index(fields=['user', 'id'], name='mailbox_change_user_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.6 on 2026-10-18 15:40
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def keep_variant_urls(apps, schema_editor):
+    """
+    The variants of the avatars stored before were named after a hash of the name of the
+    avatar, it becomes their token so that their urls stay the same
+    """
+    CustomUser = apps.get_model("dre_mail_api", "CustomUser")
+
+    users = CustomUser.objects.exclude(avi="").exclude(avi__isnull=True).only("id", "avi")
+
+    for user in users.iterator():
+        user.avi_token = hashlib.sha256(user.avi.name.encode()).hexdigest()[:16]
+        user.save(update_fields=["avi_token"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0019_pushevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='avi_token',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.RunPython(keep_variant_urls, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.6 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dre_mail_api', '0021_jobqueue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='writer',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
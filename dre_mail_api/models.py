@@ -2,8 +2,9 @@ from django.db import models
 from django.utils.timezone import now
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
-from .managers import CustomUserManager
+from .managers import CustomUserManager, EmailTransferQuerySet, MailboxEntryQuerySet
 import re
+import uuid
 
 # Create your models here.
 class CustomUser(AbstractUser):
@@ -11,6 +12,10 @@ class CustomUser(AbstractUser):
     email = models.EmailField(_('email address'), unique=True)
     avi = models.ImageField(upload_to="userImages/", null=True, blank=True)
 
+    # Renewed with every upload of an avatar, it names the resized variants (see avatars.py)
+    avi_token = models.CharField(max_length=32, blank=True, default="")
+    updated_at = models.DateTimeField(auto_now=True)
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
@@ -30,41 +35,239 @@ class EmailGroup(models.Model):
     members = models.ManyToManyField(to=CustomUser, related_name="members")
 
 
+# A stored attachment file, addressed by the SHA-256 hash of its content so that a file
+# attached to many emails, drafts or uploads is written to disk once. The reference count
+# is the number of emails and uploads that point at it; unreferenced blobs are collected.
+class Blob(models.Model):
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class Email(models.Model):
     subject =  models.CharField(max_length=100, blank=False, null=False)
     message = models.TextField(blank=False)
     attachment = models.FileField(upload_to='attachments/')
 
+    # The blob holding the attachment and the name it was attached with
+    blob = models.ForeignKey(null=True, blank=True, to=Blob, on_delete=models.PROTECT, related_name="emails")
+    attachmentName = models.CharField(max_length=255, blank=True, default="")
+
 
 class EmailTransfer(models.Model):
+
+    # Recipient types
+    TO = "to"
+    CC = "cc"
+    BCC = "bcc"
+
+    RECIPIENT_TYPES = [
+        (TO, "To"),
+        (CC, "Cc"),
+        (BCC, "Bcc"),
+    ]
+
     email = models.ForeignKey(to=Email, on_delete=models.CASCADE)
     sender = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE, related_name="sender")
     recipient = models.ForeignKey(null=True, blank=True, to=CustomUser, on_delete=models.CASCADE, related_name="recipient")
     group = models.ForeignKey(null=True, blank=True, to=EmailGroup, on_delete=models.CASCADE)
     dateSent = models.DateTimeField(default=now, null=False, blank=False)
     hasRead = models.ManyToManyField(to=CustomUser)
+    recipientType = models.CharField(max_length=3, choices=RECIPIENT_TYPES, default=TO)
+
+    objects = EmailTransferQuerySet.as_manager()
+
+    class Meta:
+        # The mailbox listings filter on a participant and page on (dateSent, id)
+        indexes = [
+            models.Index(fields=["recipient", "dateSent", "id"], name="transfer_recipient_date_idx"),
+            models.Index(fields=["sender", "dateSent", "id"], name="transfer_sender_date_idx"),
+            models.Index(fields=["group", "dateSent", "id"], name="transfer_group_date_idx"),
+        ]
+
+
+# The state of an email transfer in the mailbox of one user: the folder it is filed in and its flags.
+# Recipients (every member but the sender for group emails) get an inbox entry when the
+# email is delivered, other users (e.g. the sender) only get one once they act on the email.
+class MailboxEntry(models.Model):
+
+    # Folders
+    INBOX = "inbox"
+    SENT = "sent"
+    TRASH = "trash"
+    SPAM = "spam"
+    JUNK = "junk"
+    DELETED = "deleted"
+
+    FOLDERS = [
+        (INBOX, "Inbox"),
+        (SENT, "Sent"),
+        (TRASH, "Trash"),
+        (SPAM, "Spam"),
+        (JUNK, "Junk"),
+        (DELETED, "Deleted"),
+    ]
+
+    # Flags
+    FAVORITE = 1
+    RECEIVED = 2
+
+    user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE, related_name="mailboxEntries")
+    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE, related_name="mailboxEntries")
+    folder = models.CharField(max_length=10, choices=FOLDERS, default=INBOX)
+    flags = models.PositiveSmallIntegerField(default=0)
+
+    # Copied from the email transfer so that a folder is listed straight from the index
+    dateSent = models.DateTimeField(default=now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MailboxEntryQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "emailTransfer"], name="unique_mailbox_entry"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "folder", "dateSent", "id"], name="mailbox_user_folder_date_idx"),
+        ]
+
+
+# Per user badge counts, kept in sync with the mailbox entries and read statuses so that
+# they can be served with a single primary key read. The version goes up with every change
+# to the mailbox of the user and keys the cached listings. Compacted is the id of the newest
+# change taken out of the change journal of the user.
+class MailboxCounter(models.Model):
+    user = models.OneToOneField(to=CustomUser, on_delete=models.CASCADE, primary_key=True, related_name="mailboxCounter")
+    unread_inbox = models.IntegerField(default=0)
+    trash = models.IntegerField(default=0)
+    spam = models.IntegerField(default=0)
+    junk = models.IntegerField(default=0)
+    favorites = models.IntegerField(default=0)
+    version = models.PositiveBigIntegerField(default=0)
+    compacted = models.PositiveBigIntegerField(default=0)
+
 
+# The change journal of a user: an email transfer delivered to them, read or unread, moved,
+# (un)favorited or permanently deleted in their mailbox. The rows of a user are appended in
+# the order their changes commit, so clients sync by asking for the changes after the last
+# one they saw (see journal.py). Moves carry the whole new state of the entry.
+class MailboxChange(models.Model):
 
-class Favorites(models.Model):
-    favoriter = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
-    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE)
+    # Kinds
+    DELIVERED = "delivered"
+    READ = "read"
+    UNREAD = "unread"
+    MOVED = "moved"
+    DELETED = "deleted"
 
-class Junk(models.Model):
-    junker = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
-    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE)
+    KINDS = [
+        (DELIVERED, "Delivered"),
+        (READ, "Read"),
+        (UNREAD, "Unread"),
+        (MOVED, "Moved"),
+        (DELETED, "Deleted"),
+    ]
 
-class Trash(models.Model):
-    deleter = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
-    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE)
+    user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE, related_name="mailboxChanges")
+    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE, related_name="mailboxChanges")
+    kind = models.CharField(max_length=10, choices=KINDS)
+    folder = models.CharField(max_length=10, choices=MailboxEntry.FOLDERS, blank=True, default="")
+    flags = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"], name="mailbox_change_user_idx"),
+        ]
+
+
+# A resumable upload of an attachment. The chunks are appended to a partial file at the
+# current offset and, once every byte has arrived, the file becomes an attachment that a
+# draft or a sent email refers to by the id of the upload.
+class Upload(models.Model):
+
+    # Statuses
+    PENDING = "pending"
+    COMPLETE = "complete"
+
+    STATUSES = [
+        (PENDING, "Pending"),
+        (COMPLETE, "Complete"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE, related_name="uploads")
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    file = models.FileField(upload_to="attachments/", null=True, blank=True)
+    blob = models.ForeignKey(null=True, blank=True, to=Blob, on_delete=models.PROTECT, related_name="uploads")
+
+    # The request writing a chunk at the offset, see uploads.claim
+    writer = models.CharField(max_length=32, blank=True, default="")
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+
+# A unit of background work, run by the `run_jobs` workers (see jobs.py). A job with a key
+# is only queued once, and a job that fails is retried with backoff until it runs out of
+# attempts.
+class Job(models.Model):
+
+    # Statuses
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    name = models.CharField(max_length=100)
+    queue = models.CharField(max_length=50, default="default")
+    key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=now)
+    locked_by = models.CharField(max_length=100, blank=True, default="")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_at"], name="job_status_run_at_idx"),
+        ]
+
+
+# The lock of a job queue with a concurrency limit: the workers claim its jobs one after the
+# other while holding the row, so they never run more than the limit between them.
+class JobQueue(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+
+
+# A push event raised by a background job, relayed through the database to the processes
+# holding the event streams when the broker can't reach them (see notifications.py).
+class PushEvent(models.Model):
+    user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE, related_name="pushEvents")
+    event = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
 
-class Spam(models.Model):
-    spammer = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
-    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE)
 
 class Drafts(models.Model):
     drafter = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
     email = models.ForeignKey(to=Email, on_delete=models.CASCADE)
-
-class Deleted(models.Model):
-    deleter = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
-    emailTransfer = models.ForeignKey(to=EmailTransfer, on_delete=models.CASCADE)
\ No newline at end of file
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from .models import PushEvent
+
+
+# Push notifications of mailbox changes. The mailbox operations call `notify` inside their
+# transaction and the events are handed to the broker once it commits, which fans them out
+# to the streams the user has open (see push.py). Events are small: the ids of the emails
+# that changed and their new state, the client fetches anything else it needs.
+#
+# The background jobs run in the `run_jobs` workers, which hold no streams. Unless the broker
+# reaches every process, the events of a job are written to the PushEvent table in the
+# transaction of the job, and the processes holding streams poll it for them.
+
+# Events
+DELIVERY = "delivery"
+READ = "read"
+FOLDER = "folder"
+
+# Events queued for a slow client before its stream is told to resync
+QUEUE_SIZE = 100
+
+# The event that replaces the events a slow client missed
+RESYNC = {"type": "resync"}
+
+# How long the relayed events are kept, the streams poll for them every PUSH_RELAY_INTERVAL
+RELAY_RETENTION = timedelta(minutes=5)
+
+# The events raised by the job running in this thread, when they are relayed
+local = threading.local()
+
+
+class Subscription:
+    """
+    The events of one user for one open stream, queued on the event loop of the stream
+    """
+
+    def __init__(self, userID, loop):
+        self.userID = userID
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def put(self, event):
+        """
+        It queues an event, from the thread of the event loop
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+
+            # The client fell behind, it refetches its mailbox instead of the missed events
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """
+    Hands the events to the streams open in this process. Events can be published from any
+    thread, they are passed to the event loop of each stream. The events of the background
+    jobs come through the database (see `relayed`).
+    """
+
+    # Whether the events published in one process reach the streams of the others
+    shared = False
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+        self.relay = None
+
+    def subscribe(self, userID):
+        """
+        Open a subscription to the events of the user, from a running event loop
+        """
+        loop = asyncio.get_running_loop()
+        subscription = Subscription(userID, loop)
+
+        with self.lock:
+            self.subscriptions[userID].add(subscription)
+
+        if not self.shared and (self.relay is None or self.relay.done() or self.relay.get_loop() is not loop):
+            self.relay = loop.create_task(self.poll_relayed())
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.userID)
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self.subscriptions[subscription.userID]
+
+    def publish(self, userID, event):
+        """
+        Send an event to every stream of the user
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(userID, ()))
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+
+                # The event loop of the stream has been closed
+                self.unsubscribe(subscription)
+
+    def connections(self):
+        """
+        The number of streams open in this process
+        """
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    async def poll_relayed(self):
+        """
+        It publishes the events relayed by the background jobs to the streams of this
+        process, for as long as it has any
+        """
+        cursor = await sync_to_async(RelayCursor)()
+
+        while self.connections():
+            await asyncio.sleep(settings.PUSH_RELAY_INTERVAL)
+
+            for userID, event in await sync_to_async(cursor.fetch)():
+                self.publish(userID, event)
+
+
+class RelayCursor:
+    """
+    How far a process has read the relayed events. The jobs commit in any order, so an event
+    can become visible after events with greater ids: the ids skipped over are looked for
+    again at every fetch, until they are older than RELAY_RETENTION (the job rolled back).
+    """
+
+    def __init__(self):
+        self.lastID = PushEvent.objects.aggregate(last=Max("id"))["last"] or 0
+        self.gaps = {}
+
+    def fetch(self):
+        """
+        :return: The (user id, event) of the relayed events committed since the last fetch.
+        """
+        lookup = Q(id__gt=self.lastID)
+
+        if self.gaps:
+            lookup |= Q(id__in=list(self.gaps))
+
+        events = []
+        fetchedAt = time.monotonic()
+
+        for eventID, userID, event in PushEvent.objects.filter(lookup).order_by("id").values_list(
+            "id", "user_id", "event"
+        ):
+            if eventID > self.lastID:
+                self.gaps.update(dict.fromkeys(range(self.lastID + 1, eventID), fetchedAt))
+                self.lastID = eventID
+            else:
+                del self.gaps[eventID]
+
+            events.append((userID, event))
+
+        expiredAt = fetchedAt - RELAY_RETENTION.total_seconds()
+        self.gaps = {eventID: skippedAt for eventID, skippedAt in self.gaps.items() if skippedAt > expiredAt}
+
+        return events
+
+
+class RedisBroker(InProcessBroker):
+    """
+    Publishes the events on a Redis channel that every process listens to, so that they
+    reach the streams whatever worker made the change. Each process holds a single Redis
+    subscription and fans the events out to its own streams.
+    """
+
+    CHANNEL = "dremail:events"
+    shared = True
+
+    def __init__(self, url=None):
+        import redis
+
+        super().__init__()
+        self.url = url or settings.REDIS_URL
+        self.client = redis.Redis.from_url(self.url)
+        self.listener = None
+
+    def subscribe(self, userID):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+        return super().subscribe(userID)
+
+    def publish(self, userID, event):
+        self.client.publish(self.CHANNEL, json.dumps([userID, event]))
+
+    async def listen(self):
+        import redis.asyncio
+
+        pubsub = redis.asyncio.Redis.from_url(self.url).pubsub()
+        await pubsub.subscribe(self.CHANNEL)
+
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                userID, event = json.loads(message["data"])
+                super().publish(userID, event)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    """
+    The broker of this process, of the class named by the PUSH_BROKER setting
+    """
+    return import_string(settings.PUSH_BROKER)()
+
+
+def notify(userID, eventType, **data):
+    """
+    Publish an event to the user once the current transaction commits
+
+    :param userID: The id of the user whose mailbox changed
+    :param eventType: DELIVERY, READ or FOLDER
+    :param data: The content of the event
+    """
+    event = {"type": eventType, **data}
+
+    if getattr(local, "relayed", None) is not None:
+        local.relayed.append(PushEvent(user_id=userID, event=event))
+    else:
+        transaction.on_commit(lambda: get_broker().publish(userID, event))
+
+
+@contextmanager
+def relayed():
+    """
+    The events raised in the block are written to the database, in the current transaction,
+    for the processes holding the streams to publish. A no-op when the broker reaches every
+    process.
+    """
+    if get_broker().shared:
+        yield
+        return
+
+    local.relayed = []
+
+    try:
+        yield
+        PushEvent.objects.bulk_create(local.relayed)
+    finally:
+        local.relayed = None
+
+
+def prune_relayed(retention=RELAY_RETENTION):
+    """
+    It removes the relayed events that every stream has had the time to poll
+
+    :return: The number of events removed.
+    """
+    return PushEvent.objects.filter(created_at__lt=now() - retention).delete()[0]
@@ -0,0 +1,205 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+# Keyset pagination for the mailbox listings. Pages are ordered newest first on
+# (dateSent, id) and the position in the listing is carried by an opaque cursor,
+# so neither an OFFSET scan nor a COUNT(*) is needed to serve a page.
+class MailboxCursorPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    invalid_cursor_message = "Invalid cursor"
+
+    # The fields the listings are ordered and paged on
+    ordering = ("dateSent", "id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        It returns the page of the queryset that follows (or precedes) the position in the cursor
+
+        :param queryset: The queryset that is being paginated
+        :param request: The request object
+        :param view: The view that is paginating
+        :return: The objects on the requested page.
+        """
+        self.setup(request, view)
+
+        # Only count the listing when the client explicitly asks for it
+        if request.query_params.get(self.count_query_param) == "true":
+            self.count = queryset.count()
+
+        return self.finish(list(self.page_queryset(queryset)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        The same page as `paginate_queryset`, read with the async ORM
+        """
+        self.setup(request, view)
+
+        if request.query_params.get(self.count_query_param) == "true":
+            self.count = await queryset.acount()
+
+        return self.finish([obj async for obj in self.page_queryset(queryset)])
+
+    def setup(self, request, view):
+        """
+        Read the page size and the cursor of the request
+        """
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.dateField, self.idField = self.ordering
+        self.count = None
+
+        self.cursor = self.decode_cursor(request)
+        self.reverse = self.cursor is not None and self.cursor["reverse"]
+
+    def page_queryset(self, queryset):
+        """
+        The queryset of the objects on the page, plus one to find out if there is another page
+        """
+        if self.cursor is not None:
+            queryset = queryset.filter(self.position_filter(self.cursor))
+
+        # Walking backwards reads the listing oldest first and flips the page afterwards
+        if self.reverse:
+            queryset = queryset.order_by(self.dateField, self.idField)
+        else:
+            queryset = queryset.order_by(f"-{self.dateField}", f"-{self.idField}")
+
+        return queryset[:self.page_size + 1]
+
+    def finish(self, results):
+        """
+        Cut the fetched objects down to the page and work out the links around it
+        """
+        hasMore = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if self.reverse:
+            self.page.reverse()
+            self.hasNext, self.hasPrevious = True, hasMore
+        else:
+            self.hasNext, self.hasPrevious = hasMore, self.cursor is not None
+
+        return self.page
+
+    def get_page_size(self, request):
+        """
+        The requested page size, capped at `max_page_size`
+        """
+        try:
+            pageSize = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        if pageSize <= 0:
+            return self.page_size
+
+        return min(pageSize, self.max_page_size)
+
+    def position_filter(self, cursor):
+        """
+        Build the keyset condition selecting the objects after (or before) the cursor position
+        """
+        lookup = "gt" if cursor["reverse"] else "lt"
+
+        return Q(**{f"{self.dateField}__{lookup}": cursor["dateSent"]}) | Q(
+            **{self.dateField: cursor["dateSent"], f"{self.idField}__{lookup}": cursor["id"]}
+        )
+
+    def decode_cursor(self, request):
+        """
+        Turn the opaque cursor of the request back into a position, or None on the first page
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+
+        if not encoded:
+            return None
+
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            cursor = {
+                "dateSent": parse_datetime(position["d"]),
+                "id": int(position["i"]),
+                "reverse": bool(position.get("r", False)),
+            }
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if cursor["dateSent"] is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        return cursor
+
+    def encode_cursor(self, obj, reverse):
+        """
+        Build the url pointing at the page after (or before) the given object
+        """
+        dateSent = getattr(obj, self.dateField)
+        objectID = getattr(obj, self.idField)
+
+        position = {"d": dateSent.isoformat(), "i": objectID}
+        if reverse:
+            position["r"] = True
+
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(position, separators=(",", ":")).encode("ascii")
+        ).decode("ascii")
+
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.hasNext or not self.page:
+            return None
+
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.hasPrevious:
+            return None
+
+        # An empty page past the end of the listing leads back to the first page
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_data(self, data):
+        paginated = OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ])
+
+        if self.count is not None:
+            paginated["count"] = self.count
+            paginated.move_to_end("count", last=False)
+
+        return paginated
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "count": {"type": "integer", "example": 123},
+                "next": {"type": "string", "nullable": True},
+                "previous": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
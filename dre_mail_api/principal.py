@@ -0,0 +1,39 @@
+from .models import EmailGroup
+
+
+# The identity of the user making a request, loaded once and shared by the views and
+# serializers handling the request instead of fetching the user again each time.
+class Principal:
+
+    def __init__(self, user):
+        self.user = user
+        self.id = user.id
+
+    @property
+    def group_ids(self):
+        """
+        The ids of the groups the user is a member of, as a query to use as a subquery
+        """
+        return EmailGroup.members.through.objects.filter(customuser_id=self.id).values_list("emailgroup_id", flat=True)
+
+
+def get_principal(request):
+    """
+    The principal of the request, created from the authenticated user on first use
+
+    :param request: The request being handled
+    :return: The Principal of the request.
+    """
+    principal = getattr(request, "_principal", None)
+
+    if principal is None or principal.id != request.user.id:
+        principal = request._principal = Principal(request.user)
+
+    return principal
+
+
+class PrincipalMixin:
+
+    @property
+    def principal(self):
+        return get_principal(self.request)
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import time
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .async_views import authenticate_token
+from . import notifications
+
+
+# Server-Sent Events streams of the mailbox changes, served by the ASGI application next
+# to Django. An idle stream costs a queue and a task waiting on it, so a single worker can
+# hold thousands of them; the events come from the broker (see notifications.py).
+
+# How long the browser waits before reconnecting a dropped stream, in milliseconds
+RETRY = 5000
+
+
+def push_router(application):
+    """
+    An ASGI application serving the event streams at PUSH_PATH, and every other request
+    with the given (Django) application
+    """
+    async def router(scope, receive, send):
+        if scope["type"] == "http" and scope["path"].rstrip("/") == settings.PUSH_PATH:
+            return await events(scope, receive, send)
+
+        return await application(scope, receive, send)
+
+    return router
+
+
+def raw_token(scope):
+    """
+    The access token of the request: the Authorization header, or the `token` query
+    parameter since browsers can't set headers on an EventSource
+    """
+    for name, value in scope["headers"]:
+        if name == jwt_settings.AUTH_HEADER_NAME.lower().removeprefix("http_").replace("_", "-").encode():
+            parts = value.decode("latin1").split()
+
+            if len(parts) == 2 and parts[0] in jwt_settings.AUTH_HEADER_TYPES:
+                return parts[1]
+
+    tokens = parse_qs(scope.get("query_string", b"").decode("latin1")).get("token")
+
+    return tokens[0] if tokens else None
+
+
+def format_event(event):
+    """
+    An event in the text/event-stream format
+    """
+    data = dict(event)
+    eventType = data.pop("type")
+
+    return f"event: {eventType}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+async def respond(send, statusCode, detail):
+    await send({
+        "type": "http.response.start",
+        "status": statusCode,
+        "headers": [(b"content-type", b"application/json")],
+    })
+    await send({"type": "http.response.body", "body": json.dumps({"detail": detail}).encode()})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def events(scope, receive, send):
+    """
+    Stream the mailbox changes of the user of the access token until the client goes away
+    or the token expires (the client then reconnects with a fresh one)
+    """
+    if scope["method"] != "GET":
+        return await respond(send, 405, f'Method "{scope["method"]}" not allowed.')
+
+    rawToken = raw_token(scope)
+
+    if rawToken is None:
+        return await respond(send, 401, "Authentication credentials were not provided.")
+
+    try:
+        user, token = await authenticate_token(rawToken)
+    except (APIException, TokenError) as e:
+        return await respond(send, 401, str(e))
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + token["exp"] - time.time()
+
+    broker = notifications.get_broker()
+    subscription = broker.subscribe(user.id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": f"retry: {RETRY}\n\n".encode(), "more_body": True})
+
+        while not disconnected.done():
+            timeout = min(settings.PUSH_HEARTBEAT, deadline - loop.time())
+
+            if timeout <= 0:
+                break
+
+            nextEvent = asyncio.ensure_future(subscription.get())
+            await asyncio.wait({nextEvent, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if nextEvent.done():
+                body = format_event(nextEvent.result())
+            else:
+                nextEvent.cancel()
+
+                # A comment keeps the proxies from closing an idle stream
+                body = b": keep-alive\n\n"
+
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+
+        if not disconnected.done():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    finally:
+        broker.unsubscribe(subscription)
+        disconnected.cancel()
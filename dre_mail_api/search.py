@@ -0,0 +1,188 @@
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import BaseFilterBackend
+
+
+# Full text search over the email transfers. Every transfer gets a document made of
+# the subject, the message and the names of the sender and recipient, kept in an
+# index that is specific to the database backend:
+#   - Postgres: a weighted `search_vector` tsvector column with a GIN index
+#   - SQLite: an FTS5 virtual table keyed by the transfer id (used for local testing)
+
+TRANSFER_TABLE = "dre_mail_api_emailtransfer"
+FTS_TABLE = "dre_mail_api_emailtransfer_fts"
+INDEX_BATCH_SIZE = 500
+
+
+def search_terms(query):
+    """
+    Split a search query into the words that are matched as prefixes
+
+    :param query: The raw search query
+    :return: The list of words in the query.
+    """
+    return re.findall(r"\w+", query or "")
+
+
+class PostgresSearchBackend:
+
+    document = f"""
+        SELECT
+            setweight(to_tsvector('simple', coalesce(e.subject, '')), 'A') ||
+            setweight(to_tsvector('simple', concat_ws(' ',
+                s.first_name, s.last_name, s.username, s.email,
+                r.first_name, r.last_name, r.username, r.email
+            )), 'B') ||
+            setweight(to_tsvector('simple', coalesce(e.message, '')), 'C')
+        FROM dre_mail_api_email e
+        JOIN dre_mail_api_customuser s ON s.id = t.sender_id
+        LEFT JOIN dre_mail_api_customuser r ON r.id = t.recipient_id
+        WHERE e.id = t.email_id
+    """
+
+    def install(self, cursor):
+        cursor.execute(f"ALTER TABLE {TRANSFER_TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector")
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS transfer_search_vector_idx ON {TRANSFER_TABLE} USING GIN (search_vector)"
+        )
+
+    def uninstall(self, cursor):
+        cursor.execute(f"ALTER TABLE {TRANSFER_TABLE} DROP COLUMN IF EXISTS search_vector")
+
+    def index(self, cursor, transferIDs=None):
+        if transferIDs is None:
+            cursor.execute(f"UPDATE {TRANSFER_TABLE} AS t SET search_vector = ({self.document})")
+        else:
+            cursor.execute(
+                f"UPDATE {TRANSFER_TABLE} AS t SET search_vector = ({self.document}) WHERE t.id = ANY(%s)",
+                [list(transferIDs)]
+            )
+
+    def search(self, queryset, terms):
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+
+        return queryset.filter(
+            RawSQL(
+                f"{TRANSFER_TABLE}.search_vector @@ to_tsquery('simple', %s)",
+                [tsquery], output_field=BooleanField()
+            )
+        ).annotate(
+            search_rank=RawSQL(
+                f"ts_rank({TRANSFER_TABLE}.search_vector, to_tsquery('simple', %s))",
+                [tsquery], output_field=FloatField()
+            )
+        )
+
+
+class SQLiteSearchBackend:
+
+    document = f"""
+        SELECT t.id, e.subject, e.message,
+            s.first_name || ' ' || s.last_name || ' ' || s.username || ' ' || s.email || ' ' ||
+            coalesce(r.first_name || ' ' || r.last_name || ' ' || r.username || ' ' || r.email, '')
+        FROM {TRANSFER_TABLE} t
+        JOIN dre_mail_api_email e ON e.id = t.email_id
+        JOIN dre_mail_api_customuser s ON s.id = t.sender_id
+        LEFT JOIN dre_mail_api_customuser r ON r.id = t.recipient_id
+    """
+
+    def install(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            "USING fts5(subject, message, participants, tokenize='unicode61')"
+        )
+
+    def uninstall(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+    def index(self, cursor, transferIDs=None):
+        if transferIDs is None:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(f"INSERT INTO {FTS_TABLE} (rowid, subject, message, participants) {self.document}")
+            return
+
+        transferIDs = list(transferIDs)
+        placeholders = ", ".join(["%s"] * len(transferIDs))
+
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", transferIDs)
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, subject, message, participants) "
+            f"{self.document} WHERE t.id IN ({placeholders})",
+            transferIDs
+        )
+
+    def search(self, queryset, terms):
+        match = " ".join(f'"{term}"*' for term in terms)
+
+        # bm25 is lower for better matches; subject and participants weigh more than the message
+        return queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match])
+        ).annotate(
+            search_rank=RawSQL(
+                f"SELECT -bm25({FTS_TABLE}, 10.0, 1.0, 5.0) FROM {FTS_TABLE} "
+                f"WHERE {FTS_TABLE} MATCH %s AND rowid = {TRANSFER_TABLE}.id",
+                [match], output_field=FloatField()
+            )
+        )
+
+
+BACKENDS = {
+    "postgresql": PostgresSearchBackend,
+    "sqlite": SQLiteSearchBackend,
+}
+
+
+def get_search_backend(conn=None):
+    """
+    Return the search backend for the vendor of the given database connection
+    """
+    return BACKENDS[(conn or connection).vendor]()
+
+
+def index_transfers(transferIDs=None):
+    """
+    (Re)build the search documents of the given email transfers, or of every transfer
+
+    :param transferIDs: The ids of the transfers to index, None to index all of them
+    """
+    backend = get_search_backend()
+
+    with connection.cursor() as cursor:
+
+        if transferIDs is None:
+            backend.index(cursor)
+            return
+
+        # Index in batches to stay under the query parameter limits
+        transferIDs = list(transferIDs)
+        for start in range(0, len(transferIDs), INDEX_BATCH_SIZE):
+            backend.index(cursor, transferIDs[start:start + INDEX_BATCH_SIZE])
+
+
+def search_transfers(queryset, query):
+    """
+    Restrict an email transfer queryset to the transfers matching every word of the query
+    as a prefix, annotated with a `search_rank` that is higher for better matches
+    """
+    terms = search_terms(query)
+
+    if not terms:
+        return queryset.none()
+
+    return get_search_backend().search(queryset, terms)
+
+
+# Replaces the icontains SearchFilter on the email transfers with the full text index
+class FullTextSearchFilter(BaseFilterBackend):
+    search_param = "search"
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param)
+
+        if not query:
+            return queryset
+
+        return search_transfers(queryset.involving(request.user), query)
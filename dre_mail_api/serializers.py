@@ -1,10 +1,99 @@
+import os
+
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 from dre_mail_api.customResponses import CustomResponses
 from .models import *
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils.timezone import now
+from .principal import get_principal
+from . import avatars, blobs, jobs, mailbox, uploads
+
+
+# Serializers that render related objects declare them here so that a listing can load
+# every relation up front instead of lazily fetching them once per row
+class EagerLoadingMixin:
+    select_related_fields = []
+    prefetch_related_fields = {}
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, user):
+        """
+        It shapes the queryset so that serializing it costs a fixed number of queries
+        
+        :param queryset: The queryset that is going to be serialized
+        :param user: The user making the request, used to annotate the read status
+        :return: The queryset with its relations loaded eagerly.
+        """
+        # select_related() without fields would follow every foreign key
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+
+        # Load the nested objects with a queryset shaped by their own serializer
+        for relation, serializerClass in cls.prefetch_related_fields.items():
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    relation,
+                    queryset=serializerClass.setup_eager_loading(
+                        serializerClass.Meta.model.objects.all(), user
+                    )
+                )
+            )
+
+        if "has_read" in cls._declared_fields:
+            queryset = queryset.with_read_status(user)
+
+        return queryset
+
+# Files are only served by the authorized download endpoints, so they are rendered as the
+# url of the endpoint instead of their media url
+class ProtectedFileMixin:
+
+    def __init__(self, view_name, **kwargs):
+        self.view_name = view_name
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        request = self.context.get("request")
+
+        if not value or request is None:
+            return super().to_representation(value)
+
+        return reverse(self.view_name, kwargs={"pk": value.instance.pk}, request=request)
+
+
+class ProtectedFileField(ProtectedFileMixin, serializers.FileField):
+    pass
+
+
+class ProtectedImageField(ProtectedFileMixin, serializers.ImageField):
+    pass
+
+
+# The urls of the resized variants of the avatar of a user, below its download endpoint
+class AvatarVariantsField(serializers.Field):
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "*"
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, user):
+        request = self.context.get("request")
+
+        if not user.avi or request is None:
+            return None
+
+        return avatars.variant_urls(user, reverse("users-avi", kwargs={"pk": user.pk}, request=request))
+
 
 """--------------- AUTH SERIALIZERS ---------------"""
 
 class RegisterUserSerializer(serializers.ModelSerializer):
+    avi = ProtectedImageField("users-avi", required=False, allow_null=True)
+    avi_variants = AvatarVariantsField()
     first_name = serializers.CharField(required=True)
     last_name = serializers.CharField(required=True)
     email = serializers.CharField(required=True)
@@ -12,7 +101,7 @@ class RegisterUserSerializer(serializers.ModelSerializer):
  
     class Meta:
         model = CustomUser
-        fields = ('id', 'first_name', 'last_name', 'username', 'password', 'email', 'avi')
+        fields = ('id', 'first_name', 'last_name', 'username', 'password', 'email', 'avi', 'avi_variants')
         extra_kwargs = {
             'password': {"write_only": True}
         }
@@ -42,6 +131,10 @@ class RegisterUserSerializer(serializers.ModelSerializer):
             user.avi = validated_data.get('avi')
             user.save()
 
+            # Resize the avatar once, rather than on every download
+            if user.avi:
+                avatars.enqueue_variants(user)
+
             return user
 
         except Exception as e:
@@ -52,9 +145,24 @@ class RegisterUserSerializer(serializers.ModelSerializer):
 
 # It creates a new user and a new User, and then saves them both
 class UserSerializer(serializers.ModelSerializer):
+    avi = ProtectedImageField("users-avi", required=False, allow_null=True)
+    avi_variants = AvatarVariantsField()
+
     class Meta:
         model = CustomUser
-        fields = ['id', 'first_name', 'last_name', 'username', 'email', "avi"]
+        fields = ['id', 'first_name', 'last_name', 'username', 'email', "avi", "avi_variants"]
+
+    def update(self, instance, validated_data):
+        if "avi" not in validated_data:
+            return super().update(instance, validated_data)
+
+        avatars.delete_variants(instance)
+        instance = super().update(instance, validated_data)
+
+        if instance.avi:
+            avatars.enqueue_variants(instance)
+
+        return instance
 
 
 # It's a serializer that validates the old password, the new password, and the confirmation of the new
@@ -148,19 +256,23 @@ class UpdateUserSerializer(serializers.ModelSerializer):
 
 # This class is used to update the user's first name, last name, email, and username
 class UpdateAVISerializer(serializers.ModelSerializer):
+    avi = ProtectedImageField("users-avi")
+    avi_variants = AvatarVariantsField()
 
     class Meta:
         model = CustomUser
-        fields = ['avi']
+        fields = ['avi', 'avi_variants']
 
     def update(self, instance, validated_data):
 
-        # delete current image from directory
+        # delete current image and its variants from directory
+        avatars.delete_variants(instance)
         instance.avi.delete()
 
-        # store the new image
+        # store the new image and resize it
         instance.avi = validated_data['avi']
         instance.save()
+        avatars.enqueue_variants(instance)
 
         return instance
 
@@ -175,7 +287,7 @@ class EmailGroupSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
 
-        currentUser = CustomUser.objects.get(id=self.context['request'].user.id)
+        currentUser = get_principal(self.context['request']).user
 
         #  provide the info for the group
         emailGroup = EmailGroup(
@@ -208,28 +320,127 @@ class EmailGroupMemberSerializer(serializers.ModelSerializer):
 
 
 # This is a serializer for the Email model, and it has an attachment field that is a FileField.
+# The attachment is either uploaded with the email or refers to a finished resumable upload.
 class EmailSerializer(serializers.ModelSerializer):
-    attachment = serializers.FileField(required=False)
+    attachment = ProtectedFileField("email-attachment", required=False)
+    upload_id = serializers.UUIDField(write_only=True, required=False)
 
     class Meta:
         model = Email
-        fields = "__all__"
+        exclude = ["blob"]
+        read_only_fields = ["attachmentName"]
+
+    def validate_upload_id(self, value):
+        """
+        The upload must be a finished upload of the user
 
-class EmailTransferSerializer(serializers.ModelSerializer):
+        :param value: The id of the upload
+        :return: The upload.
+        """
+        upload = Upload.objects.filter(
+            id=value, owner_id=self.context['request'].user.id, status=Upload.COMPLETE
+        ).first()
+
+        if upload is None:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse("Upload with specified ID does not exist or is not finished.")
+            )
+
+        return upload
+
+    def create(self, validated_data):
+        validated_data.update(email_attachment(validated_data))
+        validated_data.pop("upload_id", None)
+
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        if "upload_id" in validated_data or "attachment" in validated_data:
+            validated_data.update(email_attachment(validated_data))
+            validated_data.pop("upload_id", None)
+
+        return super().update(instance, validated_data)
+
+
+def email_attachment(emailData):
+    """
+    The attachment fields of validated email data. An uploaded file is stored in the blob
+    of its content, the upload it refers to already is (the blob is shared rather than copied).
+
+    :param emailData: The validated email data
+    :return: The attachment, attachmentName and blob of the email.
+    """
+    upload = emailData.get("upload_id")
+
+    if upload is not None:
+        return {"attachment": upload.file.name, "attachmentName": upload.filename, "blob": upload.blob}
+
+    file = emailData.get("attachment")
+
+    if not file:
+        return {"attachment": None, "attachmentName": "", "blob": None}
+
+    blob = blobs.store(file)
+
+    return {
+        "attachment": blobs.blob_name(blob.sha256),
+        "attachmentName": os.path.basename(file.name),
+        "blob": blob
+    }
+
+
+# This class is used to start a resumable upload and follow its progress
+class UploadSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Upload
+        fields = ["id", "filename", "size", "offset", "status", "created_at"]
+        read_only_fields = ["offset", "status"]
+
+    def validate_filename(self, value):
+        return os.path.basename(value)
+
+    def validate_size(self, value):
+        if value <= 0 or value > settings.MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse(f"The size must be between 1 and {settings.MAX_UPLOAD_SIZE} bytes.")
+            )
+
+        return value
+
+    def create(self, validated_data):
+        upload = Upload.objects.create(owner=get_principal(self.context['request']).user, **validated_data)
+        uploads.start(upload)
+
+        return upload
+
+class EmailTransferSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     email = EmailSerializer()
     recipient = UserSerializer(read_only=True)
     group = EmailGroupSerializer(read_only=True)
     sender = UserSerializer(read_only=True)
     recipient_id = serializers.IntegerField(write_only=True, required=False)
     group_id = serializers.IntegerField(write_only=True, required=False)
+    to = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=False)
+    cc = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=False)
+    bcc = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=False)
+    group_ids = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=False)
     has_read = serializers.SerializerMethodField()
 
+    select_related_fields = ["email", "sender", "recipient", "group"]
+
     class Meta:
         model = EmailTransfer
-        fields = ["id", "sender", "recipient", "group", 'email', "has_read", "dateSent", "recipient_id", "group_id"]
+        fields = [
+            "id", "sender", "recipient", "group", 'email', "has_read", "dateSent", "recipientType",
+            "recipient_id", "group_id", "to", "cc", "bcc", "group_ids"
+        ]
         extra_kwargs = {
             "dateSent": {
                 "read_only": True
+            },
+            "recipientType": {
+                "read_only": True
             }
         }
 
@@ -241,81 +452,140 @@ class EmailTransferSerializer(serializers.ModelSerializer):
         :param obj: The object that is being serialized
         :return: The has_read field is being returned.
         """
+
+        # Use the read status annotated onto the queryset when it is available
+        if hasattr(obj, "has_read"):
+            return obj.has_read
+
         recipient_id = self.context['request'].user.id
         return obj.hasRead.filter(id=recipient_id).exists()
 
-    def validate_recipient_id(self, value):
+    @property
+    def sends_to_many(self):
         """
-        If the user exists, and the user is not the same as the user sending the email, then return the
-        value
-        
-        :param value: The value of the field being validated
-        :return: The value of the recipient.
+        Whether the email is addressed with the recipient lists rather than a single recipient_id or group_id
         """
-        try:
-            
-            user = self.context['request'].user
+        return any(field in self.validated_data for field in ("to", "cc", "bcc", "group_ids"))
+
+    def validate(self, attrs):
+        """
+        It checks every recipient and group of the email with one query each, and resolves them
+        into the list of (recipientType, recipient, group) the email is sent to
+
+        :param attrs: The data being validated
+        :return: The validated data with the resolved deliveries.
+        """
+        user = self.context['request'].user
 
-            if CustomUser.objects.filter(id=value).exists() == False:
-                raise CustomResponses.errorResponse("User with specified ID does not exist.")
+        # The single recipient_id and group_id are sent to like the first entry of the lists
+        toIDs = attrs.get("to", [])
+        if "recipient_id" in attrs:
+            toIDs = [attrs["recipient_id"]] + toIDs
 
+        groupIDs = attrs.get("group_ids", [])
+        if "group_id" in attrs:
+            groupIDs = [attrs["group_id"]] + groupIDs
 
-            if CustomUser.objects.get(id=user.id) == CustomUser.objects.get(id=value):
-                raise CustomResponses.errorResponse("You cannot send an email to yourself")
+        groupIDs = list(dict.fromkeys(groupIDs))
 
-            
-            return value
-        except Exception as e:
+        # A user listed more than once gets the email once, as the first type they are listed with
+        recipientTypes = {}
+        for recipientType, recipientIDs in (
+            (EmailTransfer.TO, toIDs),
+            (EmailTransfer.CC, attrs.get("cc", [])),
+            (EmailTransfer.BCC, attrs.get("bcc", [])),
+        ):
+            for recipientID in recipientIDs:
+                recipientTypes.setdefault(recipientID, recipientType)
+
+        if not recipientTypes and not groupIDs:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse("Email recipient has not been specified")
+            )
+
+        if user.id in recipientTypes:
             raise serializers.ValidationError(
-                CustomResponses.errorResponse(e)
+                CustomResponses.errorResponse("You cannot send an email to yourself")
             )
 
+        recipients = CustomUser.objects.in_bulk(list(recipientTypes)) if recipientTypes else {}
+        missing = [recipientID for recipientID in recipientTypes if recipientID not in recipients]
+
+        if missing:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse(f"Users with the IDs {missing} do not exist.")
+            )
+
+        groups = EmailGroup.objects.in_bulk(groupIDs) if groupIDs else {}
+        missing = [groupID for groupID in groupIDs if groupID not in groups]
+
+        if missing:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse(f"Groups with the IDs {missing} do not exist.")
+            )
+
+        attrs["deliveries"] = [
+            (recipientType, recipients[recipientID], None) for recipientID, recipientType in recipientTypes.items()
+        ] + [
+            (EmailTransfer.TO, None, groups[groupID]) for groupID in groupIDs
+        ]
+
+        return attrs
+
 
     def create(self, validated_data):
         """
-        It's creating a new email object and saving it to the database. It's creating a new draft object
-        and saving it to the database
+        It stores the email once and creates a transfer for every recipient and group
+        in a single transaction. The transfers are inserted in bulk, so they are delivered
+        here rather than by the post_save signals: the recipients get the email at once,
+        while the fan out to the groups and the search indexing are queued as background jobs.
         
         :param validated_data: It's the data that has been validated by the serializer
-        :return: It's returning the emailTransfer object.
+        :return: The first email transfer, every transfer is kept in `transfers`.
         """
+        sender = self.context['request'].user
 
-        if validated_data.get("recipient_id") is None and validated_data.get("group_id") is None:
-            raise serializers.ValidationError(
-                CustomResponses.errorResponse("Email recipient has not been specified")
+        with transaction.atomic():
+
+            # It's creating a new email object and saving it to the database.
+            email = Email(
+                subject = validated_data['email'].get("subject"),
+                message = validated_data['email'].get("message"),
+                **email_attachment(validated_data['email'])
             )
 
-    
+            email.save()
 
-        # It's creating a new email object and saving it to the database.
-        email = Email(
-            subject = validated_data['email'].get("subject"),
-            message = validated_data['email'].get("message"),
-            attachment = validated_data['email'].get('attachment')
-        )
+            dateSent = now()
 
-        email.save()
+            self.transfers = EmailTransfer.objects.bulk_create(
+                EmailTransfer(
+                    email=email,
+                    sender=sender,
+                    recipient=recipient,
+                    group=group,
+                    recipientType=recipientType,
+                    dateSent=dateSent
+                )
+                for recipientType, recipient, group in validated_data["deliveries"]
+            )
 
-        
-        # It's creating a new draft object and saving it to the database.
-        emailTransfer = EmailTransfer(
-            sender = CustomUser.objects.get(id=self.context['request'].user.id),
-            email = email
-        )
+            mailbox.send(self.transfers, key=f"deliver-groups:{email.id}")
 
-        if validated_data.get("recipient_id") is None:
-            emailTransfer.group = EmailGroup.objects.get(id=validated_data.get("group_id"))
-        else:
-            emailTransfer.recipient = CustomUser.objects.get(id=validated_data.get('recipient_id'))
+            jobs.enqueue(
+                "index_transfers", key=f"index:{email.id}", transferIDs=[transfer.id for transfer in self.transfers]
+            )
 
-        emailTransfer.save()
+        # Nobody has read a new email yet
+        for transfer in self.transfers:
+            transfer.has_read = False
 
-        return emailTransfer
+        return self.transfers[0]
 
 
 # The InboxSerializer class is a ModelSerializer that serializes the EmailTransfer model 
 # for the inbox. It has a nested EmailSerializer and UserSerializer
-class InboxSerializer(serializers.ModelSerializer):
+class InboxSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     email = EmailSerializer(read_only=True)
     sender = UserSerializer(read_only=True)
     group = EmailGroupSerializer(read_only=True)
@@ -323,6 +593,8 @@ class InboxSerializer(serializers.ModelSerializer):
     destination = serializers.ChoiceField(required=True, write_only=True, choices=['favorites', 'junk', 'spam'])
     has_read = serializers.SerializerMethodField()
 
+    select_related_fields = ["email", "sender", "group"]
+
     class Meta:
         model = EmailTransfer
         fields = ["id", "sender", 'group', 'email', "has_read", "dateSent", "email_id", "destination"]
@@ -340,6 +612,11 @@ class InboxSerializer(serializers.ModelSerializer):
         :param obj: The object that is being serialized
         :return: The has_read field is being returned.
         """
+
+        # Use the read status annotated onto the queryset when it is available
+        if hasattr(obj, "has_read"):
+            return obj.has_read
+
         recipient_id = self.context['request'].user.id
         return obj.hasRead.filter(id=recipient_id).exists()
 
@@ -370,12 +647,48 @@ class ReadStatusUpdateSerializers(serializers.ModelSerializer):
             raise serializers.ValidationError(e)
 
 
-class EmailActionSerializer(serializers.ModelSerializer):
+# This class is used to set the read status of many emails at once
+class ReadStatusBatchSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=1000)
+    has_read = serializers.BooleanField()
+
+
+# This class is used to mark every email of a folder as read
+class MarkAllReadSerializer(serializers.Serializer):
+    folder = serializers.ChoiceField(
+        choices=[MailboxEntry.INBOX, MailboxEntry.TRASH, MailboxEntry.SPAM, MailboxEntry.JUNK],
+        default=MailboxEntry.INBOX
+    )
+    up_to = serializers.IntegerField(required=False)
+
+
+# This class is used to move many emails from one folder to another
+class BulkMoveSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=1000)
+    source = serializers.ChoiceField(choices=list(mailbox.MOVES))
+    destination = serializers.ChoiceField(
+        choices=list(dict.fromkeys(folder for folders in mailbox.MOVES.values() for folder in folders))
+    )
+
+    def validate(self, attrs):
+        if attrs["destination"] not in mailbox.MOVES[attrs["source"]]:
+            raise serializers.ValidationError(
+                CustomResponses.errorResponse(
+                    f"Emails cannot be moved from {attrs['source']} to {attrs['destination']}"
+                )
+            )
+
+        return attrs
+
+
+class EmailActionSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     emailTransfer = InboxSerializer(read_only=True)
     email_id = serializers.IntegerField(write_only=True, required=True)
 
+    prefetch_related_fields = {"emailTransfer": InboxSerializer}
+
     class Meta:
-        model = Trash
+        model = MailboxEntry
         fields = ['email_id', 'emailTransfer']
         extra_kwargs = {
             "dateSent": {
@@ -403,39 +716,24 @@ class EmailActionSerializer(serializers.ModelSerializer):
         """
 
         try:
-            endpoint = self.context['request'].get_full_path()
-            endpointType = endpoint.split("/")[-1]
+            # The folder the email is taken out of is set by the view
+            endpointType = self.context['folder']
 
-            # Remove the email from their respective Models
-            
-            # Deleting the email from the trash.
-            if endpointType == "trash":
-       
-                return Trash.objects.get(
-                    deleter=CustomUser.objects.get(id=self.context['request'].user.id),
-                    emailTransfer=EmailTransfer.objects.get(id=validated_data.get("email_id"))
-                ).delete()
-
-            # Deleting the email from spam.
-            elif endpointType == "spam":
-                return Spam.objects.get(
-                    spammer=CustomUser.objects.get(id=self.context['request'].user.id),
-                    emailTransfer=EmailTransfer.objects.get(id=validated_data.get("email_id"))
-                ).delete()
-                
-            # Deleting the email from junk.
-            elif endpointType == 'junk':
-                return Junk.objects.get(
-                    junker=CustomUser.objects.get(id=self.context['request'].user.id),
-                    emailTransfer=EmailTransfer.objects.get(id=validated_data.get("email_id"))
-                ).delete()
-
-            # Deleting the email from favorite.
+            user = self.context['request'].user
+            emailID = validated_data.get("email_id")
+
+            # Taking the email off the favorites.
+            if endpointType == "favorites":
+                updated = mailbox.clear_flag(user, [emailID], MailboxEntry.FAVORITE)
+
+            # Moving the email out of trash, spam or junk.
             else:
-                return Favorites.objects.get(
-                    favoriter=CustomUser.objects.get(id=self.context['request'].user.id),
-                    emailTransfer=EmailTransfer.objects.get(id=validated_data.get("email_id"))
-                ).delete()
+                updated = mailbox.restore(user, [emailID], endpointType)
+
+            if not updated:
+                raise MailboxEntry.DoesNotExist(f"Email with specified ID is not in {endpointType}")
+
+            return MailboxEntry.objects.get(user=user, emailTransfer_id=emailID)
 
         
         except Exception as e:
@@ -444,10 +742,12 @@ class EmailActionSerializer(serializers.ModelSerializer):
 
 # The SentEmailSerializer class is a serializer for the EmailTransfer model. It has a nested
 # serializer for the Email model and a nested serializer for the User model
-class SentEmailSerializer(serializers.ModelSerializer):
+class SentEmailSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     email = EmailSerializer()
     recipient = UserSerializer(read_only=True)
 
+    select_related_fields = ["email", "recipient"]
+
     class Meta:
         model = EmailTransfer
         fields = ["id", "recipient", 'email', "dateSent"]
@@ -459,9 +759,11 @@ class SentEmailSerializer(serializers.ModelSerializer):
 
 
 # It's creating a draft and saving it to the database
-class DraftSerializer(serializers.ModelSerializer):
+class DraftSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     email = EmailSerializer()
 
+    select_related_fields = ["email"]
+
     class Meta:
         model = Drafts
         fields = ['id', 'email']
@@ -479,7 +781,7 @@ class DraftSerializer(serializers.ModelSerializer):
         email = Email(
             subject = validated_data['email'].get("subject"),
             message = validated_data['email'].get("message"),
-            attachment = validated_data['email'].get('attachment')
+            **email_attachment(validated_data['email'])
         )
 
         email.save()
@@ -487,7 +789,7 @@ class DraftSerializer(serializers.ModelSerializer):
         
         # It's creating a new draft object and saving it to the database.
         draft = Drafts(
-            drafter = CustomUser.objects.get(id=self.context['request'].user.id),
+            drafter = get_principal(self.context['request']).user,
             email = email
         )
 
@@ -509,7 +811,8 @@ class DraftSerializer(serializers.ModelSerializer):
 
         instance.email.subject = validated_data['email'].get("subject")
         instance.email.message = validated_data['email'].get("message")
-        instance.email.attachment = validated_data['email'].get('attachment')
+        for field, value in email_attachment(validated_data['email']).items():
+            setattr(instance.email, field, value)
 
         instance.email.save()
 
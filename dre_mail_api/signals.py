@@ -0,0 +1,205 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from .models import *
+from . import authentication, avatars, blacklist, blobs, counters, jobs, journal, mailbox, notifications
+
+
+# The fields of a user that appear in the search documents of their emails
+SEARCHABLE_USER_FIELDS = {"first_name", "last_name", "username", "email"}
+
+# The fields of a user that appear in the mailbox listings of others
+DISPLAYED_USER_FIELDS = SEARCHABLE_USER_FIELDS | {"avi", "avi_token"}
+
+
+"""--------------- DELIVERY ---------------"""
+
+@receiver(post_save, sender=EmailTransfer)
+def deliver_email_transfer(sender, instance, created, **kwargs):
+
+    # File new emails in the inbox of their recipient, the fan out to a group is queued
+    if created:
+        mailbox.send([instance], key=f"deliver-transfer:{instance.id}")
+
+
+"""--------------- USER CACHE ---------------"""
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def forget_cached_user(sender, instance, **kwargs):
+
+    # The authentication reads the users through the cache
+    authentication.forget_user(instance.pk)
+
+
+"""--------------- AVATARS ---------------"""
+
+@receiver(pre_save, sender=CustomUser)
+def renew_avatar_token(sender, instance, **kwargs):
+
+    # A newly uploaded avatar, its file is stored once this save goes on
+    if instance.avi and not instance.avi._committed:
+        instance.avi_token = avatars.new_token()
+
+
+"""--------------- TOKEN BLACKLIST ---------------"""
+
+@receiver(post_save, sender=BlacklistedToken)
+def sync_blacklist_filters(sender, instance, created, **kwargs):
+
+    # The processes check the refresh tokens against their own filter of the blacklist
+    if created:
+        blacklist.blacklist_changed()
+
+
+"""--------------- COUNTERS ---------------"""
+
+@receiver(post_save, sender=CustomUser)
+def create_mailbox_counter(sender, instance, created, **kwargs):
+    if created:
+        MailboxCounter.objects.get_or_create(user=instance)
+
+
+@receiver(m2m_changed, sender=EmailTransfer.hasRead.through)
+def count_read_status_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the unread inbox counts in sync with the read statuses. For removals the
+    pairs that actually exist are worked out before the rows are deleted.
+    """
+    if action not in ("post_add", "pre_remove", "post_remove", "pre_clear", "post_clear"):
+        return
+
+    if action.startswith("pre_"):
+
+        # Select the (user, emailTransfer) pairs that are currently read
+        read = EmailTransfer.hasRead.through.objects.filter(
+            **({"customuser": instance} if reverse else {"emailtransfer": instance})
+        )
+        if pk_set is not None:
+            read = read.filter(**({"emailtransfer__in": pk_set} if reverse else {"customuser__in": pk_set}))
+
+        instance._unreadPairs = list(read.values_list("customuser_id", "emailtransfer_id"))
+        return
+
+    if action == "post_add":
+        pairs = [(instance.id, pk) if reverse else (pk, instance.id) for pk in pk_set]
+    else:
+        pairs = getattr(instance, "_unreadPairs", [])
+
+    if not pairs:
+        return
+
+    selection = Q()
+    for userID, transferID in pairs:
+        selection |= Q(user_id=userID, emailTransfer_id=transferID)
+
+    deltas = counters.read_deltas(selection, read=action == "post_add")
+
+    # The mailbox of every reader changed, even when their unread count did not
+    for userID, _ in pairs:
+        deltas.setdefault(userID, Counter())
+
+    counters.apply_deltas(deltas)
+
+    readIDs = defaultdict(list)
+    for userID, transferID in pairs:
+        readIDs[userID].append(transferID)
+
+    journal.record([
+        change for userID, transferIDs in readIDs.items()
+        for change in journal.read_changes(userID, transferIDs, action == "post_add")
+    ])
+
+    for userID, transferIDs in readIDs.items():
+        notifications.notify(userID, notifications.READ, ids=transferIDs, has_read=action == "post_add")
+
+
+"""--------------- SEARCH INDEX ---------------"""
+
+# The documents are (re)built by background jobs, off the request
+
+@receiver(post_save, sender=EmailTransfer)
+def index_email_transfer(sender, instance, **kwargs):
+    jobs.enqueue("index_transfers", transferIDs=[instance.id])
+
+
+@receiver(post_save, sender=Email)
+def reindex_email(sender, instance, created, **kwargs):
+
+    # A new email has no transfers yet, they are indexed when they are created
+    if created:
+        return
+
+    transferIDs = list(EmailTransfer.objects.filter(email=instance).values_list("id", flat=True))
+
+    if transferIDs:
+        jobs.enqueue("index_transfers", transferIDs=transferIDs)
+
+
+@receiver(pre_save, sender=CustomUser)
+def remember_displayed_fields(sender, instance, update_fields=None, **kwargs):
+
+    # The displayed fields before this save, unless it can't change them (e.g. last_login)
+    instance._previousDisplayed = None
+
+    if instance._state.adding or (update_fields is not None and not DISPLAYED_USER_FIELDS & set(update_fields)):
+        return
+
+    instance._previousDisplayed = CustomUser.objects.filter(pk=instance.pk).values(*DISPLAYED_USER_FIELDS).first()
+
+
+def changed_fields(instance):
+    """
+    The displayed fields of a user that the save changed
+    """
+    previous = getattr(instance, "_previousDisplayed", None)
+
+    if previous is None:
+        return set()
+
+    # The avatar is compared by the name it is stored under, "" when there is none
+    current = {field: getattr(instance, field) for field in DISPLAYED_USER_FIELDS}
+    current["avi"] = instance.avi.name or ""
+
+    return {field for field in DISPLAYED_USER_FIELDS if (previous[field] or "") != current[field]}
+
+
+@receiver(post_save, sender=CustomUser)
+def reindex_participant(sender, instance, created, **kwargs):
+    changed = changed_fields(instance)
+
+    # Only a change to a searchable field changes the documents of their emails
+    if changed & SEARCHABLE_USER_FIELDS:
+        jobs.enqueue("index_participant_transfers", userID=instance.pk)
+
+    # The listings of others embed the profile of the user
+    if changed:
+        jobs.enqueue("expire_participant_listings", userID=instance.pk)
+
+
+"""--------------- BLOB REFERENCES ---------------"""
+
+@receiver(pre_save, sender=Email)
+@receiver(pre_save, sender=Upload)
+def remember_blob(sender, instance, **kwargs):
+
+    # The blob the row referred to before this save
+    instance._previousBlobID = None if instance._state.adding else (
+        sender.objects.filter(pk=instance.pk).values_list("blob_id", flat=True).first()
+    )
+
+
+@receiver(post_save, sender=Email)
+@receiver(post_save, sender=Upload)
+def count_blob_reference(sender, instance, **kwargs):
+    blobs.move_reference(getattr(instance, "_previousBlobID", None), instance.blob_id)
+
+
+@receiver(post_delete, sender=Email)
+@receiver(post_delete, sender=Upload)
+def release_blob(sender, instance, **kwargs):
+    blobs.move_reference(instance.blob_id, None)
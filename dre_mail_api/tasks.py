@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.db.models import Q
+
+from .models import CustomUser, EmailTransfer
+from .search import index_transfers
+from . import avatars, blacklist, counters, jobs, mailbox
+
+
+# The background tasks run by the `run_jobs` workers (see jobs.py). A task can run more
+# than once (its job is retried until it succeeds), so every task is idempotent.
+
+
+@jobs.task("deliver_group_emails")
+def deliver_group_emails(transferIDs):
+    """
+    Fan group emails out to the inboxes of the members, with their counters, journal entries
+    and notifications. Members who already have the email are skipped.
+    """
+    mailbox.deliver(list(EmailTransfer.objects.filter(id__in=transferIDs)))
+
+
+@jobs.task("index_transfers")
+def index_email_transfers(transferIDs):
+    index_transfers(transferIDs)
+
+
+@jobs.task("index_participant_transfers")
+def index_participant_transfers(userID):
+    """
+    Reindex the emails a user sent or received, after a change to their name or address
+    """
+    index_transfers(
+        EmailTransfer.objects.filter(Q(sender_id=userID) | Q(recipient_id=userID)).values_list("id", flat=True)
+    )
+
+
+@jobs.task("expire_participant_listings")
+def expire_participant_listings(userID):
+    """
+    Move the cached listings that show a user on, after a change to their profile
+    """
+    counters.touch_participants(userID)
+
+
+@jobs.task("create_avatar_variants", queue="media", maxAttempts=3)
+def create_avatar_variants(userID, token):
+    """
+    Resize the avatar of a user, unless it has been replaced (or removed) since
+    """
+    user = CustomUser.objects.filter(id=userID).first()
+
+    if user is None or not user.avi or avatars.avatar_token(user) != token:
+        return
+
+    avatars.create_variants(user)
+
+
+@jobs.task("prune_expired_tokens", every=timedelta(hours=1))
+def prune_expired_tokens():
+    """
+    Delete the refresh tokens, and their blacklist entries, that have expired
+    """
+    blacklist.prune()
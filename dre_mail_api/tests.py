@@ -1,8 +1,28 @@
+import asyncio
+import json
+import os
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from PIL import Image
+from asgiref.sync import async_to_sync, sync_to_async
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.shortcuts import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from dre_mail_api.models import *
+from dre_mail_api import authentication, avatars, blacklist, blobs, jobs, journal, mailbox, notifications, push, uploads
 
 # Create your tests here.
 User = get_user_model()
@@ -188,6 +208,124 @@ class TestEmailTransferViewSet(TestCase):
         response = self.client.post(f'/v1/api/emailTransfers/junk', data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_inbox_excludes_filed_emails(self):
+        """
+        Emails moved to trash, spam or junk should not be listed in the recipient's inbox
+        """
+        self.client.login(email='recipient@dremail.com', password='password')
+
+        response = self.client.get('/v1/api/emailTransfers/inbox')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+
+        data = {
+            # data for the object
+            "email_id": self.email_id,
+            "destination": "spam"
+        }
+
+        response = self.client.post('/v1/api/emailTransfers/inbox', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get('/v1/api/emailTransfers/inbox')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_trash_restore_and_permanent_delete(self):
+        """
+        Deleting an email moves it to trash, restoring it brings it back to the inbox
+        and deleting it from the trash hides it for good
+        """
+        self.client.login(email='recipient@dremail.com', password='password')
+
+        response = self.client.delete(f'/v1/api/emailTransfers/{self.email_id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.client.get('/v1/api/emailTransfers/inbox').data['results']), 0)
+        self.assertEqual(len(self.client.get('/v1/api/emailTransfers/trash').data['results']), 1)
+
+        response = self.client.post('/v1/api/emailTransfers/trash', {"email_id": self.email_id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.client.get('/v1/api/emailTransfers/inbox').data['results']), 1)
+
+        self.client.delete(f'/v1/api/emailTransfers/{self.email_id}')
+        response = self.client.delete(f'/v1/api/emailTransfers/{self.email_id}')
+        self.assertEqual(response.data['detail'], "Email has been permanently deleted")
+        self.assertEqual(len(self.client.get('/v1/api/emailTransfers/trash').data['results']), 0)
+
+        response = self.client.get(f'/v1/api/emailTransfers/{self.email_id}')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_send_to_many_recipients(self):
+        others = [
+            User.objects.create_user(email=f'other{i}@dremail.com', password='password', username=f'other{i}')
+            for i in range(3)
+        ]
+        group = EmailGroup.objects.create(name="Copied", description="Copied group", creator=self.user)
+        group.members.add(self.user, others[2])
+
+        data = {
+            "to": [self.recipient.id, others[0].id],
+            "cc": [others[1].id, self.recipient.id],
+            "bcc": [others[2].id],
+            "group_ids": [group.id],
+            "email": {
+                "message": "This is a test message",
+                "subject": "This is a test subject"
+            }
+        }
+
+        emails = Email.objects.count()
+        response = self.client.post('/v1/api/emailTransfers/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # the body is stored once and each recipient is listed with their first type
+        self.assertEqual(Email.objects.count(), emails + 1)
+        self.assertEqual(
+            [(item['recipient'] and item['recipient']['id'], item['recipientType']) for item in response.data['results']],
+            [(self.recipient.id, "to"), (others[0].id, "to"), (others[1].id, "cc"), (others[2].id, "bcc"), (None, "to")]
+        )
+
+        # every recipient got it in their inbox, the group member once per transfer once the
+        # group is fanned out in the background
+        transferIDs = [item['id'] for item in response.data['results']]
+        self.assertEqual(
+            MailboxEntry.objects.filter(emailTransfer_id__in=transferIDs, folder=MailboxEntry.INBOX).count(), 4
+        )
+
+        self.assertTrue(Job.objects.filter(name="deliver_group_emails", status=Job.QUEUED).exists())
+        jobs.run_pending()
+        self.assertEqual(
+            MailboxEntry.objects.filter(emailTransfer_id__in=transferIDs, folder=MailboxEntry.INBOX).count(), 5
+        )
+
+    def test_send_queries_do_not_grow_with_recipients(self):
+        others = [
+            User.objects.create_user(email=f'other{i}@dremail.com', password='password', username=f'other{i}')
+            for i in range(20)
+        ]
+
+        def send(recipients):
+            data = {"to": [user.id for user in recipients], "email": {"message": "Hi", "subject": "Hi"}}
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/v1/api/emailTransfers/', data, format='json')
+
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return len(queries)
+
+        self.assertEqual(send(others[:2]), send(others))
+
+    def test_send_to_unknown_recipients(self):
+        data = {
+            "to": [self.recipient.id, 9999],
+            "email": {"message": "This is a test message", "subject": "This is a test subject"}
+        }
+
+        emails = Email.objects.count()
+        response = self.client.post('/v1/api/emailTransfers/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Email.objects.count(), emails)
+
     def test_update_read_status(self):
         print(self.user.id)
         data = {
@@ -498,3 +636,1611 @@ class TestEmailGroupViewSet(TestCase):
         self.assertEqual(response.data['email']['message'], "This is a test message")
         self.assertEqual(response.data['email']['subject'], "This is a test subject")
         self.assertEqual(response.data['group']['name'], "Test Group")
+
+    def test_user_is_loaded_once_per_request(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/v1/api/groups/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        userQueries = [query for query in queries if 'FROM "dre_mail_api_customuser"' in query['sql']]
+        self.assertEqual(len(userQueries), 1)
+
+    def test_principal_group_ids(self):
+        from dre_mail_api.principal import Principal
+
+        groups = EmailGroup.objects.filter(id__in=Principal(self.user).group_ids)
+
+        # The memberships are looked up in a subquery of the groups
+        with self.assertNumQueries(1):
+            self.assertEqual([group.id for group in groups], [self.group_id])
+
+        EmailGroup.objects.get(id=self.group_id).members.remove(self.user)
+        self.assertFalse(groups.all().exists())
+
+    def test_group_email_is_delivered_to_every_member(self):
+        members = [
+            User.objects.create_user(email=f'member{i}@dremail.com', password='password', username=f'member{i}')
+            for i in range(3)
+        ]
+        EmailGroup.objects.get(id=self.group_id).members.add(*members)
+
+        email = Email.objects.create(subject="Group", message="Hello everyone")
+        transfer = EmailTransfer.objects.create(email=email, sender=self.user, group_id=self.group_id)
+
+        # the fan out is queued, not done on save
+        self.assertFalse(MailboxEntry.objects.filter(emailTransfer=transfer, flags=MailboxEntry.RECEIVED).exists())
+        jobs.run_pending(queues=["default"])
+
+        # every member but the sender gets an unread inbox entry
+        self.assertCountEqual(
+            MailboxEntry.objects.filter(emailTransfer=transfer, folder=MailboxEntry.INBOX).values_list("user", flat=True),
+            [member.id for member in members]
+        )
+        self.assertEqual(
+            list(MailboxCounter.objects.filter(user__in=members).values_list("unread_inbox", flat=True)), [1, 1, 1]
+        )
+
+        self.client.login(email='member0@dremail.com', password='password')
+        response = self.client.get('/v1/api/emailTransfers/inbox')
+        self.assertEqual([item['id'] for item in response.data['results']], [transfer.id])
+
+
+# This class checks that the read status of a listing is computed once per page and not once per email
+class TestReadStatusQueries(TestCase):
+
+    listings = ['inbox', 'sent_emails', 'trash', 'spam', 'junk', 'favorites']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+    def file_emails(self, count):
+        """
+        Create `count` emails in each of the inbox, trash, spam, junk and favorites
+        of the user and `count` emails sent by the user
+        """
+        for _ in range(count):
+            email = Email.objects.create(subject="Subject", message="Message")
+            received = EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user)
+            EmailTransfer.objects.create(email=email, sender=self.user, recipient=self.sender)
+            received.hasRead.add(self.user)
+
+            # an email can only be in one folder so file a copy in each of them
+            for folder in [MailboxEntry.TRASH, MailboxEntry.SPAM, MailboxEntry.JUNK]:
+                transfer = EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user)
+                transfer.hasRead.add(self.user)
+                mailbox.move(self.user, [transfer], folder)
+
+            mailbox.set_flag(self.user, [received], MailboxEntry.FAVORITE)
+
+    def read_status_queries(self, listing):
+        """
+        Return the number of queries that touched the read status table while listing
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'/v1/api/emailTransfers/{listing}')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return len([
+            query for query in context.captured_queries
+            if EmailTransfer.hasRead.through._meta.db_table in query['sql']
+        ])
+
+    def test_read_status_queries_are_constant(self):
+        self.file_emails(1)
+        single = {listing: self.read_status_queries(listing) for listing in self.listings}
+
+        self.file_emails(5)
+        several = {listing: self.read_status_queries(listing) for listing in self.listings}
+
+        self.assertEqual(single, several)
+
+    def test_read_status_is_annotated(self):
+        self.file_emails(2)
+
+        response = self.client.get('/v1/api/emailTransfers/trash')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(all(item['emailTransfer']['has_read'] for item in response.data['results']))
+
+    def test_listing_queries_are_constant(self):
+        """
+        Every listing should cost the same number of queries whatever the number of emails on the page
+        """
+        self.file_emails(1)
+        single = {}
+
+        for listing in self.listings:
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(f'/v1/api/emailTransfers/{listing}')
+            single[listing] = len(context.captured_queries)
+
+        self.file_emails(5)
+
+        for listing in self.listings:
+            with self.assertNumQueries(single[listing]):
+                self.client.get(f'/v1/api/emailTransfers/{listing}')
+
+
+# This class tests the keyset pagination of the mailbox listings
+class TestMailboxCursorPagination(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        email = Email.objects.create(subject="Subject", message="Message")
+
+        # emails sharing the same dateSent must still be paged in a stable order
+        sameTime = EmailTransfer(email=email, sender=self.sender, recipient=self.user).dateSent
+        self.transfers = [
+            EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user, dateSent=sameTime)
+            for _ in range(25)
+        ]
+
+    def test_pages_walk_the_whole_inbox(self):
+        seen = []
+        url = '/v1/api/emailTransfers/inbox?page_size=10'
+
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(seen, sorted((t.id for t in self.transfers), reverse=True))
+
+    def test_previous_page(self):
+        first = self.client.get('/v1/api/emailTransfers/inbox?page_size=10')
+        self.assertIsNone(first.data['previous'])
+
+        second = self.client.get(first.data['next'])
+        previous = self.client.get(second.data['previous'])
+
+        self.assertEqual(previous.data['results'], first.data['results'])
+        self.assertIsNone(previous.data['previous'])
+
+    def test_page_size_is_capped_and_count_is_optional(self):
+        response = self.client.get('/v1/api/emailTransfers/inbox?page_size=1000&count=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 25)
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/v1/api/emailTransfers/inbox?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+# This class checks with EXPLAIN that the inbox and folder queries are served by indexes
+class TestMailboxQueryPlans(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(email=f'user{i}@dremail.com', password='password', username=f'user{i}')
+            for i in range(20)
+        ]
+        cls.user = cls.users[0]
+        email = Email.objects.create(subject="Subject", message="Message")
+
+        transfers = EmailTransfer.objects.bulk_create(
+            EmailTransfer(email=email, sender=cls.users[i % 20], recipient=cls.users[(i + 1) % 20])
+            for i in range(2000)
+        )
+        mailbox.deliver(transfers)
+
+        # every user files some of the emails they received
+        for user in cls.users:
+            received = [t for t in transfers if t.recipient_id == user.id]
+
+            mailbox.move(user, received[:20], MailboxEntry.TRASH)
+            mailbox.move(user, received[20:40], MailboxEntry.SPAM)
+            mailbox.move(user, received[40:60], MailboxEntry.JUNK)
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertUsesIndexes(self, queryset):
+        """
+        Fail if the plan of the queryset scans a whole table
+        """
+        if connection.vendor == 'postgresql':
+            # the planner prefers sequential scans on tables this small
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+            plan = queryset.explain()
+            self.assertNotIn("Seq Scan", plan)
+            self.assertIn("Index", plan)
+
+        else:
+            plan = queryset.explain()
+            self.assertNotRegex(plan, r"\bSCAN\b")
+            self.assertIn("INDEX", plan)
+
+    def test_inbox_uses_indexes(self):
+        inbox = MailboxEntry.objects.in_folder(self.user, MailboxEntry.INBOX)
+        self.assertUsesIndexes(inbox.order_by('-dateSent', '-id')[:10])
+
+    def test_sent_emails_use_indexes(self):
+        sent = EmailTransfer.objects.visible_to(self.user).filter(sender=self.user)
+        self.assertUsesIndexes(sent.order_by('-dateSent', '-id')[:10])
+
+    def test_folders_use_indexes(self):
+        for folder in [MailboxEntry.TRASH, MailboxEntry.SPAM, MailboxEntry.JUNK]:
+            entries = MailboxEntry.objects.in_folder(self.user, folder)
+            self.assertUsesIndexes(entries.order_by('-dateSent', '-id')[:10])
+
+    def test_visible_emails_use_indexes(self):
+        self.assertUsesIndexes(EmailTransfer.objects.visible_to(self.user).filter(recipient=self.user)[:10])
+
+
+# This class tests the full text search over the emails
+class TestEmailSearch(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(
+            email='sender@dremail.com', password='password', username='sender', first_name='Kwame', last_name='Mensah'
+        )
+        self.stranger = User.objects.create_user(email='stranger@dremail.com', password='password', username='stranger')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        self.budget = self.send("Quarterly budget review", "Please review the attached numbers")
+        self.lunch = self.send("Lunch on Friday", "The budget for lunch is small")
+        self.hidden = self.send("Budget secrets", "Not for the user", recipient=self.stranger)
+
+        # The documents are built by background jobs
+        jobs.run_pending()
+
+    def send(self, subject, message, recipient=None):
+        email = Email.objects.create(subject=subject, message=message)
+        return EmailTransfer.objects.create(email=email, sender=self.sender, recipient=recipient or self.user)
+
+    def search(self, query):
+        response = self.client.get('/v1/api/emailTransfers/search', {"q": query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_results_are_ranked(self):
+        # a match in the subject ranks above a match in the message
+        self.assertEqual(self.search("budget"), [self.budget.id, self.lunch.id])
+
+    def test_prefix_match(self):
+        self.assertEqual(self.search("quart rev"), [self.budget.id])
+
+    def test_participant_names(self):
+        self.assertCountEqual(self.search("kwa"), [self.budget.id, self.lunch.id])
+
+    def test_index_follows_updates(self):
+        self.lunch.email.subject = "Dinner on Friday"
+        self.lunch.email.save()
+        jobs.run_pending()
+
+        self.assertEqual(self.search("dinner"), [self.lunch.id])
+
+    def test_only_searchable_changes_reindex_the_participant(self):
+        self.sender.set_password("changed")
+        self.sender.save()
+        self.sender.last_login = now()
+        self.sender.save(update_fields=["last_login"])
+
+        self.assertFalse(Job.objects.filter(status=Job.QUEUED).exists())
+
+        self.sender.first_name = "Kofi"
+        self.sender.save()
+        self.assertTrue(Job.objects.filter(name="index_participant_transfers", status=Job.QUEUED).exists())
+        jobs.run_pending()
+
+        self.assertCountEqual(self.search("kofi"), [self.budget.id, self.lunch.id])
+        self.assertEqual(self.search("kwame"), [])
+
+    def test_list_search_is_restricted_to_the_user(self):
+        response = self.client.get('/v1/api/emailTransfers/', {"search": "secrets"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+
+class TestMailboxCounters(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        email = Email.objects.create(subject="Counted", message="Count me")
+        self.transfers = [
+            EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user) for _ in range(3)
+        ]
+
+    def counts(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/v1/api/emailTransfers/counts')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['detail'], queries
+
+    def test_counts_follow_the_mailbox(self):
+        counts, _ = self.counts()
+        self.assertEqual(counts['unread_inbox'], 3)
+
+        self.transfers[0].hasRead.add(self.user)
+        mailbox.move(self.user, [self.transfers[1]], MailboxEntry.SPAM)
+        mailbox.set_flag(self.user, [self.transfers[2]], MailboxEntry.FAVORITE)
+
+        counts, _ = self.counts()
+        self.assertEqual(counts, {"unread_inbox": 1, "trash": 0, "spam": 1, "junk": 0, "favorites": 1})
+
+        self.transfers[0].hasRead.remove(self.user)
+        mailbox.restore(self.user, [self.transfers[1].id], MailboxEntry.SPAM)
+        mailbox.move(self.user, [self.transfers[2]], MailboxEntry.DELETED)
+
+        counts, _ = self.counts()
+        self.assertEqual(counts, {"unread_inbox": 2, "trash": 0, "spam": 0, "junk": 0, "favorites": 0})
+
+    def test_counts_are_a_single_read(self):
+        _, queries = self.counts()
+        counterQueries = [query for query in queries if "mailboxcounter" in query['sql']]
+        self.assertEqual(len(counterQueries), 1)
+
+    def test_counters_do_not_drift(self):
+        from dre_mail_api import counters
+
+        mailbox.move(self.user, self.transfers[:2], MailboxEntry.TRASH)
+        self.transfers[2].hasRead.add(self.user, self.sender)
+        self.transfers[2].hasRead.clear()
+
+        self.assertEqual(counters.drift(), {})
+
+    def test_delivering_again_changes_nothing(self):
+        counts, _ = self.counts()
+        changes = MailboxChange.objects.count()
+
+        mailbox.deliver(self.transfers)
+
+        self.assertEqual(self.counts()[0], counts)
+        self.assertEqual(MailboxChange.objects.count(), changes)
+        self.assertEqual(MailboxEntry.objects.filter(user=self.user).count(), 3)
+
+
+class TestBatchReadStatus(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        email = Email.objects.create(subject="Batch", message="Read me")
+        self.transfers = [
+            EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user) for _ in range(5)
+        ]
+        self.hidden = EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.sender)
+
+    def read_ids(self):
+        return set(self.user.emailtransfer_set.values_list("id", flat=True))
+
+    def unread_count(self):
+        return MailboxCounter.objects.get(user=self.user).unread_inbox
+
+    def test_set_read_status_explicitly(self):
+        ids = [transfer.id for transfer in self.transfers[:3]]
+
+        response = self.client.post(
+            '/v1/api/emailTransfers/read_status', {"ids": ids + [self.hidden.id], "has_read": True}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['detail']['updated'], ids)
+        self.assertEqual(response.data['detail']['not_found'], [self.hidden.id])
+        self.assertEqual(self.read_ids(), set(ids))
+        self.assertEqual(self.unread_count(), 2)
+
+        # marking again is not a toggle
+        response = self.client.post('/v1/api/emailTransfers/read_status', {"ids": ids, "has_read": True}, format='json')
+        self.assertEqual(response.data['detail']['updated'], [])
+        self.assertEqual(self.read_ids(), set(ids))
+
+        response = self.client.post('/v1/api/emailTransfers/read_status', {"ids": ids[:1], "has_read": False}, format='json')
+        self.assertEqual(response.data['detail']['updated'], ids[:1])
+        self.assertEqual(self.unread_count(), 3)
+
+    def test_mark_all_read(self):
+        mailbox.move(self.user, [self.transfers[0]], MailboxEntry.SPAM)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/v1/api/emailTransfers/mark_all_read', {"folder": "inbox"}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['detail']['updated'], 4)
+        self.assertEqual(self.read_ids(), {transfer.id for transfer in self.transfers[1:]})
+        self.assertEqual(self.unread_count(), 0)
+
+        # the statuses are written with one insert, not one per email, and journaled with another
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertIn(EmailTransfer.hasRead.through._meta.db_table, inserts[0])
+        self.assertIn(MailboxChange._meta.db_table, inserts[1])
+
+    def test_mark_all_read_up_to(self):
+        # emails newer than the one the client listed last stay unread
+        response = self.client.post(
+            '/v1/api/emailTransfers/mark_all_read', {"folder": "inbox", "up_to": self.transfers[2].id}, format='json'
+        )
+        self.assertEqual(response.data['detail']['updated'], 3)
+        self.assertEqual(self.read_ids(), {transfer.id for transfer in self.transfers[:3]})
+        self.assertEqual(self.unread_count(), 2)
+
+
+class TestBulkMove(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        email = Email.objects.create(subject="Bulk", message="Move me")
+        self.transfers = [
+            EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user) for _ in range(4)
+        ]
+        self.hidden = EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.sender)
+
+    def move(self, ids, source, destination):
+        return self.client.post(
+            '/v1/api/emailTransfers/move', {"ids": ids, "source": source, "destination": destination}, format='json'
+        )
+
+    def folders(self):
+        return dict(
+            MailboxEntry.objects.filter(user=self.user).values_list("emailTransfer_id", "folder")
+        )
+
+    def test_move_and_restore(self):
+        first, second, third, fourth = [transfer.id for transfer in self.transfers]
+        mailbox.move(self.user, [self.transfers[3]], MailboxEntry.JUNK)
+
+        response = self.move([first, second, fourth, self.hidden.id], "inbox", "spam")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['detail']['results'], [
+            {"id": first, "result": "moved"},
+            {"id": second, "result": "moved"},
+            {"id": fourth, "result": "not_in_folder"},
+            {"id": self.hidden.id, "result": "not_found"},
+        ])
+        self.assertEqual(self.folders(), {first: "spam", second: "spam", third: "inbox", fourth: "junk"})
+        self.assertEqual(MailboxCounter.objects.get(user=self.user).spam, 2)
+
+        self.move([first, second], "spam", "inbox")
+        self.assertEqual(self.folders(), {first: "inbox", second: "inbox", third: "inbox", fourth: "junk"})
+
+    def test_favorites(self):
+        ids = [transfer.id for transfer in self.transfers[:2]]
+
+        self.move(ids, "inbox", "favorites")
+        self.assertEqual(MailboxEntry.objects.flagged(self.user, MailboxEntry.FAVORITE).count(), 2)
+
+        self.move(ids[:1], "favorites", "inbox")
+        self.assertEqual(MailboxEntry.objects.flagged(self.user, MailboxEntry.FAVORITE).count(), 1)
+
+    def test_queries_do_not_grow_with_ids(self):
+
+        def move(transfers):
+            with CaptureQueriesContext(connection) as queries:
+                self.move([transfer.id for transfer in transfers], "inbox", "trash")
+
+            return len(queries)
+
+        self.assertEqual(move(self.transfers[:1]), move(self.transfers[1:]))
+
+    def test_invalid_move(self):
+        response = self.move([self.transfers[0].id], "inbox", "deleted")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.folders()[self.transfers[0].id], "inbox")
+
+
+class TestMailboxListingCache(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        self.email = Email.objects.create(subject="Cached", message="Cache me")
+        self.transfer = self.send()
+
+    def send(self):
+        return EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+
+    def listing(self, name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/v1/api/emailTransfers/{name}')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        transferQueries = [query for query in queries if 'dre_mail_api_email' in query['sql']]
+        return response.data['results'], transferQueries
+
+    def test_unchanged_listing_is_served_from_the_cache(self):
+        from dre_mail_api.caching import cache_stats
+
+        before = cache_stats()
+        first, queries = self.listing('inbox')
+        self.assertTrue(queries)
+
+        second, queries = self.listing('inbox')
+        self.assertEqual(second, first)
+        self.assertEqual(queries, [])
+
+        after = cache_stats()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_changes_move_the_version_on(self):
+        self.listing('inbox')
+
+        newer = self.send()
+        results, _ = self.listing('inbox')
+        self.assertEqual([item['id'] for item in results], [newer.id, self.transfer.id])
+
+        self.transfer.hasRead.add(self.user)
+        results, _ = self.listing('inbox')
+        self.assertEqual([item['has_read'] for item in results], [False, True])
+
+        mailbox.move(self.user, [newer], MailboxEntry.TRASH)
+        results, _ = self.listing('inbox')
+        self.assertEqual([item['id'] for item in results], [self.transfer.id])
+
+        # reading an email in the trash changes the trash listing but no count
+        self.listing('trash')
+        newer.hasRead.add(self.user)
+        results, _ = self.listing('trash')
+        self.assertEqual([item['emailTransfer']['has_read'] for item in results], [True])
+
+
+class TestConditionalRequests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        self.email = Email.objects.create(subject="Polled", message="Poll me")
+        EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+
+    def get(self, url, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **headers)
+
+        # Leave out the queries of the session authentication
+        queries = [
+            query for query in queries
+            if 'django_session' not in query['sql'] and 'FROM "dre_mail_api_customuser"' not in query['sql']
+        ]
+        return response, queries
+
+    def test_unchanged_inbox_is_not_modified(self):
+        response, _ = self.get('/v1/api/emailTransfers/inbox')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response, queries = self.get('/v1/api/emailTransfers/inbox', etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(queries), 1)
+
+        EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+
+        response, _ = self.get('/v1/api/emailTransfers/inbox', etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_unchanged_user_is_not_modified(self):
+        url = f'/v1/api/users/{self.sender.id}'
+
+        response, _ = self.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response, _ = self.get(url, etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.sender.first_name = "Renamed"
+        self.sender.save()
+
+        response, _ = self.get(url, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['first_name'], "Renamed")
+
+    def test_listing_follows_the_profiles_it_shows(self):
+        response, _ = self.get('/v1/api/emailTransfers/inbox')
+        etag = response['ETag']
+
+        self.sender.last_login = now()
+        self.sender.save(update_fields=["last_login"])
+        jobs.run_pending()
+
+        response, _ = self.get('/v1/api/emailTransfers/inbox', etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.sender.first_name = "Renamed"
+        self.sender.save()
+        jobs.run_pending()
+
+        response, _ = self.get('/v1/api/emailTransfers/inbox', etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['sender']['first_name'], "Renamed")
+
+
+class TestDownloads(TestCase):
+
+    content = b"0123456789" * 10
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.settings = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.stranger = User.objects.create_user(email='stranger@dremail.com', password='password', username='stranger')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        self.email = Email.objects.create(
+            subject="Attached", message="See attached", attachment=SimpleUploadedFile("report.txt", self.content)
+        )
+        EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+        self.url = f'/v1/api/emails/{self.email.id}/attachment'
+
+    def test_download_attachment(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment;'))
+
+        # listings link to the download endpoint rather than the media url
+        response = self.client.get('/v1/api/emailTransfers/inbox')
+        self.assertTrue(response.data['results'][0]['email']['attachment'].endswith(self.url))
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b"".join(response.streaming_content), self.content[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b"".join(response.streaming_content), self.content[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=500-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+        # a range of an older version of the file gets the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_conditional_download(self):
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_only_participants_can_download(self):
+        self.client.login(email='stranger@dremail.com', password='password')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(DOWNLOAD_OFFLOAD="x-accel-redirect", DOWNLOAD_ACCEL_PREFIX="/protected-media/")
+    def test_offload_to_the_proxy(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.email.attachment.name}')
+        self.assertEqual(response.content, b"")
+
+    def test_download_avatar(self):
+        self.sender.avi = SimpleUploadedFile("avatar.png", b"not really a png")
+        self.sender.save()
+
+        response = self.client.get(f'/v1/api/users/{self.sender.id}/avi')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), b"not really a png")
+        self.assertTrue(response['Content-Disposition'].startswith('inline;'))
+
+
+class TestResumableUploads(TestCase):
+
+    content = b"0123456789" * 10
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.settings = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.recipient = User.objects.create_user(email='recipient@dremail.com', password='password', username='recipient')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        response = self.client.post('/v1/api/uploads/', {"filename": "report.txt", "size": len(self.content)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.url = f"/v1/api/uploads/{response.data['id']}"
+
+    def put_chunk(self, offset, chunk):
+        return self.client.put(
+            self.url, chunk, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def upload(self):
+        self.assertEqual(self.put_chunk(0, self.content[:60]).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.put_chunk(60, self.content[60:])['Upload-Offset'], str(len(self.content)))
+
+        response = self.client.post(f'{self.url}/finalize')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], Upload.COMPLETE)
+
+        return response.data['id']
+
+    def test_resume_after_an_interrupted_chunk(self):
+        response = self.put_chunk(0, self.content[:40])
+        self.assertEqual(response['Upload-Offset'], "40")
+
+        # a chunk at the wrong offset is refused with the offset to resume from
+        response = self.put_chunk(20, self.content[20:60])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], "40")
+
+        self.assertEqual(self.client.get(self.url).data['offset'], 40)
+
+        # the upload can't be finalized until every byte has arrived
+        response = self.client.post(f'{self.url}/finalize')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # nor take more bytes than it was started with
+        response = self.put_chunk(40, self.content[40:] + b"extra")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_chunks_at_the_same_offset(self):
+        first, second = Upload.objects.get(), Upload.objects.get()
+
+        self.assertEqual(uploads.write_chunk(first, 0, BytesIO(self.content[:40]), 40), 40)
+
+        # The other request loaded the upload before the first chunk moved its offset on
+        with self.assertRaises(uploads.UploadConflict):
+            uploads.write_chunk(second, 0, BytesIO(b"x" * 40), 40)
+
+        with open(uploads.partial_path(first), "rb") as file:
+            self.assertEqual(file.read(), self.content[:40])
+
+    def test_claimed_offset_is_taken_over_once_stalled(self):
+        upload = Upload.objects.get()
+
+        # Another request is writing a chunk at the offset
+        Upload.objects.update(writer="other", claimed_at=now())
+
+        response = self.put_chunk(0, self.content[:40])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], "0")
+
+        # Its client stalled for longer than the claim holds
+        Upload.objects.update(claimed_at=now() - uploads.CLAIM_TIMEOUT - timedelta(seconds=1))
+
+        self.assertEqual(uploads.write_chunk(upload, 0, BytesIO(self.content[:40]), 40), 40)
+        self.assertEqual(Upload.objects.values_list("offset", "writer", "claimed_at").get(), (40, "", None))
+
+        # The stalled request finds its claim taken over when it renews it, and writes no more
+        class StalledStream(BytesIO):
+            def read(stream, size):
+                Upload.objects.update(writer="other", claimed_at=now())
+                return super().read(size)
+
+        with mock.patch.object(uploads, "CLAIM_RENEWAL", timedelta()), self.assertRaises(uploads.UploadConflict):
+            uploads.write_chunk(upload, 40, StalledStream(b"x" * 60), 60)
+
+        with open(uploads.partial_path(upload), "rb") as file:
+            self.assertEqual(file.read(), self.content[:40])
+
+    def test_finalize_again_after_a_rollback(self):
+        upload = Upload.objects.get()
+        uploads.write_chunk(upload, 0, BytesIO(self.content), len(self.content))
+
+        with mock.patch.object(Upload, "save", side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            uploads.finalize(upload)
+
+        # The upload is still pending and its partial file is still there
+        self.assertEqual(Upload.objects.get().status, Upload.PENDING)
+        self.assertFalse(Blob.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            upload = uploads.finalize(upload)
+
+        self.assertEqual(upload.file.read(), self.content)
+        self.assertFalse(os.path.exists(uploads.partial_path(upload)))
+
+    def test_send_an_uploaded_attachment(self):
+        uploadID = self.upload()
+
+        data = {
+            "recipient_id": self.recipient.id,
+            "email": {
+                "message": "See attached",
+                "subject": "Attached",
+                "upload_id": uploadID
+            }
+        }
+
+        response = self.client.post('/v1/api/emailTransfers/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        email = Email.objects.get(id=response.data['email']['id'])
+        self.assertEqual(email.attachment.read(), self.content)
+
+    def test_uploads_are_private(self):
+        uploadID = self.upload()
+
+        User.objects.create_user(email='stranger@dremail.com', password='password', username='stranger')
+        self.client.login(email='stranger@dremail.com', password='password')
+
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+        data = {"email": {"message": "Mine now", "subject": "Attached", "upload_id": uploadID}}
+        response = self.client.post('/v1/api/drafts/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestAttachmentBlobs(TestCase):
+
+    content = b"the same report" * 100
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.settings = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+    def draft_with_attachment(self):
+        response = self.client.post('/v1/api/uploads/', {"filename": "report.txt", "size": len(self.content)}, format='json')
+        url = f"/v1/api/uploads/{response.data['id']}"
+
+        self.client.put(url, self.content, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET="0")
+        self.client.post(f'{url}/finalize')
+
+        data = {"email": {"message": "See attached", "subject": "Attached", "upload_id": response.data['id']}}
+        response = self.client.post('/v1/api/drafts/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        return response.data
+
+    def blob_files(self):
+        return [name for _, _, names in os.walk(os.path.join(self.media.name, blobs.BLOB_DIRECTORY)) for name in names]
+
+    def test_same_content_is_stored_once(self):
+        first = self.draft_with_attachment()
+        self.draft_with_attachment()
+        blobs.store(SimpleUploadedFile("copy.txt", self.content))
+
+        blob = Blob.objects.get()
+        # two uploads and two drafts refer to it
+        self.assertEqual(blob.refcount, 4)
+        self.assertEqual(len(self.blob_files()), 1)
+
+        # the attachment is still downloaded under its own name
+        response = self.client.get(f"/v1/api/emails/{first['email']['id']}/attachment")
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertIn('filename="report.txt"', response['Content-Disposition'])
+        self.assertEqual(response['Content-Type'], 'text/plain')
+
+    def test_collect_unreferenced_blobs(self):
+        draft = self.draft_with_attachment()
+
+        self.client.delete(f"/v1/api/drafts/{draft['id']}")
+        Upload.objects.all().delete()
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 0)
+
+        # kept for the grace period
+        self.assertEqual(blobs.collect(), [])
+
+        self.assertEqual(blobs.collect(timedelta(0)), [blob.sha256])
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.blob_files(), [])
+
+    def test_deduplicate_existing_attachments(self):
+        emails = [
+            Email.objects.create(subject="Attached", message="Copy", attachment=SimpleUploadedFile("report.txt", self.content))
+            for _ in range(3)
+        ]
+        names = [email.attachment.name for email in emails]
+
+        self.assertEqual(blobs.deduplicate(), (1, 2, 0))
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 3)
+        self.assertEqual(len(self.blob_files()), 1)
+        self.assertFalse(any(os.path.exists(os.path.join(self.media.name, name)) for name in names))
+
+        for email, name in zip(Email.objects.order_by("id"), names):
+            self.assertEqual(email.attachmentName, os.path.basename(name))
+            self.assertEqual(email.attachment.read(), self.content)
+
+
+class TestAvatarVariants(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.settings = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+    def image(self, color):
+        buffer = BytesIO()
+        Image.new("RGB", (400, 300), color).save(buffer, "PNG")
+
+        return SimpleUploadedFile("avatar.png", buffer.getvalue(), content_type="image/png")
+
+    def upload_avatar(self, color):
+        response = self.client.patch(f'/v1/api/users/{self.user.id}', {"avi": self.image(color)}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return response.data['avi_variants']
+
+    def test_variants_are_created_on_upload(self):
+        variants = self.upload_avatar("red")
+        self.assertEqual(set(variants), {"32", "64", "256"})
+
+        # they are resized by a background job
+        self.assertEqual(jobs.run_pending(queues=["media"]), 1)
+        self.user.refresh_from_db()
+        self.assertTrue(avatars.has_variants(self.user))
+
+        response = self.client.get(variants["32"]["webp"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("immutable", response['Cache-Control'])
+
+        image = Image.open(BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual((image.format, image.size), ("WEBP", (32, 32)))
+
+        response = self.client.get(variants["256"]["jpg"])
+        self.assertEqual(Image.open(BytesIO(b"".join(response.streaming_content))).format, "JPEG")
+
+    def test_replaced_avatar_gets_new_urls(self):
+        old = self.upload_avatar("red")
+        new = self.upload_avatar("blue")
+        self.assertNotEqual(old["64"]["webp"], new["64"]["webp"])
+
+        # an old url sends the client to the current variant
+        response = self.client.get(old["64"]["webp"])
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], new["64"]["webp"])
+
+    def test_avatar_stored_under_the_old_name_gets_new_urls(self):
+        self.user.avi = self.image("red")
+        self.user.save()
+        name, token = self.user.avi.name, avatars.avatar_token(self.user)
+
+        # Replaced as UpdateAVISerializer does: the old file goes first, so the new one takes its name
+        self.user.avi.delete()
+        self.user.avi = self.image("blue")
+        self.user.save()
+
+        self.assertEqual(self.user.avi.name, name)
+        self.assertNotEqual(avatars.avatar_token(self.user), token)
+
+    def test_backfill_variants(self):
+        self.user.avi = self.image("green")
+        self.user.save()
+        self.assertFalse(avatars.has_variants(self.user))
+
+        call_command("create_avatar_variants", stdout=StringIO())
+        self.assertTrue(avatars.has_variants(self.user))
+
+
+class TestAsyncViews(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+        email = Email.objects.create(subject="Hello", message="Hello there")
+        self.transfers = [
+            EmailTransfer.objects.create(email=email, sender=self.sender, recipient=self.user) for _ in range(3)
+        ]
+        mailbox.move(self.user, self.transfers[:1], MailboxEntry.TRASH)
+
+        self.group = EmailGroup.objects.create(name="Team", description="The team", creator=self.sender)
+        self.group.members.add(self.sender, self.user)
+
+    def test_listings_match_the_sync_views(self):
+        for listing in ["inbox", "sent_emails", "trash", "spam", "junk", "favorites"]:
+            expected = self.client.get(f'/v1/api/emailTransfers/{listing}', {"page_size": 1}).json()
+            response = self.client.get(f'/v1/api/async/emailTransfers/{listing}', {"page_size": 1})
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()['results'], expected['results'])
+            self.assertEqual(response.json()['next'] is None, expected['next'] is None)
+
+        # the next page follows the cursor like the sync listing
+        page = self.client.get('/v1/api/async/emailTransfers/inbox', {"page_size": 1}).json()
+        nextPage = self.client.get(page['next']).json()
+        self.assertEqual(
+            [page['results'][0]['id'], nextPage['results'][0]['id']],
+            [transfer.id for transfer in reversed(self.transfers[1:])]
+        )
+
+    def test_conditional_listing(self):
+        response = self.client.get('/v1/api/async/emailTransfers/inbox')
+
+        response = self.client.get('/v1/api/async/emailTransfers/inbox', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_user_and_group_members(self):
+        response = self.client.get(f'/v1/api/async/users/{self.sender.id}')
+        self.assertEqual(response.json(), self.client.get(f'/v1/api/users/{self.sender.id}').json())
+
+        response = self.client.get(f'/v1/api/async/groups/{self.group.id}/members')
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(
+            {member['id'] for member in response.json()['results']}, {self.sender.id, self.user.id}
+        )
+
+        stranger = User.objects.create_user(email='stranger@dremail.com', password='password', username='stranger')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(stranger).access_token}')
+
+        response = self.client.get(f'/v1/api/async/groups/{self.group.id}/members')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_authentication_is_required(self):
+        self.client.credentials()
+        self.assertEqual(self.client.get('/v1/api/async/emailTransfers/inbox').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        self.assertEqual(self.client.get('/v1/api/async/emailTransfers/inbox').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TestPushNotifications(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.email = Email.objects.create(subject="Hello", message="Hello there")
+
+    def stream(self, action, headers=None, events=1):
+        """
+        Open an event stream, run the action once it is open and return the events received
+        """
+        if headers is None:
+            headers = [(b"authorization", f"Bearer {self.token}".encode())]
+
+        async def run():
+            messages = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                messages.append(message)
+
+            def received():
+                body = b"".join(message.get("body", b"") for message in messages)
+                return [block for block in body.decode().split("\n\n") if block.startswith("event:")]
+
+            scope = {"type": "http", "method": "GET", "path": "/v1/api/events", "headers": headers, "query_string": b""}
+            task = asyncio.ensure_future(push.events(scope, receive, send))
+
+            # Wait for the stream to open, or for the request to be refused
+            for _ in range(100):
+                if len(messages) >= 2 or task.done():
+                    break
+                await asyncio.sleep(0.01)
+
+            if not task.done():
+                await sync_to_async(action)()
+
+                for _ in range(100):
+                    if len(received()) >= events:
+                        break
+                    await asyncio.sleep(0.01)
+
+            disconnect.set()
+            await task
+
+            return messages[0]["status"], [
+                (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+                for block in received()
+            ]
+
+        return async_to_sync(run)()
+
+    def test_delivery_read_and_folder_events(self):
+
+        def act():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.transfer = EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+            with self.captureOnCommitCallbacks(execute=True):
+                mailbox.set_read(self.user, [self.transfer.id], True)
+            with self.captureOnCommitCallbacks(execute=True):
+                mailbox.move(self.user, [self.transfer], MailboxEntry.TRASH)
+
+        statusCode, events = self.stream(act, events=3)
+
+        self.assertEqual(statusCode, 200)
+        self.assertEqual(events, [
+            ("delivery", {"ids": [self.transfer.id]}),
+            ("read", {"ids": [self.transfer.id], "has_read": True}),
+            ("folder", {"changes": [{"id": self.transfer.id, "folder": "trash", "favorite": False}]}),
+        ])
+
+    def test_events_are_private(self):
+
+        def act():
+            with self.captureOnCommitCallbacks(execute=True):
+                EmailTransfer.objects.create(email=self.email, sender=self.user, recipient=self.sender)
+
+        self.assertEqual(self.stream(act, events=1)[1], [])
+
+    def test_authentication_is_required(self):
+        self.assertEqual(self.stream(lambda: None, headers=[])[0], 401)
+        self.assertEqual(self.stream(lambda: None, headers=[(b"authorization", b"Bearer not-a-token")])[0], 401)
+
+    @override_settings(PUSH_RELAY_INTERVAL=0.01)
+    def test_events_of_jobs_are_relayed(self):
+        group = EmailGroup.objects.create(name="Team", description="The team", creator=self.sender)
+        group.members.add(self.user, self.sender)
+
+        # Sent as the serializer sends it, the fan out is left to the job
+        transfer = EmailTransfer.objects.bulk_create([EmailTransfer(email=self.email, sender=self.sender, group=group)])[0]
+        jobs.enqueue("deliver_group_emails", transferIDs=[transfer.id])
+
+        def act():
+            self.assertTrue(jobs.run(jobs.claim(jobs.worker_name(), 1)[0]))
+
+        # The event reaches the stream without the transaction committing in this process
+        statusCode, events = self.stream(act)
+
+        self.assertEqual(events, [("delivery", {"ids": [transfer.id]})])
+        self.assertEqual(PushEvent.objects.count(), 1)
+
+    def test_events_committed_out_of_order_are_relayed(self):
+        cursor = notifications.RelayCursor()
+
+        # The job holding the greater id commits first
+        later = PushEvent.objects.create(id=cursor.lastID + 2, user=self.user, event={"type": "delivery", "ids": [2]})
+        self.assertEqual(cursor.fetch(), [(self.user.id, later.event)])
+
+        earlier = PushEvent.objects.create(id=cursor.lastID - 1, user=self.user, event={"type": "delivery", "ids": [1]})
+        self.assertEqual(cursor.fetch(), [(self.user.id, earlier.event)])
+        self.assertEqual(cursor.fetch(), [])
+        self.assertEqual(cursor.gaps, {})
+
+    def test_slow_client_is_told_to_resync(self):
+        subscription = notifications.Subscription(self.user.id, None)
+
+        for transferID in range(notifications.QUEUE_SIZE + 1):
+            subscription.put({"type": notifications.DELIVERY, "ids": [transferID]})
+
+        self.assertEqual(subscription.queue.qsize(), 1)
+        self.assertEqual(subscription.queue.get_nowait(), notifications.RESYNC)
+
+
+class TestChangeJournal(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+        self.sender = User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        self.client.login(email='test_user@dremail.com', password='password')
+
+        self.email = Email.objects.create(subject="Sync", message="Sync me")
+
+    def changes(self, since=None):
+        return self.client.get('/v1/api/emailTransfers/changes', {} if since is None else {"since": since})
+
+    def test_sync(self):
+        token = self.changes().data['detail']['token']
+
+        first, second, third = [
+            EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user) for _ in range(3)
+        ]
+        mailbox.set_read(self.user, [first.id, second.id], True)
+        mailbox.set_read(self.user, [second.id], False)
+        mailbox.move(self.user, [second], MailboxEntry.TRASH)
+        mailbox.set_flag(self.user, [first], MailboxEntry.FAVORITE)
+        mailbox.move(self.user, [third], MailboxEntry.TRASH)
+        mailbox.move(self.user, [third], MailboxEntry.DELETED)
+
+        response = self.changes(token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['detail']['changes'], [
+            {"id": second.id, "delivered": True, "has_read": False, "folder": "trash", "favorite": False},
+            {"id": first.id, "delivered": True, "has_read": True, "folder": "inbox", "favorite": True},
+            {"id": third.id, "deleted": True},
+        ])
+        self.assertFalse(response.data['detail']['more'])
+
+        # Nothing changed since the new token, and the emails of others are not journaled
+        token = response.data['detail']['token']
+        EmailTransfer.objects.create(email=self.email, sender=self.user, recipient=self.sender)
+
+        response = self.changes(token)
+        self.assertEqual(response.data['detail'], {"changes": [], "token": token, "more": False})
+
+    def test_changes_are_paged(self):
+        token = self.changes().data['detail']['token']
+        transfers = [
+            EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user) for _ in range(3)
+        ]
+
+        records, token, more = journal.changes_since(self.user.id, int(token), limit=2)
+        self.assertEqual([record["id"] for record in records], [transfer.id for transfer in transfers[:2]])
+        self.assertTrue(more)
+
+        records, token, more = journal.changes_since(self.user.id, int(token))
+        self.assertEqual([record["id"] for record in records], [transfers[2].id])
+        self.assertFalse(more)
+
+    def test_read_status_signal_is_journaled(self):
+        token = self.changes().data['detail']['token']
+        transfer = EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+        transfer.hasRead.add(self.user)
+
+        self.assertEqual(self.changes(token).data['detail']['changes'], [
+            {"id": transfer.id, "delivered": True, "has_read": True},
+        ])
+
+    def test_invalid_token(self):
+        self.assertEqual(self.changes("abc").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.changes("-1").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_compaction(self):
+        token = self.changes().data['detail']['token']
+        transfer = EmailTransfer.objects.create(email=self.email, sender=self.sender, recipient=self.user)
+
+        for folder in [MailboxEntry.TRASH, MailboxEntry.SPAM, MailboxEntry.JUNK]:
+            mailbox.move(self.user, [transfer], folder)
+
+        before = self.changes(token).data['detail']['changes']
+
+        # Only the newest move is kept, and syncing gives the same state
+        self.assertEqual(journal.compact(), (2, 0))
+        self.assertEqual(MailboxChange.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(self.changes(token).data['detail']['changes'], before)
+
+        # Expired changes make the older tokens resync
+        MailboxChange.objects.update(created_at=now() - journal.RETENTION - timedelta(days=1))
+        self.assertEqual(journal.compact(), (0, 2))
+
+        response = self.changes(token)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+        token = response.data['error']['token']
+        self.assertEqual(self.changes(token).data['detail']['changes'], [])
+
+        mailbox.set_read(self.user, [transfer.id], True)
+        self.assertEqual(self.changes(token).data['detail']['changes'], [{"id": transfer.id, "has_read": True}])
+
+
+class TestBackgroundJobs(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def record(value, fail=0):
+            self.calls.append(value)
+            Blob.objects.create(sha256=f"{value}{len(self.calls)}", size=0)
+
+            if len(self.calls) <= fail:
+                raise RuntimeError("Try again")
+
+        for name, queue in [("test_record", jobs.DEFAULT_QUEUE), ("test_media", "media")]:
+            jobs.task(name, queue=queue, maxAttempts=2)(record)
+            self.addCleanup(jobs.TASKS.pop, name)
+
+    def test_jobs_with_a_key_are_queued_once(self):
+        first, created = jobs.enqueue("test_record", key="once", value="a")
+        self.assertTrue(created)
+
+        second, created = jobs.enqueue("test_record", key="once", value="b")
+        self.assertFalse(created)
+        self.assertEqual(first.id, second.id)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(Job.objects.get().status, Job.DONE)
+
+    def test_failed_jobs_are_retried_with_backoff(self):
+        job, _ = jobs.enqueue("test_record", value="a", fail=2)
+
+        # the changes of a failed attempt are rolled back
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_at, now() + jobs.BACKOFF / 2 - timedelta(seconds=1))
+        self.assertIn("Try again", job.last_error)
+        self.assertEqual(Blob.objects.count(), 0)
+
+        # not due yet
+        self.assertEqual(jobs.run_pending(), 0)
+
+        Job.objects.update(run_at=now())
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_queue_concurrency_limit(self):
+        for value in "abc":
+            jobs.enqueue("test_media", value=value)
+        jobs.enqueue("test_record", value="d")
+
+        with override_settings(JOB_CONCURRENCY={"media": 2}):
+
+            # A worker of the other queues doesn't wait for the lock of the media queue
+            with CaptureQueriesContext(connection) as queries:
+                jobs.claim("worker", 0, queues=["default"])
+            self.assertFalse(any(JobQueue._meta.db_table in query['sql'] for query in queries))
+
+            claimed = jobs.claim("worker", 10)
+            self.assertEqual(sorted(job.queue for job in claimed), ["default", "media", "media"])
+            self.assertEqual(list(JobQueue.objects.values_list("name", flat=True)), ["media"])
+
+            self.assertEqual(jobs.claim("worker", 10), [])
+
+    def test_lost_jobs_are_retried_once(self):
+        jobs.enqueue("test_record", value="a")
+        [job] = jobs.claim("lost", 1)
+
+        Job.objects.update(locked_at=now() - jobs.STALE_AFTER - timedelta(seconds=1))
+        self.assertEqual(jobs.requeue_stale(), (1, 0))
+
+        self.assertEqual(jobs.run_pending(), 1)
+
+        # the lost worker finishing late does not apply the job a second time
+        self.assertFalse(jobs.run(job))
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(Job.objects.get().attempts, 2)
+
+    def test_metrics(self):
+        for value in "ab":
+            jobs.enqueue("test_record", value=value)
+        jobs.enqueue("test_media", value="c")
+        jobs.enqueue("test_record", delay=timedelta(hours=1), value="d")
+
+        stats = jobs.metrics()
+        self.assertEqual((stats["default"]["due"], stats["default"]["scheduled"]), (2, 1))
+        self.assertEqual(stats["media"]["due"], 1)
+
+        self.assertEqual(jobs.run_pending(queues=["default"]), 2)
+
+        stats = jobs.metrics()
+        self.assertEqual((stats["default"]["due"], stats["default"]["finished"]), (0, 2))
+        self.assertIsNotNone(stats["default"]["wait_p50"])
+        self.assertEqual(stats["media"]["due"], 1)
+
+        output = StringIO()
+        call_command("job_stats", stdout=output)
+        self.assertIn("media", output.getvalue())
+
+
+class TestJobWorker(TransactionTestCase):
+
+    def test_worker_runs_the_jobs_due(self):
+        transfer = EmailTransfer.objects.create(
+            email=Email.objects.create(subject="Worker", message="Run me"),
+            sender=User.objects.create_user(email='sender@dremail.com', password='password', username='sender')
+        )
+
+        jobs.enqueue("index_transfers", transferIDs=[transfer.id])
+        jobs.enqueue("deliver_group_emails", transferIDs=[transfer.id])
+        jobs.enqueue("create_avatar_variants", userID=transfer.sender_id, token="")
+
+        output = StringIO()
+        call_command("run_jobs", "--burst", "--concurrency", "1", "--queues", "default", stdout=output)
+
+        # The worker also runs the indexing queued on save, and queues (and runs) the periodic tasks
+        self.assertEqual(output.getvalue().count(" done in "), 4)
+        self.assertIn("1 periodic job(s) queued", output.getvalue())
+        self.assertEqual(
+            dict(Job.objects.values_list("name", "status")),
+            {
+                "index_transfers": Job.DONE, "deliver_group_emails": Job.DONE,
+                "create_avatar_variants": Job.QUEUED, "prune_expired_tokens": Job.DONE,
+            }
+        )
+
+
+class TestCachedUserAuthentication(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+
+        response = self.client.post('/v1/api/authenticate/', {"email": "test_user@dremail.com", "password": "password"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.token = response.data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def user_queries(self, url):
+        """
+        The status of a request and the queries it made for the user or their session
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        tables = [User._meta.db_table, "django_session"]
+
+        return response.status_code, [query['sql'] for query in queries if any(table in query['sql'] for table in tables)]
+
+    def test_cached_user_needs_no_query(self):
+        self.assertEqual(len(self.user_queries('/v1/api/emailTransfers/counts')[1]), 1)
+        self.assertEqual(self.user_queries('/v1/api/emailTransfers/counts'), (status.HTTP_200_OK, []))
+
+    def test_changes_to_the_user_are_seen_at_once(self):
+        self.user_queries('/v1/api/emailTransfers/counts')
+
+        response = self.client.patch(f'/v1/api/users/{self.user.id}', {"first_name": "Renamed"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(authentication.load_user(self.user.id).first_name, "Renamed")
+
+        self.user.refresh_from_db()
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self.user_queries('/v1/api/emailTransfers/counts')[0], status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user_is_refused(self):
+        self.user_queries('/v1/api/emailTransfers/counts')
+
+        response = self.client.delete(f'/v1/api/users/{self.user.id}')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.assertEqual(self.user_queries('/v1/api/emailTransfers/counts')[0], status.HTTP_401_UNAUTHORIZED)
+
+
+class TestTokenBlacklist(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test_user@dremail.com', password='password', username='user')
+
+        # Each test starts with an empty filter
+        blacklist.get_filter.cache_clear()
+        blacklist.get_cache().delete(blacklist.VERSION_KEY)
+
+        response = self.client.post('/v1/api/authenticate/', {"email": "test_user@dremail.com", "password": "password"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.access, self.refresh = response.data['access'], response.data['refresh']
+
+    def refresh_token(self, refresh):
+        """
+        The status of a refresh, its new refresh token and the blacklist lookups it made
+        """
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/v1/api/token/refresh/', {"refresh": refresh})
+
+        lookups = [
+            query['sql'] for query in queries
+            if BlacklistedToken._meta.db_table in query['sql'] and '."jti" =' in query['sql']
+        ]
+
+        return response.status_code, response.data.get('refresh'), lookups
+
+    def test_refresh_skips_the_blacklist_query(self):
+        code, refresh, lookups = self.refresh_token(self.refresh)
+        self.assertEqual((code, lookups), (status.HTTP_200_OK, []))
+
+        code, refresh, lookups = self.refresh_token(refresh)
+        self.assertEqual((code, lookups), (status.HTTP_200_OK, []))
+
+    def test_rotated_and_logged_out_tokens_are_refused(self):
+        code, refresh, _ = self.refresh_token(self.refresh)
+        self.assertEqual(code, status.HTTP_200_OK)
+
+        # The rotated token is in the filter, so it is looked up
+        code, _, lookups = self.refresh_token(self.refresh)
+        self.assertEqual((code, len(lookups)), (status.HTTP_401_UNAUTHORIZED, 1))
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.access}")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put('/v1/api/logout/', {"refresh": refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.refresh_token(refresh)[0], status.HTTP_401_UNAUTHORIZED)
+
+    def test_filter_syncs_on_a_new_version_or_after_the_interval(self):
+        blacklistFilter = blacklist.get_filter()
+        blacklistFilter.sync()
+
+        def sync_queries():
+            with CaptureQueriesContext(connection) as queries:
+                blacklistFilter.sync()
+            return len(queries)
+
+        # Unchanged within the interval, the filter is not synced
+        self.assertEqual(sync_queries(), 0)
+
+        # Blacklisted by another process whose version this process can't see
+        token = RefreshToken.for_user(self.user)
+        token.blacklist()
+        self.assertNotIn(token['jti'], blacklistFilter)
+
+        with override_settings(TOKEN_BLACKLIST_SYNC_INTERVAL=0):
+            self.assertEqual(sync_queries(), 1)
+        self.assertIn(token['jti'], blacklistFilter)
+
+        # Blacklisted in this process, the version moves on at once
+        token = RefreshToken.for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            token.blacklist()
+
+        self.assertEqual(sync_queries(), 1)
+        self.assertIn(token['jti'], blacklistFilter)
+
+    def test_bloom_filter_holds_what_was_added(self):
+        bloom = blacklist.BloomFilter(1000)
+        values = [f"jti-{i}" for i in range(1000)]
+
+        for value in values:
+            bloom.add(value)
+
+        self.assertTrue(all(value in bloom for value in values))
+
+        falsePositives = sum(f"other-{i}" in bloom for i in range(10000))
+        self.assertLess(falsePositives, 300)
+
+    def test_prune_deletes_expired_tokens_in_batches(self):
+        tokens = [RefreshToken.for_user(self.user) for _ in range(4)]
+        tokens[0].blacklist()
+        tokens[3].blacklist()
+
+        OutstandingToken.objects.filter(jti__in=[token['jti'] for token in tokens[:3]]).update(
+            expires_at=now() - timedelta(minutes=1)
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(blacklist.prune(batchSize=2), (3, 1))
+
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE FROM "token_blacklist_outstandingtoken"')]
+        self.assertEqual(len(deletes), 2)
+        self.assertEqual(OutstandingToken.objects.count(), 2)
+        self.assertEqual(list(BlacklistedToken.objects.values_list("token__jti", flat=True)), [tokens[3]['jti']])
+
+    def test_pruning_is_scheduled_once_per_period(self):
+        self.assertGreaterEqual(jobs.schedule(), 1)
+        self.assertEqual(jobs.schedule(), 0)
+        self.assertEqual(Job.objects.filter(name="prune_expired_tokens").count(), 1)
+
+        OutstandingToken.objects.update(expires_at=now() - timedelta(minutes=1))
+        jobs.run_pending()
+
+        self.assertFalse(OutstandingToken.objects.exists())
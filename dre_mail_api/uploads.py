@@ -0,0 +1,170 @@
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from .models import Upload
+from . import blobs
+
+
+# Resumable uploads. Every chunk is copied from the request stream to the partial file of
+# the upload a block at a time, so a chunk is never held in memory, and the offset only
+# moves on by the bytes that actually reached the disk: after a dropped connection the
+# client asks for the offset and sends the rest from there. A request claims the offset of
+# the upload before it writes its chunk (see `claim`), so concurrent requests can't write
+# over each other, and no transaction stays open while the chunk comes over the network.
+
+BLOCK_SIZE = 64 * 1024
+PARTIAL_DIRECTORY = "uploads"
+
+# How long a claim holds without being renewed, after that the chunk is taken to be stalled
+# and another request can claim its offset. A request renews its claim while it writes.
+CLAIM_TIMEOUT = timedelta(minutes=2)
+CLAIM_RENEWAL = timedelta(seconds=30)
+
+
+class UploadConflict(Exception):
+    """
+    The chunk does not start at the current offset of the upload
+    """
+
+
+def partial_path(upload):
+    return default_storage.path(f"{PARTIAL_DIRECTORY}/{upload.id}.part")
+
+
+def start(upload):
+    """
+    It creates the empty partial file of a new upload
+    """
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+
+
+def claim(upload, offset):
+    """
+    It claims the offset of the upload for the chunk of one request, unless another request
+    holds a claim that has not timed out
+
+    :param upload: The upload the chunk belongs to
+    :param offset: The offset the client sends the chunk at, it must be the current offset
+    :raise UploadConflict: The upload is at another offset, complete, or claimed
+    :return: The token of the claim.
+    """
+    token = uuid.uuid4().hex
+    claimedAt = now()
+
+    claimed = Upload.objects.filter(
+        Q(writer="") | Q(claimed_at__lt=claimedAt - CLAIM_TIMEOUT), id=upload.id, offset=offset, status=Upload.PENDING
+    ).update(writer=token, claimed_at=claimedAt)
+
+    if not claimed:
+        current, uploadStatus = Upload.objects.values_list("offset", "status").get(id=upload.id)
+
+        if uploadStatus == Upload.COMPLETE:
+            raise UploadConflict("The upload is complete")
+
+        if offset != current:
+            raise UploadConflict(f"The upload is at offset {current}")
+
+        raise UploadConflict(f"A chunk is being written at offset {current}")
+
+    return token
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    It writes a chunk read from the stream at the offset of the upload
+
+    :param upload: The upload the chunk belongs to
+    :param offset: The offset the client sends the chunk at, it must be the current offset
+    :raise UploadConflict: The upload is at another offset, complete, or claimed
+    :param stream: The request stream holding the chunk
+    :param length: The length of the chunk
+    :return: The new offset of the upload.
+    """
+    token = claim(upload, offset)
+    claimed = Upload.objects.filter(id=upload.id, writer=token)
+
+    written = 0
+    renewedAt = time.monotonic()
+
+    try:
+        with open(partial_path(upload), "r+b") as file:
+            file.seek(offset)
+
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+
+                # A claim left unrenewed for longer than the renewal interval may have timed
+                # out, it is renewed before anything more is written
+                if time.monotonic() - renewedAt > CLAIM_RENEWAL.total_seconds():
+                    if not claimed.update(claimed_at=now()):
+                        raise UploadConflict("The chunk stalled and its offset was claimed again")
+
+                    renewedAt = time.monotonic()
+
+                file.write(block)
+                written += len(block)
+
+            # Drop whatever an interrupted request wrote past the offset
+            file.truncate()
+    finally:
+
+        # The offset moves on by the bytes that reached the disk, and the claim is released
+        claimed.update(offset=offset + written, writer="", claimed_at=None, updated_at=now())
+
+    upload.offset = offset + written
+    return upload.offset
+
+
+def finalize(upload):
+    """
+    It turns the partial file of a fully written upload into the blob of its content
+
+    :param upload: The upload to finalize
+    :return: The completed upload.
+    """
+    with transaction.atomic():
+        upload = Upload.objects.select_for_update().get(id=upload.id)
+
+        if upload.status == Upload.COMPLETE:
+            return upload
+
+        # The chunks came in over several requests, so the file is hashed once complete
+        path = partial_path(upload)
+        blob = blobs.store_path(path, *blobs.hash_file(path), keep=True)
+
+        upload.blob = blob
+        upload.file.name = blobs.blob_name(blob.sha256)
+        upload.status = Upload.COMPLETE
+        upload.save(update_fields=["blob", "file", "status", "updated_at"])
+
+        # The partial file is left until the upload is complete for good, so that finalizing
+        # can be tried again if this transaction rolls back
+        transaction.on_commit(lambda: remove_partial(upload))
+
+    return upload
+
+
+def remove_partial(upload):
+    try:
+        os.remove(partial_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def discard(upload):
+    """
+    It deletes an unfinished upload and its partial file
+    """
+    remove_partial(upload)
+    upload.delete()
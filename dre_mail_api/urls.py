@@ -1,6 +1,7 @@
 from django.urls import path, re_path, include
 from rest_framework.routers import DefaultRouter
 from dre_mail_api.views import *
+from dre_mail_api import async_views
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -9,6 +10,7 @@ from rest_framework_simplejwt.views import (
 router = DefaultRouter(trailing_slash=False)
 router.register(r'emails/?', EmailViewSet, basename="email")
 router.register(r'drafts/?', DraftViewSet, basename="drafts")
+router.register(r'uploads/?', UploadViewSet, basename="uploads")
 router.register(r'groups/?', EmailGroupViewSet, basename="group")
 router.register(r'users/?', UserViewSet, basename="users")
 router.register(r'emailTransfers/?', EmailTransferViewSet, basename="emailTransfers")
@@ -20,4 +22,14 @@ urlpatterns = [
     path('logout/', LogoutView.as_view(), name="logout"),
     path('register/', RegisterUserView.as_view(), name="register"),
     re_path('change_password/', ChangePasswordView.as_view(), name='change_password'),
+
+    # Async versions of the read heavy endpoints, for ASGI deployments
+    path('async/emailTransfers/inbox', async_views.inbox, name="async-inbox"),
+    path('async/emailTransfers/sent_emails', async_views.sent_emails, name="async-sent-emails"),
+    path('async/emailTransfers/trash', async_views.trash, name="async-trash"),
+    path('async/emailTransfers/spam', async_views.spam, name="async-spam"),
+    path('async/emailTransfers/junk', async_views.junk, name="async-junk"),
+    path('async/emailTransfers/favorites', async_views.favorites, name="async-favorites"),
+    path('async/users/<int:pk>', async_views.user_detail, name="async-user-detail"),
+    path('async/groups/<int:pk>/members', async_views.group_members, name="async-group-members"),
 ]
\ No newline at end of file
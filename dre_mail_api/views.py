@@ -1,4 +1,6 @@
-from django.shortcuts import render
+from django.shortcuts import redirect, render
+from django.http import Http404
+from django.core.files.storage import default_storage
 
 from dre_mail_api.customResponses import CustomResponses
 from .serializers import *
@@ -8,10 +10,18 @@ from rest_framework.exceptions import APIException
 from rest_framework import status, permissions, \
     generics, filters, viewsets
 from .models import *
-from rest_framework_simplejwt.tokens import RefreshToken
+from .blacklist import FilteredRefreshToken
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q
+from rest_framework.generics import get_object_or_404
+from rest_framework.reverse import reverse
+from .pagination import MailboxCursorPagination
+from .search import FullTextSearchFilter, search_transfers
+from .caching import cached_listing, is_not_modified, make_etag, not_modified
+from .downloads import DownloadContentNegotiation, serve_file
+from .principal import PrincipalMixin
+from . import avatars, counters, journal, mailbox, uploads
 
 
 # Create your views here.
@@ -26,7 +36,7 @@ class RegisterUserView(generics.CreateAPIView):
 
 
 # It's a class that inherits from the UpdateAPIView class and it's used to update a user's password
-class ChangePasswordView(generics.UpdateAPIView):
+class ChangePasswordView(PrincipalMixin, generics.UpdateAPIView):
     # add permission to check if user is authenticated
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ChangePasswordSerializer
@@ -55,7 +65,7 @@ class ChangePasswordView(generics.UpdateAPIView):
 
             # This is checking if the user is a superuser or if the user is trying to access their own
             # data.
-            if CustomUser.objects.get(id=request.user.id).is_superuser == False \
+            if self.principal.user.is_superuser == False \
                 and userID is not None \
                 and str(request.user.id) != userID:
                 return Response(
@@ -100,7 +110,7 @@ class LogoutView(generics.UpdateAPIView):
 
             if (serializer.is_valid()):
 
-                token = RefreshToken(request.data.get('refresh'))
+                token = FilteredRefreshToken(request.data.get('refresh'))
                 token.blacklist()
 
                 successMessage = CustomResponses.successResponse("You have been logged out successfully.")
@@ -129,6 +139,64 @@ class UserViewSet(viewsets.ModelViewSet):
     search_fields = ['first_name', 'last_name', 'username', 'email']
     http_method_names = ['get', 'delete', 'patch']
 
+    @action(detail=True, content_negotiation_class=DownloadContentNegotiation)
+    def avi(self, request, pk=None):
+        """
+        Download the avatar of a user. Supports Range and conditional requests.
+        """
+        return serve_file(request, self.get_object().avi)
+
+    @action(
+        detail=True, content_negotiation_class=DownloadContentNegotiation, url_name="avi-variant",
+        url_path=r"avi/(?P<token>[0-9a-f]+)/(?P<size>[0-9]+)\.(?P<extension>webp|jpg)"
+    )
+    def avi_variant(self, request, pk=None, token=None, size=None, extension=None):
+        """
+        Download a resized variant of the avatar of a user. The url names the avatar it was
+        made from, so the response never changes and is cached for good.
+        """
+        user = self.get_object()
+
+        if not user.avi or int(size) not in avatars.SIZES:
+            raise Http404("There is no such avatar.")
+
+        # A variant of a replaced avatar, e.g. from a listing cached before the change
+        if token != avatars.avatar_token(user):
+            aviURL = reverse("users-avi", kwargs={"pk": user.pk}, request=request)
+            return redirect(avatars.variant_urls(user, aviURL)[size][extension])
+
+        # Avatars stored before the variants existed are resized on their first download
+        if not default_storage.exists(avatars.variant_name(user, int(size), extension)):
+            try:
+                avatars.create_variants(user)
+            except OSError:
+                raise Http404("The avatar is not an image.")
+
+        response = serve_file(request, avatars.variant_file(user, int(size), extension))
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+
+        # The ETag comes from the last modification of the user, read without loading them
+        updatedAt = CustomUser.objects.filter(
+            pk=kwargs.get("pk")
+        ).values_list("updated_at", flat=True).first()
+
+        if updatedAt is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        etag = make_etag(request, kwargs.get("pk"), updatedAt.isoformat())
+
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+
+        response = super().retrieve(request, *args, **kwargs)
+        response["ETag"] = etag
+
+        return response
+
     def destroy(self, request, *args, **kwargs):
 
         # Only allow users to delete their own accounts
@@ -154,7 +222,7 @@ class UserViewSet(viewsets.ModelViewSet):
 
 """--------------- EMAIL GROUP ENDPOINTS ---------------"""
 
-class EmailGroupViewSet(viewsets.ModelViewSet):
+class EmailGroupViewSet(PrincipalMixin, viewsets.ModelViewSet):
     queryset = EmailGroup.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = EmailGroupSerializer
@@ -176,11 +244,10 @@ class EmailGroupViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
 
-        currentUser = CustomUser.objects.get(id=self.request.user.id)
-
+        # The groups the user created or is a member of
         return EmailGroup.objects.filter(
-            Q(creator = currentUser) | Q(members=currentUser)
-        ).distinct()
+            Q(creator_id=self.principal.id) | Q(id__in=self.principal.group_ids)
+        )
 
 
     @action(detail=True, serializer_class=UserSerializer, search_fields=['members__username'])
@@ -216,15 +283,13 @@ class EmailGroupViewSet(viewsets.ModelViewSet):
 
         try:
 
+            group = self.get_object()
+
             # check if the user is removing themselves by checking if no id was submitted
             if request.data.get("id") is None or request.data.get("id") == "":
 
                 # leave the group
-                self.get_object().members.remove(
-                    CustomUser.objects.get(
-                        id=self.request.user.id
-                    )
-                )
+                group.members.remove(self.principal.user)
 
                 return Response(
                     CustomResponses.successResponse("You have successfully left the group")
@@ -233,7 +298,7 @@ class EmailGroupViewSet(viewsets.ModelViewSet):
 
             # revoke access if the person trying to remove the member is 
             # not the creator of the group or the member themselves
-            if self.get_object().creator != CustomUser.objects.get(id=self.request.user.id):
+            if group.creator_id != self.principal.id:
                 return Response(
                 CustomResponses.errorResponse("You do not have access to perform this action"),
                 status=status.HTTP_400_BAD_REQUEST
@@ -244,7 +309,7 @@ class EmailGroupViewSet(viewsets.ModelViewSet):
                 id=request.data.get("id")
             )
 
-            self.get_object().members.remove(
+            group.members.remove(
                 userToRemove
             )
 
@@ -267,65 +332,194 @@ class EmailViewSet(viewsets.ModelViewSet):
     queryset = Email.objects.all()
     permission_classes = [permissions.IsAdminUser]
 
+    @action(
+        detail=True, permission_classes=[permissions.IsAuthenticated],
+        content_negotiation_class=DownloadContentNegotiation
+    )
+    def attachment(self, request, pk=None):
+        """
+        Download the attachment of an email the user sent, received or drafted.
+        Supports Range and conditional requests.
+        """
+
+        emails = Email.objects.all()
+
+        # Check the user can see the email with a single query
+        if not self.request.user.is_staff:
+            emails = emails.filter(
+                Exists(
+                    EmailTransfer.objects.visible_to(self.request.user).involving(
+                        self.request.user
+                    ).filter(email=OuterRef("pk"))
+                ) | Exists(
+                    Drafts.objects.filter(drafter=self.request.user, email=OuterRef("pk"))
+                )
+            )
+
+        email = get_object_or_404(emails, pk=pk)
+
+        return serve_file(request, email.attachment, asAttachment=True, filename=email.attachmentName)
+
+# Resumable uploads of attachments: POST starts an upload with its filename and size, PUT
+# sends the next chunk at the `Upload-Offset` header, GET tells where to resume, and
+# finalize turns the finished upload into an attachment a draft or an email can use.
+class UploadViewSet(viewsets.GenericViewSet):
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(owner_id=self.request.user.id)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, *args, **kwargs):
+        upload = self.get_object()
+
+        return Response(self.get_serializer(upload).data, headers={"Upload-Offset": str(upload.offset)})
+
+    def update(self, request, *args, **kwargs):
+        """
+        Write the chunk in the request body at the offset given by the `Upload-Offset` header.
+        The body is copied to disk from the request stream without being parsed.
+        """
+        upload = self.get_object()
+
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.headers.get("Content-Length") or 0)
+        except (KeyError, ValueError):
+            return Response(
+                CustomResponses.errorResponse("The Upload-Offset and Content-Length headers are required"),
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if upload.status == Upload.COMPLETE or offset + length > upload.size:
+            return Response(
+                CustomResponses.errorResponse("The chunk does not fit in the upload"),
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            uploads.write_chunk(upload, offset, request.stream, length)
+        except uploads.UploadConflict as e:
+            upload.refresh_from_db(fields=["offset"])
+
+            return Response(
+                CustomResponses.errorResponse(str(e)),
+                status=status.HTTP_409_CONFLICT,
+                headers={"Upload-Offset": str(upload.offset)}
+            )
+
+        return Response(self.get_serializer(upload).data, headers={"Upload-Offset": str(upload.offset)})
+
+    def destroy(self, request, *args, **kwargs):
+        uploads.discard(self.get_object())
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        upload = self.get_object()
+
+        if upload.offset != upload.size:
+            return Response(
+                CustomResponses.errorResponse(f"The upload is at {upload.offset} of {upload.size} bytes"),
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        upload = uploads.finalize(upload)
+
+        return Response(self.get_serializer(upload).data, status=status.HTTP_200_OK)
+
+
 # This class is a viewset that allows you to create, retrieve, update, and delete drafts
 class DraftViewSet(viewsets.ModelViewSet):
     serializer_class = DraftSerializer
     queryset = Drafts.objects.all()
     permission_classes = [permissions.IsAuthenticated]
 
-class EmailTransferViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        return self.get_serializer_class().setup_eager_loading(
+            Drafts.objects.all(), self.request.user
+        )
+
+    def perform_destroy(self, instance):
+
+        # The email of a draft belongs to it alone, deleting it (and the draft with it)
+        # releases the blob of its attachment
+        instance.email.delete()
+
+class EmailTransferViewSet(PrincipalMixin, viewsets.ModelViewSet):
     serializer_class = EmailTransferSerializer
     queryset = EmailTransfer.objects.all()
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    pagination_class = MailboxCursorPagination
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter]
     filterset_fields = ['sender', 'recipient']
-    search_fields = [
-        'email__subject', 
-        "email__message", 
-        "recipient__first_name",
-        "recipient__last_name",
-        "recipient__username",
-        "recipient__email",
-        "sender__first_name",
-        "sender__last_name",
-        "sender__username",
-        "sender__email",
-    ] 
 
     http_method_names = ['get', 'post', 'delete']
 
-    def get_queryset(self):
+    def shape_queryset(self, queryset):
+        """
+        Load the relations rendered by the serializer of the current action eagerly
+        
+        :param queryset: The queryset that is going to be serialized
+        :return: The queryset with its relations loaded up front.
+        """
+        return self.get_serializer_class().setup_eager_loading(queryset, self.request.user)
 
-        # Get the ids all permanently emails deleted by the current user
-        deletedEmailIds = list(
-            Deleted.objects.filter(
-                deleter=CustomUser.objects.get(id=self.request.user.id)
-            ).values_list("emailTransfer__id", flat=True)
-        )
+    def get_queryset(self):
 
-        # get all emails that have not been permanently deleted
-        queryset = EmailTransfer.objects.exclude(
-            id__in=deletedEmailIds
-        ).all()
+        # get all emails that have not been permanently deleted by the current user
+        queryset = EmailTransfer.objects.visible_to(self.request.user)
 
 
         read = self.request.query_params.get("hasRead")
 
-        if read is None:
-            return queryset
-
-        elif read == "true":
-            return queryset.filter(
+        if read == "true":
+            queryset = queryset.filter(
                 hasRead__id=self.request.user.id
             )
-        else:
-            return queryset.exclude(
+        elif read is not None:
+            queryset = queryset.exclude(
                 hasRead__id=self.request.user.id
             )
 
+        return self.shape_queryset(queryset)
 
+    def get_serializer_context(self):
+
+        # The folder listings take emails out of their own folder when posted to
+        context = super().get_serializer_context()
+        context["folder"] = self.action
+
+        return context
+
+
+    def create(self, request, *args, **kwargs):
+        """
+        Send an email to its recipients and groups. A single recipient_id or group_id
+        returns the new email transfer, the to, cc, bcc and group_ids lists return all of them.
         
-        
+        :param request: The request object
+        :return: A response object
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        if serializer.sends_to_many:
+            data = {"results": self.get_serializer(serializer.transfers, many=True).data}
+        else:
+            data = serializer.data
+
+        return Response(data, status=status.HTTP_201_CREATED)
+
 
     def destroy(self, request, *args, **kwargs):
         """
@@ -337,25 +531,19 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
         try:
 
-            currentUser = CustomUser.objects.get(id=self.request.user.id)
+            currentUser = self.principal.user
             currentEmail = self.get_object()
-            print(self.get_object().id)
-
 
-            # check if the user is the recipient of the email or is in the group that received the email
-            if currentEmail.recipient != currentUser and currentEmail.group != None and currentEmail.group.members != currentUser:
+            # check if the user sent the email, received it or is in the group that received the email
+            if not EmailTransfer.objects.involving(currentUser).filter(id=currentEmail.id).exists():
                 raise APIException("You do not have access to perform this action")
                 
 
             # Check if the email is in trash
-            if Trash.objects.filter(emailTransfer=currentEmail, deleter=currentUser).exists():
-
-                # delete the email from Trash
-                Trash.objects.get(deleter=currentUser, emailTransfer=currentEmail).delete()
+            if mailbox.current_folder(currentUser, currentEmail) == MailboxEntry.TRASH:
 
                 # permanently delete the email
-                deletedEmail = Deleted(deleter= currentUser, emailTransfer = currentEmail)
-                deletedEmail.save()
+                mailbox.move(currentUser, [currentEmail], MailboxEntry.DELETED)
 
                 return Response(
                     CustomResponses.successResponse("Email has been permanently deleted"),
@@ -364,12 +552,7 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
             # Move email to deleted Emails (trash)
-            trash = Trash(
-                deleter = currentUser,
-                emailTransfer = currentEmail
-            )
-
-            trash.save()
+            mailbox.move(currentUser, [currentEmail], MailboxEntry.TRASH)
 
             return Response(
                 CustomResponses.successResponse("Successfully moved email to Trash"),
@@ -381,6 +564,7 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
     @action(detail=False, serializer_class=InboxSerializer, methods=['get', 'post'])
+    @cached_listing
     def inbox(self, request):
 
         # Check if the user sends a post request and move the email to the respective table
@@ -388,51 +572,34 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
             try:
 
+                # The user making the request, already loaded for the request
+                user = self.principal.user
+
                 # Getting the email_id from the request.data and then getting the emailTransfer object
-                # from the database.
-                emailTransfer = EmailTransfer.objects.get(
+                # from the emails the user sent or received.
+                emailTransfer = EmailTransfer.objects.involving(user).get(
                     id=self.request.data.get("email_id")
                 )
 
-                # Getting the User object from the database.
-                user = CustomUser.objects.get(
-                    id=self.request.user.id
-                )
-
                 # The below code is a function that is used to move emails to different folders.
                 match(request.data.get("destination")):
 
                     case "favorites":
-                        favorites = Favorites(
-                            favoriter = user,
-                            emailTransfer = emailTransfer
-                        )
-
-                        favorites.save()
+                        mailbox.set_flag(user, [emailTransfer], MailboxEntry.FAVORITE)
 
                         return Response(
                             CustomResponses.successResponse("Email has been added to favorites")
                         )
 
                     case "junk":
-                        junk = Junk(
-                            junker = user,
-                            emailTransfer = emailTransfer
-                        )
-
-                        junk.save()
+                        mailbox.move(user, [emailTransfer], MailboxEntry.JUNK)
 
                         return Response(
                             CustomResponses.successResponse("Email has been added to junk")
                         )
 
                     case "spam":
-                        spam = Spam(
-                            spammer = user,
-                            emailTransfer = emailTransfer
-                        )
-
-                        spam.save()
+                        mailbox.move(user, [emailTransfer], MailboxEntry.SPAM)
 
                         return Response(
                             CustomResponses.successResponse("Email has been added to spam")
@@ -445,34 +612,9 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
         # Getting the query parameter "unread" from the request.
         read = self.request.query_params.get("read")
 
-        # Getting the user object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
-
-        # Getting all the deleted emails ids of the user.
-        trashedEmailIDs = list(Trash.objects.filter(
-            deleter=user
-        ).values_list("emailTransfer__id", flat=True))
-
-       # Filtering the spammer and getting the values of the emailTransfer__id.
-        spamEmailIDs = list(Spam.objects.filter(
-            spammer=user
-        ).values_list("emailTransfer__id", flat=True))
-
-        # Filtering the Spam model for the user and then returning the emailTransfer__id
-        junkEmailIDs = list(Junk.objects.filter(
-            junker=user
-        ).values_list("emailTransfer__id", flat=True))
-
-
-        # Get inbox (emails received by the user or by groups that the user is in)
-        inbox = self.get_queryset().exclude(
-            id__in=trashedEmailIDs + spamEmailIDs + junkEmailIDs,
-        ).filter(
-            Q(group__isnull=True) | Q(group__members=user),
-            recipient=user
-        )
+        # Get inbox (emails delivered to the user that are still in their inbox)
+        # straight from the (user, folder, dateSent) index
+        inbox = MailboxEntry.objects.in_folder(self.request.user, MailboxEntry.INBOX)
 
         
         # Filtering the emails based on the unread status.
@@ -482,24 +624,103 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
             if read == "true":
                 inbox = inbox.filter(
-                    hasRead__id=self.request.user.id
+                    emailTransfer__hasRead__id=self.request.user.id
                 )
             else:
                 inbox = inbox.exclude(
-                    hasRead__id=self.request.user.id
+                    emailTransfer__hasRead__id=self.request.user.id
                 )
         
+        # Load the email transfers of the entries the way the inbox serializer renders them
+        inbox = EmailActionSerializer.setup_eager_loading(inbox, self.request.user)
 
         page = self.paginate_queryset(inbox)
         
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
+            serializer = self.get_serializer([entry.emailTransfer for entry in page], many=True)
             return self.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(inbox, many=True)
+        serializer = self.get_serializer([entry.emailTransfer for entry in inbox], many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+    @action(detail=False)
+    def search(self, request):
+        """
+        Full text search over the emails the user sent or received, best matches first.
+        Every word of the `q` query parameter is matched as a prefix of the subject,
+        message or participant names.
+        """
+
+        results = search_transfers(
+            self.get_queryset().involving(self.request.user),
+            self.request.query_params.get("q")
+        ).order_by("-search_rank", "-dateSent", "-id")
+
+        # Ranked results are not paged with a cursor, only the best `page_size` are returned
+        results = results[:self.paginator.get_page_size(request)]
+
+        serializer = self.get_serializer(results, many=True)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
+
+
+    @action(detail=False)
+    def counts(self, request):
+        """
+        The badge counts of the mailbox of the user (unread inbox emails, trash, spam,
+        junk and favorites), read from their counter row with a single query
+        """
+
+        counts = MailboxCounter.objects.filter(
+            user_id=self.request.user.id
+        ).values(*counters.FIELDS).first()
+
+        return Response(
+            CustomResponses.successResponse(counts or dict.fromkeys(counters.FIELDS, 0)),
+            status=status.HTTP_200_OK
+        )
+
+
+    @action(detail=False)
+    def changes(self, request):
+        """
+        The changes to the mailbox of the user after the `since` token: one record per email
+        with what changed (delivered, has_read, folder and favorite, or deleted) and the token
+        to ask from next time. Without `since` it only returns the current token, to take
+        before fetching the mailbox. A token too old to sync from gets a 410 and a fresh token.
+        """
+
+        since = request.query_params.get("since")
+
+        if since is None:
+            return Response(
+                CustomResponses.successResponse({"changes": [], "token": journal.current_token(request.user.id), "more": False}),
+                status=status.HTTP_200_OK
+            )
+
+        try:
+            records, token, more = journal.changes_since(request.user.id, journal.parse_token(since))
+
+        except ValueError:
+            return Response(
+                CustomResponses.errorResponse("Invalid sync token"),
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        except journal.TokenTooOld:
+
+            # The client refetches its mailbox, then syncs from the token it is given here
+            response = CustomResponses.errorResponse("The sync token is too old, refetch the mailbox")
+            response["error"]["token"] = journal.current_token(request.user.id)
+
+            return Response(response, status=status.HTTP_410_GONE)
+
+        return Response(
+            CustomResponses.successResponse({"changes": records, "token": token, "more": more}),
+            status=status.HTTP_200_OK
+        )
+
+
     @action(detail=False, serializer_class=ReadStatusUpdateSerializers, methods=['post'])
     def update_read_status(self, request):
 
@@ -530,13 +751,114 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
             raise APIException(e)  
 
     
+    @action(detail=False, serializer_class=ReadStatusBatchSerializer, methods=['post'])
+    def read_status(self, request):
+        """
+        Mark a list of emails as read or unread. The `has_read` field sets the status
+        explicitly, emails that already have it are left untouched.
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        ids = serializer.validated_data["ids"]
+
+        # Only the emails the user sent or received can be marked, checked with a single query
+        accessible = set(
+            EmailTransfer.objects.involving(self.request.user).filter(id__in=ids).values_list("id", flat=True)
+        )
+
+        changed = mailbox.set_read(
+            self.request.user,
+            [transferID for transferID in ids if transferID in accessible],
+            serializer.validated_data["has_read"]
+        )
+
+        return Response(
+            CustomResponses.successResponse({
+                "has_read": serializer.validated_data["has_read"],
+                "updated": changed,
+                "not_found": [transferID for transferID in ids if transferID not in accessible],
+            }),
+            status=status.HTTP_200_OK
+        )
+
+
+    @action(detail=False, serializer_class=MarkAllReadSerializer, methods=['post'])
+    def mark_all_read(self, request):
+        """
+        Mark every email of a folder as read in one request. When `up_to` is the id of the
+        newest email the client has listed, emails that arrived since then stay unread.
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        folder = serializer.validated_data["folder"]
+        upTo = None
+
+        if "up_to" in serializer.validated_data:
+            upTo = MailboxEntry.objects.in_folder(self.request.user, folder).filter(
+                emailTransfer_id=serializer.validated_data["up_to"]
+            ).values_list("dateSent", "emailTransfer_id").first()
+
+            if upTo is None:
+                return Response(
+                    CustomResponses.errorResponse("The email is not in this folder"),
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        updated = mailbox.mark_folder_read(self.request.user, folder, upTo)
+
+        return Response(
+            CustomResponses.successResponse({"folder": folder, "updated": updated}),
+            status=status.HTTP_200_OK
+        )
+
+
+    @action(detail=False, serializer_class=BulkMoveSerializer, methods=['post'])
+    def move(self, request):
+        """
+        Move a list of emails from a source folder to a destination folder in one transaction.
+        Every id gets a result: moved, not_in_folder when it is not in the source folder, or
+        not_found when the user did not send or receive it.
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        ids = serializer.validated_data["ids"]
+        source = serializer.validated_data["source"]
+        destination = serializer.validated_data["destination"]
+
+        # Check the access to every email with a single query
+        transfers = EmailTransfer.objects.involving(self.request.user).filter(id__in=ids).in_bulk()
+
+        moved = set(mailbox.bulk_move(self.request.user, list(transfers.values()), source, destination))
+
+        results = []
+        for transferID in dict.fromkeys(ids):
+            if transferID in moved:
+                result = "moved"
+            elif transferID in transfers:
+                result = "not_in_folder"
+            else:
+                result = "not_found"
+
+            results.append({"id": transferID, "result": result})
+
+        return Response(
+            CustomResponses.successResponse({"source": source, "destination": destination, "results": results}),
+            status=status.HTTP_200_OK
+        )
+
+
     @action(detail=False, serializer_class=SentEmailSerializer)
+    @cached_listing
     def sent_emails(self, request):
 
-        # Getting the User object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
+        # The user making the request, already loaded for the request
+        user = self.principal.user
         
         sentEmails = self.get_queryset().filter(sender=user)
 
@@ -551,20 +873,21 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
     @action(detail=False, serializer_class=EmailActionSerializer, methods=['get', 'post'])
+    @cached_listing
     def trash(self, request):
 
         # Check if the user sends a post request and move the email back to inbox
         if self.request.method == "POST":
-            self.create(request=request)
+            super().create(request)
             return Response(CustomResponses.successResponse("Email has been moved back to inbox")
         )
 
-        # Getting the user object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
+        # The user making the request, already loaded for the request
+        user = self.principal.user
         
-        trash = Trash.objects.filter(deleter=user)
+        trash = self.shape_queryset(
+            MailboxEntry.objects.in_folder(user, MailboxEntry.TRASH)
+        )
 
         page = self.paginate_queryset(trash)
         
@@ -577,19 +900,20 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
     @action(detail=False, serializer_class=EmailActionSerializer, methods=['get', 'post'])
+    @cached_listing
     def spam(self, request):
 
         # Check if the user sends a post request and move the email back to inbox
         if self.request.method == "POST":
-            self.create(request=request)
+            super().create(request)
             return Response(CustomResponses.successResponse("Email has been moved back to inbox"))
 
-        # Getting the user object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
+        # The user making the request, already loaded for the request
+        user = self.principal.user
         
-        spam = Spam.objects.filter(spammer=user)
+        spam = self.shape_queryset(
+            MailboxEntry.objects.in_folder(user, MailboxEntry.SPAM)
+        )
 
         page = self.paginate_queryset(spam)
         
@@ -602,20 +926,21 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
     @action(detail=False, serializer_class=EmailActionSerializer, methods=['get', 'post'])
+    @cached_listing
     def junk(self, request):
 
         # Check if the user sends a post request and move the email back to inbox
         if self.request.method == "POST":
             
-            self.create(request=request)
+            super().create(request)
             return Response(CustomResponses.successResponse("Email has been moved back to inbox"))
 
-        # Getting the user object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
+        # The user making the request, already loaded for the request
+        user = self.principal.user
         
-        junk = Junk.objects.filter(junker=user)
+        junk = self.shape_queryset(
+            MailboxEntry.objects.in_folder(user, MailboxEntry.JUNK)
+        )
 
         page = self.paginate_queryset(junk)
         
@@ -628,19 +953,20 @@ class EmailTransferViewSet(viewsets.ModelViewSet):
 
 
     @action(detail=False, serializer_class=EmailActionSerializer, methods=['get', 'post'])
+    @cached_listing
     def favorites(self, request):
 
         # Check if the user sends a post request and move the email back to inbox
         if self.request.method == "POST":
-            self.create(request=request)
+            super().create(request)
             return Response(CustomResponses.successResponse("Email has been moved back to inbox"))
 
-        # Getting the user object from the database.
-        user = CustomUser.objects.get(
-            id=self.request.user.id
-        )
+        # The user making the request, already loaded for the request
+        user = self.principal.user
         
-        favorites = Favorites.objects.filter(favoriter=user)
+        favorites = self.shape_queryset(
+            MailboxEntry.objects.flagged(user, MailboxEntry.FAVORITE)
+        )
 
         page = self.paginate_queryset(favorites)
         